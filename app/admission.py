@@ -0,0 +1,241 @@
+"""
+Admission control: per-route concurrency limits with bounded wait queues,
+shedding the requests that would wait too long with 503 Retry-After
+"""
+import heapq
+import itertools
+import os
+import threading
+import time
+import weakref
+from flask import current_app, g, jsonify, request
+
+# Outcomes of Gate.acquire: admitted at once or after waiting, or shed
+# because the queue was full, the wait too long or a request of a higher
+# priority took the place in the queue
+ADMITTED = 'admitted'
+QUEUED = 'queued'
+QUEUE_FULL = 'queue_full'
+TIMEOUT = 'timeout'
+PREEMPTED = 'preempted'
+SHED = (QUEUE_FULL, TIMEOUT, PREEMPTED)
+
+
+class Waiter(object):
+    """A request waiting for a slot of a Gate"""
+    __slots__ = ('event', 'granted', 'shed')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+        self.shed = None
+
+
+class Gate(object):
+    """Lets at most `limit` requests in at once and up to `queue` more wait
+    for a slot, lowest `priority` first and in arrival order otherwise.
+
+    A request finding the queue full is shed, unless a waiter of a higher
+    priority number is there, which is shed in its place.
+    """
+
+    def __init__(self, limit, queue):
+        self.limit = limit
+        self.queue = queue
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        self._running = 0
+        # (priority, sequence, waiter)
+        self._waiters = []
+
+    def acquire(self, priority, timeout):
+        """Wait up to `timeout` seconds for a slot, returns the outcome"""
+        with self._lock:
+            if self._running < self.limit and not self._waiters:
+                self._running += 1
+                return ADMITTED
+            if len(self._waiters) >= self.queue:
+                worst = max(self._waiters, default=None)
+                if worst is None or worst[0] <= priority:
+                    return QUEUE_FULL
+                self._waiters.remove(worst)
+                heapq.heapify(self._waiters)
+                worst[2].shed = PREEMPTED
+                worst[2].event.set()
+            waiter = Waiter()
+            heapq.heappush(self._waiters,
+                           (priority, next(self._sequence), waiter))
+        waiter.event.wait(timeout)
+        with self._lock:
+            if waiter.granted:
+                return QUEUED
+            if waiter.shed is not None:
+                return waiter.shed
+            self._waiters = [entry for entry in self._waiters
+                             if entry[2] is not waiter]
+            heapq.heapify(self._waiters)
+            return TIMEOUT
+
+    def release(self):
+        """Give the slot to the first waiter, if any"""
+        with self._lock:
+            if self._waiters:
+                _, _, waiter = heapq.heappop(self._waiters)
+                waiter.granted = True
+                waiter.event.set()
+            else:
+                self._running -= 1
+
+    def state(self):
+        """(running, waiting)"""
+        with self._lock:
+            return self._running, len(self._waiters)
+
+
+class AdmissionControl(object):
+    """Bounds the requests each worker process runs at once.
+
+    ADMISSION_LIMITS maps endpoints to (concurrency, queue) pairs: the
+    requests of an endpoint beyond its concurrency wait for a slot, and
+    those beyond its queue are shed. ADMISSION_MAX_CONCURRENCY and
+    ADMISSION_MAX_QUEUE do the same for every endpoint together, serving
+    first the endpoints of ADMISSION_PRIORITY_ENDPOINTS, which also take
+    the place of waiting requests of the others when the queue is full.
+    Requests waiting over ADMISSION_QUEUE_TIMEOUT seconds are shed too.
+    Shed requests get 503 with a Retry-After of ADMISSION_RETRY_AFTER
+    seconds. With ADMISSION_ENABLED off nothing is registered.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        # app -> (pid, {endpoint or None: Gate}), None being the process-wide
+        # gate. Slots are per process.
+        self._gates = weakref.WeakKeyDictionary()
+        # (endpoint, outcome) -> count
+        self._counts = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ADMISSION_ENABLED', False)
+        app.config.setdefault('ADMISSION_LIMITS', {})
+        app.config.setdefault('ADMISSION_MAX_CONCURRENCY', None)
+        app.config.setdefault('ADMISSION_MAX_QUEUE', 0)
+        app.config.setdefault('ADMISSION_PRIORITY_ENDPOINTS',
+                              ('api.check_access',
+                               'api.check_access_batch'))
+        # Long-lived streams would hold their slots for minutes
+        app.config.setdefault('ADMISSION_EXEMPT_ENDPOINTS',
+                              ('metrics', 'api.follow_changes'))
+        app.config.setdefault('ADMISSION_QUEUE_TIMEOUT', 1.0)
+        app.config.setdefault('ADMISSION_RETRY_AFTER', 1)
+        app.extensions['admission'] = self
+        if not app.config['ADMISSION_ENABLED']:
+            return
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def _app_gates(self, app):
+        # Gates created in the gunicorn master are not those of a worker
+        with self._lock:
+            pid, gates = self._gates.get(app, (None, None))
+            if pid != os.getpid():
+                config = app.config
+                gates = {endpoint: Gate(limit, queue) for endpoint,
+                         (limit, queue) in config['ADMISSION_LIMITS'].items()}
+                if config['ADMISSION_MAX_CONCURRENCY'] is not None:
+                    gates[None] = Gate(config['ADMISSION_MAX_CONCURRENCY'],
+                                       config['ADMISSION_MAX_QUEUE'])
+                self._gates[app] = (os.getpid(), gates)
+            return gates
+
+    def _count(self, endpoint, outcome):
+        with self._lock:
+            key = (endpoint, outcome)
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def _before_request(self):
+        app = current_app._get_current_object()
+        config = app.config
+        endpoint = request.endpoint
+        if endpoint is None or endpoint in config[
+                'ADMISSION_EXEMPT_ENDPOINTS']:
+            return None
+        gates = self._app_gates(app)
+        priority = 0 if endpoint in config[
+            'ADMISSION_PRIORITY_ENDPOINTS'] else 1
+        deadline = time.monotonic() + config['ADMISSION_QUEUE_TIMEOUT']
+        held = g.admission_gates = []
+        admitted = ADMITTED
+        # The endpoint's own slot first, so a request waiting for it does
+        # not keep a process-wide slot from the others
+        for gate in (gates.get(endpoint), gates.get(None)):
+            if gate is None:
+                continue
+            outcome = gate.acquire(priority,
+                                   max(deadline - time.monotonic(), 0))
+            if outcome in SHED:
+                self._count(endpoint, outcome)
+                return self._reject()
+            held.append(gate)
+            if outcome == QUEUED:
+                admitted = QUEUED
+        self._count(endpoint, admitted)
+        return None
+
+    def _reject(self):
+        # Slots taken before the gate that shed the request go back
+        for gate in reversed(g.pop('admission_gates', [])):
+            gate.release()
+        response = jsonify({"message": "Too many requests, retry later."})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(
+            current_app.config['ADMISSION_RETRY_AFTER'])
+        return response
+
+    def _teardown_request(self, exc):
+        # Runs once a streamed body has been sent as well
+        for gate in reversed(g.pop('admission_gates', [])):
+            gate.release()
+
+    def stats(self):
+        """{(endpoint, outcome): count} of the Gate.acquire outcomes"""
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+    def collect(self):
+        """Counters in the format expected by Metrics.add_collector"""
+        counts = sorted(self.stats().items())
+        with self._lock:
+            gates = [(endpoint or '*', gate.state())
+                     for pid, app_gates in list(self._gates.values())
+                     if pid == os.getpid()
+                     for endpoint, gate in app_gates.items()]
+        gates.sort()
+        return [
+            ('meetings_admission_admitted_total', 'counter',
+             'Requests admitted without waiting.',
+             [({'endpoint': endpoint}, count)
+              for (endpoint, outcome), count in counts
+              if outcome == ADMITTED]),
+            ('meetings_admission_queued_total', 'counter',
+             'Requests admitted after waiting for a slot.',
+             [({'endpoint': endpoint}, count)
+              for (endpoint, outcome), count in counts
+              if outcome == QUEUED]),
+            ('meetings_admission_shed_total', 'counter',
+             'Requests answered 503, by reason.',
+             [({'endpoint': endpoint, 'reason': outcome}, count)
+              for (endpoint, outcome), count in counts
+              if outcome in SHED]),
+            ('meetings_admission_running', 'gauge',
+             'Requests holding a slot, by gate ("*" for the process).',
+             [({'gate': name}, running) for name, (running, _) in gates]),
+            ('meetings_admission_waiting', 'gauge',
+             'Requests waiting for a slot, by gate.',
+             [({'gate': name}, waiting) for name, (_, waiting) in gates]),
+        ]
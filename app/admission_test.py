@@ -0,0 +1,128 @@
+import threading
+import time
+import unittest
+from app import create_app
+from extensions import admission, metrics
+import admission as admission_control
+
+
+class GateTestCase(unittest.TestCase):
+
+    def wait_in_thread(self, gate, priority, queued=None):
+        """Start a thread acquiring a slot of `gate`, returns the list its
+        outcome is appended to once it waits, or once `queued()` is true"""
+        outcomes = []
+        waiting = gate.state()[1]
+        thread = threading.Thread(target=lambda: outcomes.append(
+            gate.acquire(priority, 5)))
+        thread.start()
+        queued = queued or (lambda: gate.state()[1] != waiting)
+        while not queued() and not outcomes:
+            time.sleep(0.001)
+        self.addCleanup(thread.join)
+        return outcomes
+
+    def test_limit_and_queue(self):
+        gate = admission_control.Gate(1, 1)
+        self.assertEqual(admission_control.ADMITTED, gate.acquire(1, 0))
+        queued = self.wait_in_thread(gate, 1)
+        self.assertEqual(admission_control.QUEUE_FULL, gate.acquire(1, 5))
+        gate.release()
+        while not queued:
+            time.sleep(0.001)
+        self.assertEqual([admission_control.QUEUED], queued)
+        self.assertEqual((1, 0), gate.state())
+        gate.release()
+        self.assertEqual((0, 0), gate.state())
+
+    def test_wait_times_out(self):
+        gate = admission_control.Gate(1, 1)
+        gate.acquire(1, 0)
+        self.assertEqual(admission_control.TIMEOUT, gate.acquire(1, 0.01))
+        self.assertEqual((1, 0), gate.state())
+
+    def test_priority_goes_first_and_takes_the_last_place(self):
+        """Ensure a priority request is served before the waiting ones and
+        sheds the last of them when the queue is full"""
+        gate = admission_control.Gate(1, 2)
+        gate.acquire(1, 0)
+        first = self.wait_in_thread(gate, 1)
+        second = self.wait_in_thread(gate, 1)
+        urgent = self.wait_in_thread(gate, 0, lambda: second)
+        self.assertEqual([admission_control.PREEMPTED], second)
+        self.assertEqual(admission_control.QUEUE_FULL, gate.acquire(1, 0))
+        gate.release()
+        while not urgent:
+            time.sleep(0.001)
+        self.assertEqual(([admission_control.QUEUED], []), (urgent, first))
+        gate.release()
+        while not first:
+            time.sleep(0.001)
+        self.assertEqual([admission_control.QUEUED], first)
+
+
+class AdmissionControlTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app({
+            'TESTING': True,
+            'STORAGE_BACKEND': 'memory',
+            'ADMISSION_ENABLED': True,
+            'ADMISSION_LIMITS': {'api.get_recordings': (1, 0)},
+            'ADMISSION_MAX_CONCURRENCY': 4,
+            'ADMISSION_RETRY_AFTER': 2,
+            'LIST_STREAM_CHUNK': 1,
+        })
+        self.client = self.app.test_client()
+        admission.reset()
+        metrics.reset()
+
+    def gate(self, endpoint):
+        return admission._app_gates(self.app)[endpoint]
+
+    def test_sheds_over_the_route_limit(self):
+        gate = self.gate('api.get_recordings')
+        gate.acquire(1, 0)
+        rv = self.client.get('/recording/get')
+        self.assertEqual(503, rv.status_code)
+        self.assertEqual('2', rv.headers['Retry-After'])
+        self.assertEqual("Too many requests, retry later.",
+                         rv.get_json()['message'])
+        # Other routes and the metrics are still served
+        self.assertEqual(200, self.client.get('/viewer/get').status_code)
+        gate.release()
+        self.assertEqual(200, self.client.get('/recording/get').status_code)
+        self.assertEqual((0, 0), gate.state())
+        self.assertEqual((0, 0), self.gate(None).state())
+
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('meetings_admission_shed_total{endpoint='
+                      '"api.get_recordings",reason="queue_full"} 1', body)
+        self.assertIn('meetings_admission_admitted_total{endpoint='
+                      '"api.get_recordings"} 1', body)
+        self.assertIn('meetings_requests_total{method="GET",'
+                      'route="/recording/get",status="503"} 1', body)
+
+    def test_streamed_list_holds_its_slot(self):
+        """Ensure a slot is only given back once the body was sent"""
+        self.client.post('/viewer/create', json={'email': 'host@email.com'})
+        self.client.post('/meeting/create', json={
+            'host_email': 'host@email.com', 'password': 'pass'})
+        for i in range(3):
+            self.client.post('/recording/create', json={
+                'url': 'https://rec/%d' % i, 'is_private': False,
+                'meeting_id': 1})
+        rv = self.client.get('/recording/get?stream=ndjson')
+        self.assertEqual((1, 0), self.gate('api.get_recordings').state())
+        rv.get_data()
+        rv.close()
+        self.assertEqual((0, 0), self.gate('api.get_recordings').state())
+
+    def test_disabled_by_default(self):
+        app = create_app({'TESTING': True, 'STORAGE_BACKEND': 'memory'})
+        self.assertNotIn(admission._before_request,
+                         app.before_request_funcs.get(None, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
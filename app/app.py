@@ -1,234 +1,957 @@
-from flask import Flask, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from flask_marshmallow import Marshmallow
-import os
-import re
+from flask import (Blueprint, Flask, Response, current_app, request,
+                   jsonify, stream_with_context)
+from flask.cli import with_appcontext
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from config import Config
+from extensions import (access_cache, admission, credential_cache, db,
+                        group_commit, ma, metrics, profiler, read_routing,
+                        recording_purge, shards, storage, viewer_filter)
+from storage import Retry
+import changes
+import click
+import contextlib
+import counters
+import datetime
+import functools
+import listing
+import memory
+import migrations
+import models
+import purge
+import shardstorage
+import sqlstorage
+import transfer
+import versions
+
+# Init api
+api = Blueprint('api', __name__)
+
+# Storage backends, selected by STORAGE_BACKEND
+storage.add_backend('sqlalchemy', sqlstorage.SQLAlchemyRepository.from_app)
+storage.add_backend('memory', memory.MemoryRepository)
+storage.add_backend('sharded', shardstorage.ShardedRepository.from_app)
+
+# Purged recordings give their url back to the sharded backend
+recording_purge.on_purged(shardstorage.release)
+
+# Runs of a write unit whose records keep moving, see storage.Retry
+WRITE_ATTEMPTS = 3
+
 
 # Init app
-app = Flask(__name__)
-basedir = os.path.abspath(os.path.dirname(__file__))
-# Configuration
-DATABASE = "meetings.db"
-# Database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + \
-    os.path.join(basedir, DATABASE)
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-# Init db
-db = SQLAlchemy(app)
-# Init ma
-ma = Marshmallow(app)
+def create_app(config=None):
+    """Create and configure an instance of the Meetings API.
+
+    `config` is a mapping of settings applied on top of config.Config and
+    of the file MEETINGS_SETTINGS points to. Database engines are only
+    created on first use, so the app can be created before forking.
+    """
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config.from_envvar('MEETINGS_SETTINGS', silent=True)
+    if config is not None:
+        app.config.from_mapping(config)
+    db.init_app(app)
+    ma.init_app(app)
+    storage.init_app(app)
+    shards.init_app(app)
+    access_cache.init_app(app)
+    credential_cache.init_app(app)
+    viewer_filter.init_app(app)
+    group_commit.init_app(app)
+    recording_purge.init_app(app)
+    read_routing.init_app(app)
+    metrics.init_app(app)
+    # After the metrics, which count shed requests, and before the
+    # profiler, which only profiles admitted ones
+    admission.init_app(app)
+    profiler.init_app(app)
+    app.register_blueprint(api)
+    app.cli.add_command(upgrade_db)
+    app.cli.add_command(export_data)
+    app.cli.add_command(import_data)
+    app.cli.add_command(prune_changes)
+    app.cli.add_command(purge_recordings)
+    app.cli.add_command(rebalance_shards)
+    app.cli.add_command(reconcile_counters)
+    return app
+
+
+# Remember meetings whose password or host changed in a transaction
+@event.listens_for(models.Meeting, 'after_update')
+def meeting_updated(mapper, connection, meeting):
+    state = inspect(meeting)
+    if (state.attrs.password.history.has_changes() or
+            state.attrs.host_email.history.has_changes()):
+        state.session.info.setdefault('changed_meetings', set()).add(
+            meeting.id)
+
+
+# Drop cached access decisions once those changes are committed
+@event.listens_for(db.session, 'after_commit')
+def invalidate_changed_meetings(session):
+    for meeting_id in session.info.pop('changed_meetings', ()):
+        access_cache.invalidate_meeting(meeting_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_meetings(session):
+    session.info.pop('changed_meetings', None)
+
+
+# Bump the versions of the tables and rows a flush changed, in the same
+# transaction. Listening on Session covers the group commit writer too.
+@event.listens_for(Session, 'after_flush')
+def bump_versions(session, flush_context):
+    versions.bump(session.connection(), versions.changed(session),
+                  current_app.config['SQL_IN_CHUNK'])
+
+
+# (ETag, Last-Modified) of the current version of `name` for this request,
+# or None if it was never bumped. Read it before the resource, so that a
+# concurrent write can only make the validators older than the body.
+def version_of(name):
+    current = storage.repository.version(name)
+    if current is None:
+        return None
+    version, modified = current
+    return versions.etag(version, modified, request.query_string), modified
+
+
+# The ETag decides when the client sent one. Otherwise If-Modified-Since
+# must be after the change itself, not just in its second.
+def not_modified(validators):
+    if validators is None:
+        return False
+    etag, modified = validators
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return since is not None and modified < since
+
+
+# Last-Modified only has whole seconds. Once the second of the change is
+# over it is the end of that second, which validates the resource until
+# the next change. Until then it is the start, which does not, as another
+# change may still come in the same second.
+def last_modified(modified):
+    end = modified.replace(microsecond=0) + datetime.timedelta(seconds=1)
+    return min(end, datetime.datetime.utcnow().replace(microsecond=0))
+
+
+def with_validators(response, validators):
+    if validators is not None:
+        response.set_etag(validators[0])
+        response.last_modified = last_modified(validators[1])
+    return response
+
+
+# List all rows of a table, or a keyset page or stream of them if asked.
+# Only the columns the schema declares (or the ?fields= subset of them) are
+# fetched, and rows are encoded without going through the schema.
+def list_response(table, key, schema):
+    fields = schema.Meta.fields
+    try:
+        if 'fields' in request.args:
+            fields = listing.parse_fields(request.args['fields'], fields)
+        if listing.wants_page(request.args):
+            after, limit, stream = listing.parse_page_args(
+                request.args, key, current_app.config['LIST_MAX_LIMIT'])
+        else:
+            after, limit, stream = None, None, None
+    except listing.InvalidArgument as e:
+        return jsonify({"message": str(e)})
+
+    # Unchanged since the client's copy: skip the query altogether
+    validators = version_of(table)
+    if not_modified(validators):
+        return with_validators(Response(status=304), validators)
+
+    columns = list(fields)
+    if key.key not in fields:
+        # Needed for the next page cursor, left out of the items
+        columns.append(key.key)
+    chunk_size = current_app.config['LIST_STREAM_CHUNK'] if stream else None
+    rows = storage.repository.rows(table, columns,
+                                   listing.wants_page(request.args), after,
+                                   limit, chunk_size)
+
+    if stream:
+        items = (dict(zip(fields, row)) for row in rows)
+        body = listing.stream_json(items, stream == 'ndjson', chunk_size)
+        return with_validators(Response(
+            stream_with_context(body),
+            mimetype=listing.STREAM_FORMATS[stream]), validators)
+
+    response = jsonify([dict(zip(fields, row)) for row in rows])
+    if limit is not None and len(rows) == limit:
+        response.headers['Link'] = listing.next_link(
+            request.base_url, request.args,
+            rows[-1][columns.index(key.key)], limit)
+    return with_validators(response, validators)
+
+
+# Run a write unit in a transaction. With group commit enabled the unit
+# shares a transaction with the ones submitted concurrently. Units get the
+# repository to work with and return the response body, so validation and
+# the insert see the same snapshot. A unit whose records changed before it
+# wrote is run again, see storage.Retry.
+def write(unit, *args):
+    for attempt in range(1, WRITE_ATTEMPTS + 1):
+        try:
+            if group_commit.enabled and storage.backend == 'sqlalchemy':
+                return group_commit.submit(sqlstorage.run, unit, *args)
+            with storage.repository.transaction() as repository:
+                return unit(repository, *args)
+        except Retry:
+            if attempt == WRITE_ATTEMPTS:
+                raise
 
-import models
 
 """
 This is the Meeting API
 """
 
-# Create a Meeting
-@app.route('/meeting/create', methods=['POST'])
-def create_meeting():
-    host_email = request.json['host_email']
-    password = request.json['password']
 
+# Insert a Meeting, the write unit of create_meeting
+def insert_meeting(repository, host_email, password):
     # Verify if the host email is from a valid host
-    viewer = models.Viewer.query.filter_by(
-        email=host_email).first()
+    viewer = repository.viewer(host_email)
     if not viewer:
-        return jsonify({"message": "Invalid host email."})
+        return {"message": "Invalid host email."}
 
-    new_meeting = models.Meeting(host_email, password)
-    db.session.add(new_meeting)
-    db.session.commit()
-    return models.meeting_schema.jsonify(new_meeting)
+    new_meeting = repository.add_meeting(host_email, password)
+    result = models.meeting_schema.dump(new_meeting).data
+    repository.record(changes.MEETING_CREATE, result)
+    return result
+
+# Create a Meeting. The password is hashed before the write, so the key
+# derivation does not hold up a group commit batch.
+@api.route('/meeting/create', methods=['POST'])
+def create_meeting():
+    host_email = request.json['host_email']
+    password = request.json['password']
+    # Unknown hosts are turned away before hashing the password
+    if not viewer_filter.might_exist(host_email):
+        return jsonify({"message": "Invalid host email."})
+    # Numbers were stored as their text before passwords were hashed
+    if isinstance(password, (int, float)) and not isinstance(password, bool):
+        password = str(password)
+    if not isinstance(password, str):
+        return jsonify({"message": "Invalid password."})
+    return jsonify(write(insert_meeting, host_email,
+                         credential_cache.hash(password)))
 
 # Get All Meetings
-@app.route('/meeting/get', methods=['GET'])
+@api.route('/meeting/get', methods=['GET'])
+@read_routing.read_only
 def get_meetings():
-    all_meetings = models.Meeting.query.all()
-    result = models.meetings_schema.dump(all_meetings)
-    return jsonify(result.data)
+    return list_response('meeting', models.Meeting.id,
+                         models.meeting_schema)
 
 # Get Single Meeting
-@app.route('/meeting/get/<id>', methods=['GET'])
+@api.route('/meeting/get/<id>', methods=['GET'])
+@read_routing.read_only
 def get_meeting(id):
-    meeting = models.Meeting.query.get(id)
+    meeting = validators = None
+    if id.isdigit():
+        validators = version_of(versions.row('meeting', int(id)))
+        if not_modified(validators):
+            return with_validators(Response(status=304), validators)
+        meeting = storage.repository.meeting(int(id))
+
     # Check if meeting exists
     if not meeting:
         return jsonify({"message": "Meeting with id " + id +
                         " does not exist."})
-    return models.meeting_schema.jsonify(meeting)
+    return with_validators(models.meeting_schema.jsonify(meeting),
+                           validators)
 
 
 """
 This is the Recording API
 """
 
-# Create a Recording
-@app.route('/recording/create', methods=['POST'])
-def create_recording():
-    url = request.json['url']
-    is_private = request.json['is_private']
-    meeting_id = request.json['meeting_id']
 
+# Insert a Recording, the write unit of create_recording
+def insert_recording(repository, url, is_private, meeting_id):
     # Check if URL already exists
-    recording = models.Recording.query.filter_by(url=url).first()
-    if recording:
-        return jsonify({"message": "URL already exists."})
+    status = repository.recording_status(url)
+    if status == purge.PURGING:
+        return {"message": "URL is being deleted."}
+    if status == purge.ACTIVE:
+        return {"message": "URL already exists."}
 
     # Check if meeting id is valid
-    meeting = models.Meeting.query.filter_by(id=meeting_id).first()
+    meeting = repository.meeting(meeting_id)
     if not meeting:
-        return jsonify({"message": "Invalid meeting id."})
+        return {"message": "Invalid meeting id."}
 
-    new_recording = models.Recording(url, is_private, meeting_id)
-    db.session.add(new_recording)
-    db.session.commit()
-    return models.recording_schema.jsonify(new_recording)
+    # The id of the meeting found, which may have been sent as a string
+    new_recording = repository.add_recording(url, is_private, meeting.id)
+    result = models.recording_schema.dump(new_recording).data
+    repository.record(changes.RECORDING_CREATE, result)
+    return result
 
-# Delete Recording
-@app.route('/recording/delete', methods=['DELETE'])
-def delete_recording():
-    url = request.json['url']
+# Create a Recording
+@api.route('/recording/create', methods=['POST'])
+def create_recording():
+    return jsonify(write(insert_recording, request.json['url'],
+                         request.json['is_private'],
+                         request.json['meeting_id']))
+
+
+# Delete a Recording, the write unit of delete_recording
+def remove_recording(repository, url):
     # Check if URL is valid
-    recording = db.session.query(models.Recording).get(url)
+    recording = repository.recording(url)
     if not recording:
-        return jsonify({"message": "URL does not exist."})
+        return None
 
-    db.session.delete(recording)
-    db.session.commit()
-    return models.recording_schema.jsonify(recording)
+    result = models.recording_schema.dump(recording).data
+    repository.record(changes.RECORDING_DELETE, result)
+    result['status'] = repository.delete_recording(url)
+    return result
 
-# Share Recording
-@app.route('/recording/share', methods=['POST'])
-def share_recording():
-    email = request.json['email']
+
+# Delete Recording. It disappears at once, the SQLAlchemy backend purges
+# its shares in the background (see purge.py).
+@api.route('/recording/delete', methods=['DELETE'])
+def delete_recording():
     url = request.json['url']
-    recording = db.session.query(models.Recording).get(url)
-    viewer = db.session.query(models.Viewer).filter_by(email=email).first()
+    result = write(remove_recording, url)
+    if result is None:
+        return jsonify({"message": "URL does not exist."})
+    access_cache.invalidate_recording(url)
+    if result['status'] == purge.PURGING:
+        recording_purge.schedule()
+    return jsonify(result)
+
+
+# Tell whether the shares of a deleted Recording are purged yet
+@api.route('/recording/delete/status/<path:url>', methods=['GET'])
+@read_routing.read_only
+def get_delete_status(url):
+    return jsonify({"url": url,
+                    "status": storage.repository.recording_status(url)})
+
+
+# Insert a share, the write unit of share_recording
+def insert_share(repository, url, email):
+    recording = repository.recording(url)
+    viewer = repository.viewer(email)
 
     # Invalid Email
     if not viewer:
-        return jsonify({"message": "The Email " + email +
-                        " does not belong to a valid viewer."})
+        return {"message": "The Email " + email +
+                " does not belong to a valid viewer."}
 
     # Invalid URL
     if not recording:
-        return jsonify({"message": "The URL " + url +
-                        " does not belong to a valid Recording."})
+        return {"message": "The URL " + url +
+                " does not belong to a valid Recording."}
 
     # Share meeting with same viewer twice
-    if viewer in recording.viewers:
-        return jsonify({"message": "Cannot share meeting:" + url +
-                        " with the viewer " + email + " twice."})
+    if repository.is_shared(url, email):
+        return {"message": "Cannot share meeting:" + url +
+                " with the viewer " + email + " twice."}
 
     # Add viewer private recording
     if recording.is_private:
-        return jsonify({"message": "Cannot add viewers to "
-                        "a private Recording."})
-
-    recording.viewers.append(viewer)
-    db.session.add(recording)
-    db.session.commit()
+        return {"message": "Cannot add viewers to a private Recording."}
 
-    return jsonify({"message": "Viewer " + email +
-                    " added to recording " + url + "!"})
+    repository.share(url, email)
+    repository.record(changes.RECORDING_SHARE, {"url": url, "email": email})
+    return {"message": "Viewer " + email + " added to recording " + url +
+            "!"}
 
-# Verify if a Viewer has access to a specific Recording
-@app.route('/recording/has-access', methods=['GET'])
-def check_access():
+# Share Recording
+@api.route('/recording/share', methods=['POST'])
+def share_recording():
     email = request.json['email']
     url = request.json['url']
-    recording = models.Recording.query.get(url)
-    viewer = models.Viewer.query.filter_by(email=email).first()
-    # If the recording is private the owner can access it without password
-    try:
-        password = request.json['password']
-    except KeyError:
-        if recording.is_private:
-            pass
-
-    # Invalid Email
-    if not viewer:
+    # Invalid Email, known without a query
+    if not viewer_filter.might_exist(email):
         return jsonify({"message": "The Email " + email +
                         " does not belong to a valid viewer."})
+    result = write(insert_share, url, email)
+    access_cache.invalidate_recording(url, email)
+    return jsonify(result)
+
+
+# Insert many shares, the write unit of share_recordings. Viewers,
+# recordings and existing shares are resolved set-wise, then only the
+# missing rows are inserted. Returns the results and the new shares.
+def insert_shares(repository, pairs, emails):
+    valid_emails = repository.existing_emails(emails)
+    private = {url: recording.is_private for url, recording in
+               repository.recordings({url for url, _ in pairs}).items()}
+    shared = repository.shared(list(private), valid_emails)
+
+    results = []
+    new_shares = []
+    for url, email in pairs:
+        # Same rules, in the same order, as a single share
+        if email not in valid_emails:
+            message = ("The Email " + email +
+                       " does not belong to a valid viewer.")
+        elif url not in private:
+            message = ("The URL " + url +
+                       " does not belong to a valid Recording.")
+        elif (url, email) in shared:
+            message = ("Cannot share meeting:" + url +
+                       " with the viewer " + email + " twice.")
+        elif private[url]:
+            message = "Cannot add viewers to a private Recording."
+        else:
+            message = "Viewer " + email + " added to recording " + url + "!"
+            shared.add((url, email))
+            new_shares.append((url, email))
+        results.append({"url": url, "email": email, "message": message})
+
+    if new_shares:
+        repository.share_many(new_shares)
+        repository.record_many([
+            (changes.RECORDING_SHARE, {"url": url, "email": email})
+            for url, email in new_shares])
+    return results, new_shares
+
+# Share Recordings with many Viewers at once
+@api.route('/recording/share/bulk', methods=['POST'])
+def share_recordings():
+    if 'shares' in request.json:
+        pairs = [(share['url'], share['email'])
+                 for share in request.json['shares']]
+    else:
+        url = request.json['url']
+        pairs = [(url, email) for email in request.json['emails']]
+    emails = [email for email in {email for _, email in pairs}
+              if viewer_filter.might_exist(email)]
+
+    # In a single transaction, or one per shard with the sharded backend
+    results, new_shares = write(insert_shares, pairs, emails)
+    for url, email in new_shares:
+        access_cache.invalidate_recording(url, email)
+    return jsonify(results)
+
+
+# Stamps of the access decisions about the (url, meeting id) `pairs`: the
+# versions of the recording and meeting rows, which every process bumps in
+# the transaction of its writes (shares included). A cached decision is only
+# used while they are unchanged, so the shares and deletions of other
+# workers are seen at the cost of one lookup. They are read before the rows
+# a decision is computed from, so a concurrent write can only make a stamp
+# older than its decision.
+def access_stamps(repository, pairs):
+    pairs = list(pairs)
+    found = repository.versions(
+        [versions.row('recording', url) for url, _ in pairs] +
+        [versions.row('meeting', meeting_id) for _, meeting_id in pairs])
+    return {(url, meeting_id): (
+        found.get(versions.row('recording', url)),
+        found.get(versions.row('meeting', meeting_id)))
+        for url, meeting_id in pairs}
+
+
+def access_stamp(repository, url, meeting_id):
+    return access_stamps(repository, [(url, meeting_id)])[url, meeting_id]
+
+
+# Version of one row, as found in a stamp
+def row_version(repository, table, key):
+    current = repository.version(versions.row(table, key))
+    return None if current is None else tuple(current)
+
+
+# Only the host can access a private recording. The viewer needs to know
+# the password to access a public recording and needs to be in the list of
+# viewers as well. The share is checked first, it costs no hashing.
+def access_granted(email, password, is_private, host_email, meeting_id,
+                   meeting_password, shared):
+    if is_private:
+        return email == host_email
+    return shared and credential_cache.verify(meeting_id, password,
+                                              meeting_password)
+
+
+def access_message(email, granted):
+    if granted:
+        return "SUCCESS: Viewer " + email + " has access to the Recording."
+    return "FAIL: Viewer " + email + " does not have access to the Recording."
 
-    # Invalid URL
-    if not recording:
-        return jsonify({"message": "The URL " + url +
-                        " does not belong to a valid Recording."})
-
-    meeting = models.Meeting.query.get(recording.meeting_id)
-    meeting_host_email = meeting.host_email
-    meeting_password = meeting.password
 
-    # Only the host can access a private recording
-    if recording.is_private:
-        if email == meeting_host_email:
-            return jsonify({"message": "SUCCESS: Viewer " + email +
-                            " has access to the Recording."})
-        return jsonify({"message": "FAIL: Viewer " + email +
-                        " does not have access to the Recording."})
-
-    # The viewer needs to know the password to access a public recording
-    # and needs to be in the list of viewers as well
-    else:
-        if password == meeting_password and viewer in recording.viewers:
-            return jsonify({"message": "SUCCESS: Viewer " + email +
-                            " has access to the Recording."})
-        return jsonify({"message": "FAIL: Viewer " + email +
-                        " does not have access to the Recording."})
+# Verify if a Viewer has access to a specific Recording
+@api.route('/recording/has-access', methods=['GET'])
+@read_routing.read_only
+def check_access():
+    email = request.json['email']
+    url = request.json['url']
+    # If the recording is private the owner can access it without password
+    password = request.json.get('password')
+
+    # Repeated checks are answered from the cache
+    repository = storage.repository
+    key = access_cache.key(url, email, password)
+    granted = access_cache.get(key, functools.partial(access_stamp,
+                                                      repository))
+    if granted is None:
+        # Invalid Email, known without a query
+        if not viewer_filter.might_exist(email):
+            return jsonify({"message": "The Email " + email +
+                            " does not belong to a valid viewer."})
+
+        generation = access_cache.generation()
+        recording_version = row_version(repository, 'recording', url)
+        recording = repository.recording(url)
+        viewer = repository.viewer(email)
+
+        # Invalid Email
+        if not viewer:
+            return jsonify({"message": "The Email " + email +
+                            " does not belong to a valid viewer."})
+
+        # Invalid URL
+        if not recording:
+            return jsonify({"message": "The URL " + url +
+                            " does not belong to a valid Recording."})
+
+        meeting_version = row_version(repository, 'meeting',
+                                      recording.meeting_id)
+        meeting = repository.meeting(recording.meeting_id)
+        shared = not recording.is_private and \
+            repository.is_shared(url, email)
+        granted = access_granted(email, password, recording.is_private,
+                                 meeting.host_email, meeting.id,
+                                 meeting.password, shared)
+        # A decision read from a lagging replica would outlive the
+        # invalidation of the write it has not seen yet
+        if not read_routing.routed():
+            access_cache.set(key, granted, recording.meeting_id, generation,
+                             (recording_version, meeting_version))
+
+    return jsonify({"message": access_message(email, granted)})
+
+# Verify many (email, url, password) tuples at once
+@api.route('/recording/has-access/batch', methods=['GET', 'POST'])
+def check_access_batch():
+    checks = [(check['email'], check['url'], check.get('password'))
+              for check in request.json['checks']]
+    keys = [access_cache.key(url, email, password)
+            for email, url, password in checks]
+    repository = storage.repository
+
+    # The stamps of the cached decisions are looked up at once
+    current = {}
+    if access_cache.validate:
+        cached = {(url, access_cache.meeting(key))
+                  for (_, url, _), key in zip(checks, keys)}
+        current = access_stamps(repository, [
+            (url, meeting_id) for url, meeting_id in cached
+            if meeting_id is not None])
+    decisions = [access_cache.get(key, lambda url, meeting_id: current.get(
+        (url, meeting_id))) for key in keys]
+
+    # Load whatever the cache could not answer with set-based lookups
+    valid_emails = set()
+    recordings = {}
+    shared = set()
+    pending = [check for check, granted in zip(checks, decisions)
+               if granted is None]
+    if pending:
+        generation = access_cache.generation()
+        urls = {url for _, url, _ in pending}
+        # The versions of the recordings are read before their rows, see
+        # access_stamps. Those of the meetings are read once the rows tell
+        # which meetings they are: the host and password of a meeting are
+        # never updated, so its version cannot be newer than what the
+        # decision read. The recordings are then loaded once.
+        found = repository.versions(
+            [versions.row('recording', url) for url in urls])
+        valid_emails = repository.existing_emails(
+            email for email in {email for email, _, _ in pending}
+            if viewer_filter.might_exist(email))
+        recordings = repository.access_rows(urls)
+        shared = repository.shared([url for url, row in recordings.items()
+                                    if not row.is_private], valid_emails)
+        found.update(repository.versions(
+            {versions.row('meeting', row.meeting_id)
+             for row in recordings.values()}))
+        stamps = {(url, row.meeting_id): (
+            found.get(versions.row('recording', url)),
+            found.get(versions.row('meeting', row.meeting_id)))
+            for url, row in recordings.items()}
+
+    results = []
+    for (email, url, password), key, granted in zip(checks, keys, decisions):
+        if granted is None:
+            # Invalid Email
+            if email not in valid_emails:
+                message = ("The Email " + email +
+                           " does not belong to a valid viewer.")
+                results.append({"email": email, "url": url,
+                                "message": message})
+                continue
+
+            # Invalid URL
+            if url not in recordings:
+                message = ("The URL " + url +
+                           " does not belong to a valid Recording.")
+                results.append({"email": email, "url": url,
+                                "message": message})
+                continue
+
+            row = recordings[url]
+            granted = access_granted(email, password, row.is_private,
+                                     row.host_email, row.meeting_id,
+                                     row.password, (url, email) in shared)
+            access_cache.set(key, granted, row.meeting_id, generation,
+                             stamps.get((url, row.meeting_id)))
+        results.append({"email": email, "url": url,
+                        "message": access_message(email, granted)})
+    return jsonify(results)
 
 
 # Get All Recordings
-@app.route('/recording/get', methods=['GET'])
+@api.route('/recording/get', methods=['GET'])
+@read_routing.read_only
 def get_recordings():
-    all_recordings = models.Recording.query.all()
-    result = models.recordings_schema.dump(all_recordings)
-    return jsonify(result.data)
+    return list_response('recording', models.Recording.url,
+                         models.recording_schema)
 
 # Get Single Recordings
-@app.route('/recording/get/<path:url>', methods=['GET'])
+@api.route('/recording/get/<path:url>', methods=['GET'])
+@read_routing.read_only
 def get_recording(url):
-    recording = models.Recording.query.get(url)
-    return models.recording_schema.jsonify(recording)
+    validators = version_of(versions.row('recording', url))
+    if not_modified(validators):
+        return with_validators(Response(status=304), validators)
+
+    recording = storage.repository.recording(url)
+    if recording is None:
+        return models.recording_schema.jsonify(recording)
+    return with_validators(models.recording_schema.jsonify(recording),
+                           validators)
 
 
 """
 This is the Viewers API
 """
 
+
+# Insert a Viewer, the write unit of create_viewer
+def insert_viewer(repository, email):
+    # Email exists
+    email_exists = repository.viewer(email)
+    if email_exists:
+        return {"message": "Email already in use."}
+
+    new_viewer = repository.add_viewer(email)
+    result = models.viewer_schema.dump(new_viewer).data
+    repository.record(changes.VIEWER_CREATE, result)
+    return result
+
 # Create a Viewer
-@app.route('/viewer/create', methods=['POST'])
+@api.route('/viewer/create', methods=['POST'])
 def create_viewer():
-    EMAIL_REGEX = re.compile(
-        r"^[A-Za-z0-9\.\+_-]+@[A-Za-z0-9\._-]+\.[a-zA-Z]*$")
     email = request.json['email']
 
     # Invalid Email
-    if not EMAIL_REGEX.match(email):
+    if not models.EMAIL_REGEX.match(email):
         return jsonify({"message": "Invalid email."})
 
-    # Email exists
-    email_exists = models.Viewer.query.filter_by(
-        email=email).first()
-    if email_exists:
-        return jsonify({"message": "Email already in use."})
-
-    new_viewer = models.Viewer(email)
-    db.session.add(new_viewer)
-    db.session.commit()
-
-    return models.viewer_schema.jsonify(new_viewer)
+    # Before the write, so the filter never misses a committed viewer. The
+    # existence check stays in insert_viewer: only the database can say an
+    # email is taken.
+    viewer_filter.add(email)
+    return jsonify(write(insert_viewer, email))
 
 # Get All Viewers
-@app.route('/viewer/get', methods=['GET'])
+@api.route('/viewer/get', methods=['GET'])
+@read_routing.read_only
 def get_viewers():
-    all_viewers = models.Viewer.query.all()
-    result = models.viewers_schema.dump(all_viewers)
-    return jsonify(result.data)
+    return list_response('viewer', models.Viewer.id,
+                         models.viewer_schema)
+
+# Get the Recordings a Viewer can access, a keyset page of them by url:
+# public recordings shared with the viewer and private recordings of the
+# meetings they host
+@api.route('/viewer/recordings', methods=['GET'])
+@read_routing.read_only
+def get_viewer_recordings():
+    email = request.args.get('email', '')
+    fields = models.recording_schema.Meta.fields
+    key = models.Recording.url
+    try:
+        if 'fields' in request.args:
+            fields = listing.parse_fields(request.args['fields'], fields)
+        after, limit, stream = listing.parse_page_args(
+            request.args, key, current_app.config['LIST_MAX_LIMIT'])
+    except listing.InvalidArgument as e:
+        return jsonify({"message": str(e)})
+
+    # Invalid Email
+    repository = storage.repository
+    if not viewer_filter.might_exist(email) or not repository.viewer(email):
+        return jsonify({"message": "The Email " + email +
+                        " does not belong to a valid viewer."})
+
+    columns = list(fields)
+    if key.key not in fields:
+        columns.append(key.key)
+    chunk_size = current_app.config['LIST_STREAM_CHUNK'] if stream else None
+    rows = repository.viewer_recordings(email, columns, after, limit,
+                                        chunk_size)
+
+    if stream:
+        items = (dict(zip(fields, row)) for row in rows)
+        return Response(stream_with_context(listing.stream_json(
+            items, stream == 'ndjson', chunk_size)),
+            mimetype=listing.STREAM_FORMATS[stream])
+
+    response = jsonify([dict(zip(fields, row)) for row in rows])
+    if limit is not None and len(rows) == limit:
+        response.headers['Link'] = listing.next_link(
+            request.base_url, request.args,
+            rows[-1][columns.index(key.key)], limit)
+    return response
+
+
+"""
+This is the Stats API
+"""
+
+
+# Totals of the whole database. Every stat is read from the counters, see
+# counters.py, rather than counted.
+@api.route('/stats', methods=['GET'])
+@read_routing.read_only
+def get_stats():
+    return jsonify(storage.repository.counters(counters.TOTALS))
+
+# Recordings of a Meeting
+@api.route('/stats/meeting/<id>', methods=['GET'])
+@read_routing.read_only
+def get_meeting_stats(id):
+    repository = storage.repository
+    if not id.isdigit() or not repository.meeting(int(id)):
+        return jsonify({"message": "Meeting with id " + id +
+                        " does not exist."})
+    name = counters.meeting(int(id))
+    return jsonify({"meeting_id": int(id),
+                    "recordings": repository.counters([name])[name]})
+
+# Viewers a Recording is shared with
+@api.route('/stats/recording/<path:url>', methods=['GET'])
+@read_routing.read_only
+def get_recording_stats(url):
+    repository = storage.repository
+    if not repository.recording(url):
+        return jsonify({"message": "The URL " + url +
+                        " does not belong to a valid Recording."})
+    name = counters.recording(url)
+    return jsonify({"url": url, "shares": repository.counters([name])[name]})
+
+# Recordings a Viewer can access, as /viewer/recordings lists them: the
+# public ones shared with them and the private ones of their meetings
+@api.route('/stats/viewer/<email>', methods=['GET'])
+@read_routing.read_only
+def get_viewer_stats(email):
+    repository = storage.repository
+    if not viewer_filter.might_exist(email) or not repository.viewer(email):
+        return jsonify({"message": "The Email " + email +
+                        " does not belong to a valid viewer."})
+    found = repository.counters([counters.viewer(email),
+                                 counters.host(email)])
+    return jsonify({"email": email, "recordings": sum(found.values())})
+
+
+"""
+This is the Changes API
+"""
+
+
+# Follow create, delete and share events as server-sent events, from the
+# one after ?since= or Last-Event-ID, or from now on
+@api.route('/changes', methods=['GET'])
+@read_routing.read_only
+def follow_changes():
+    config = current_app.config
+    since = request.headers.get('Last-Event-ID', request.args.get('since'))
+    timeout = request.args.get('timeout', config['CHANGES_TIMEOUT'])
+    try:
+        since = None if since is None else int(since)
+        timeout = min(float(timeout), config['CHANGES_TIMEOUT'])
+    except ValueError:
+        return jsonify({"message": "Invalid since or timeout."})
+    # Events are only recorded in the database
+    if storage.backend != 'sqlalchemy':
+        return jsonify({"message": "No change feed with the " +
+                        storage.backend + " storage backend."})
+
+    body = changes.follow(db.session, since, timeout,
+                          config['CHANGES_POLL_INTERVAL'],
+                          config['CHANGES_HEARTBEAT'],
+                          config['CHANGES_CHUNK'], config['CHANGES_RETRY'])
+    return Response(stream_with_context(body), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+"""
+Management commands
+"""
+
+# Upgrade an existing database in place
+@click.command('upgrade-db')
+@with_appcontext
+def upgrade_db():
+    """Add missing tables and indexes to the database and its shards."""
+    iterations = current_app.config['PASSWORD_HASH_ITERATIONS']
+    applied = migrations.upgrade(db.engine, db.metadata, iterations)
+    hosts = counters.hosts(db.engine) if shards.count else None
+    for index in range(shards.count):
+        applied.extend("shard %d: %s" % (index, change) for change in
+                       migrations.upgrade(shards.engine(index), db.metadata,
+                                          iterations, hosts))
+    if shards.count:
+        claimed = shardstorage.fill_directory(
+            current_app.config['SQL_IN_CHUNK'])
+        if claimed:
+            applied.append("claimed %d recording urls" % claimed)
+    for change in applied:
+        click.echo(change)
+    if not applied:
+        click.echo("Database is up to date.")
+
+
+def summary(verb, counts):
+    return verb + " " + ", ".join(
+        "%d %ss" % (counts[kind], kind) for kind in transfer.KINDS)
+
+# Export every table as NDJSON
+@click.command('export')
+@click.option('-o', '--output', type=click.File('w'), default='-',
+              help="File to write, standard output by default.")
+@click.option('--chunk', default=1000, show_default=True,
+              help="Rows fetched per round trip.")
+@with_appcontext
+def export_data(output, chunk):
+    """Write viewers, meetings, recordings and shares as NDJSON, those of
+    the shards included."""
+    with contextlib.ExitStack() as stack:
+        connection = stack.enter_context(db.engine.connect())
+        counts = transfer.export(connection, output, chunk, [
+            stack.enter_context(shards.engine(index).connect())
+            for index in range(shards.count)])
+    click.echo(summary("Exported", counts), err=True)
+
+# Import an NDJSON export
+@click.command('import')
+@click.argument('input', type=click.File('r'))
+@click.option('--chunk', default=10000, show_default=True,
+              help="Records validated and committed together.")
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help="File keeping the last committed line, an interrupted "
+              "import started again with it resumes after that line.")
+@with_appcontext
+def import_data(input, chunk, checkpoint):
+    """Insert the records of an export, skipping invalid ones."""
+    # Records are only checked against the main database
+    if shards.count:
+        raise click.UsageError(
+            "Cannot import with SHARD_DATABASE_URIS: import into a database "
+            "without shards, then add them and run rebalance-shards.")
+
+    def on_commit(line):
+        if checkpoint is not None:
+            transfer.write_checkpoint(checkpoint, line)
+
+    def on_reject(line, message):
+        click.echo("line %d: %s" % (line, message), err=True)
+
+    counts = transfer.load(
+        db.engine, input, chunk, current_app.config['SQL_IN_CHUNK'],
+        transfer.read_checkpoint(checkpoint), on_commit, on_reject,
+        credential_cache.hash)
+    click.echo(summary("Imported", counts))
+    # The import inserts rows directly, without counting them
+    counters.reconcile(db.session)
+
+# Delete old events of the change feed
+@click.command('prune-changes')
+@click.option('--days', default=7.0, show_default=True,
+              help="Keep the events of this many last days.")
+@with_appcontext
+def prune_changes(days):
+    """Delete change feed events older than --days."""
+    before = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    count = changes.prune(db.session, before)
+    db.session.commit()
+    click.echo("Deleted %d events." % count)
+
+
+# Purge the shares of deleted recordings
+@click.command('purge-recordings')
+@with_appcontext
+def purge_recordings():
+    """Purge deleted recordings now, e.g. when RECORDING_PURGE_WORKER is
+    off."""
+    count = sum(recording_purge.purge_pending(session) for session in
+                recording_purge.sessions(current_app._get_current_object()))
+    click.echo("Purged %d recordings." % count)
+
+
+def database_name(index):
+    return "main database" if index is None else "shard %d" % index
+
+# Spread the recordings over the shards
+@click.command('rebalance-shards')
+@click.option('--slack', default=0.1, show_default=True,
+              help="Load above the mean a shard may keep, as a fraction.")
+@click.option('--dry-run', is_flag=True, help="Only list the moves.")
+@with_appcontext
+def rebalance_shards(slack, dry_run):
+    """Move the recordings of the main database and of the shards to
+    SHARD_DATABASE_URIS, evening out their rows."""
+    if not shards.count:
+        raise click.UsageError("No SHARD_DATABASE_URIS to rebalance.")
+
+    def on_move(move, recordings, shares):
+        meeting_id, source, target = move
+        click.echo("meeting %d: %s -> %s, %d recordings, %d shares" % (
+            meeting_id, database_name(source), database_name(target),
+            recordings, shares))
+
+    moves = shardstorage.rebalance(slack, dry_run, on_move)
+    if dry_run:
+        for meeting_id, source, target in moves:
+            click.echo("meeting %d: %s -> %s" % (
+                meeting_id, database_name(source), database_name(target)))
+    click.echo("%s %d meetings." % ("Would move" if dry_run else "Moved",
+                                    len(moves)))
+
+# Recompute the counters of the stats
+@click.command('reconcile-counters')
+@with_appcontext
+def reconcile_counters():
+    """Recount the records behind the stats counters of the database and
+    its shards, fixing the counters that drifted."""
+    sessions = [(None, db.session)] + list(enumerate(shards.sessions()))
+    # The meetings of the recordings of the shards are in the main database
+    hosts = counters.hosts(db.session) if shards.count else None
+    for index, session in sessions:
+        wrong = counters.reconcile(session, None if index is None else hosts)
+        click.echo("%s: fixed %d counters." % (database_name(index),
+                                               len(wrong)))
+        for name in wrong:
+            click.echo("  " + name)
 
 
 # Run Server
 if __name__ == '__main__':
-    db.create_all()
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        shards.create_all()
     app.run(debug=True)
@@ -1,25 +1,80 @@
 import unittest
+import json
 import os
-from app import app, db
+from app import create_app
+from extensions import (access_cache, db, metrics, recording_purge, shards,
+                        storage)
+from unittest import mock
+from flask import g
+from metrics import RequestStats
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from werkzeug.security import check_password_hash
+import datetime
+import functools
 import models
+import multiprocessing
+import purge
+import shutil
+import tempfile
 
 TEST_DB = 'test.db'
+# The databases are created in a directory removed once the tests are done
+basedir = tempfile.mkdtemp()
+app = create_app({
+    'TESTING': True,
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(basedir, TEST_DB),
+    'PASSWORD_HASH_ITERATIONS': 1000,
+    # Purges are run by the tests
+    'RECORDING_PURGE_WORKER': False,
+})
+memory_app = create_app({
+    'TESTING': True,
+    'STORAGE_BACKEND': 'memory',
+    # Not used by the routes, only by the tests running SQL themselves
+    'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+    'PASSWORD_HASH_ITERATIONS': 1000,
+})
+sharded_app = create_app({
+    'TESTING': True,
+    'STORAGE_BACKEND': 'sharded',
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(basedir, TEST_DB),
+    'SHARD_DATABASE_URIS': ['sqlite:///' + os.path.join(
+        basedir, 'test_shard%d.db' % index) for index in range(2)],
+    'PASSWORD_HASH_ITERATIONS': 1000,
+    'RECORDING_PURGE_WORKER': False,
+})
+
+
+def tearDownModule():
+    shutil.rmtree(basedir)
+
+
+def needs_database(test):
+    """Skip `test` when the API runs on the in-memory backend"""
+    @functools.wraps(test)
+    def wrapper(self):
+        if storage.backend != 'sqlalchemy':
+            self.skipTest("needs the database")
+        return test(self)
+    return wrapper
 
 
 class MeetingsApiTestCase(unittest.TestCase):
 
     def setUp(self):
         """Set up a blank temp database befor each test"""
-        basedir = os.path.abspath(os.path.dirname(__file__))
-        app.config['TESTING'] = True
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + \
-            os.path.join(basedir, TEST_DB)
+        self.context = app.app_context()
+        self.context.push()
         self.app = app.test_client()
         db.create_all()
+        metrics.reset()
 
     def tearDown(self):
         """Destroy blank temp database after each test"""
         db.drop_all()
+        access_cache.clear()
+        self.context.pop()
 
     # helper functions
 
@@ -51,6 +106,10 @@ class MeetingsApiTestCase(unittest.TestCase):
         return self.app.post('/recording/share',
                              json={'url': url, "email": email})
 
+    def share_recordings(self, url, emails):
+        return self.app.post('/recording/share/bulk',
+                             json={'url': url, 'emails': emails})
+
     def has_access_recording(self, email, url, password):
         return self.app.get('/recording/has-access',
                             json={'email': email,
@@ -60,8 +119,8 @@ class MeetingsApiTestCase(unittest.TestCase):
     # assert functions
     def test_empty_meeting(self):
         """Ensure meeting list is empty"""
-        all_meetings = models.Meeting.query.all()
-        self.assertEqual([], all_meetings)
+        all_meetings = storage.repository.rows('meeting', ['id'])
+        self.assertEqual([], list(all_meetings))
 
     # "/meeting/create" tests
 
@@ -70,10 +129,27 @@ class MeetingsApiTestCase(unittest.TestCase):
         email = "test@email.com"
         password = "pass"
         self.create_viewer(email)
-        self.create_meeting(email, password)
-        meeting = models.Meeting.query.get(1)
+        rv = self.create_meeting(email, password)
+        self.assertEqual({'id': 1, 'host_email': email}, rv.get_json())
+        meeting = storage.repository.meeting(1)
         self.assertEqual(email, meeting.host_email)
-        self.assertEqual(password, meeting.password)
+        self.assertTrue(meeting.password.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(check_password_hash(meeting.password, password))
+
+    def test_numeric_password(self):
+        """Ensure a number is taken as the password of its text"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        email = "test@email.com"
+        self.create_viewer(email)
+        rv = self.create_meeting(email, 1234)
+        self.assertEqual({'id': 1, 'host_email': email}, rv.get_json())
+        self.create_recording(url, False, 1)
+        self.share_recording(email, url)
+        rv = self.has_access_recording(email, url, "1234")
+        message = "SUCCESS: Viewer " + email + " has access to the Recording."
+        self.assertEqual(message, rv.get_json()['message'])
+        rv = self.create_meeting(email, None)
+        self.assertEqual("Invalid password.", rv.get_json()['message'])
 
     def test_invalid_host_email(self):
         """Ensure the host email is from a valid viewer"""
@@ -89,8 +165,8 @@ class MeetingsApiTestCase(unittest.TestCase):
         """Ensure that the viewer is created"""
         email = "test@email.com"
         self.create_viewer(email)
-        viewer = models.Viewer.query.get(1)
-        self.assertEqual(email, viewer.email)
+        viewer = storage.repository.viewer(email)
+        self.assertEqual(1, viewer.id)
 
     def test_invalid_email_syntax(self):
         """Ensure that the viewer email is valid"""
@@ -119,7 +195,7 @@ class MeetingsApiTestCase(unittest.TestCase):
         self.create_viewer(email)
         self.create_meeting(email, password)
         self.create_recording(url, is_private, meeting_id)
-        recording = models.Recording.query.get(url)
+        recording = storage.repository.recording(url)
         self.assertEqual(url, recording.url)
         self.assertEqual(is_private, recording.is_private)
         self.assertEqual(meeting_id, recording.meeting_id)
@@ -153,8 +229,10 @@ class MeetingsApiTestCase(unittest.TestCase):
 
     # "/recording/delete" tests
 
+    @needs_database
     def test_delete_recording(self):
-        """Ensure that a new recording is created"""
+        """Ensure that a deleted recording disappears at once and its row
+        once purged"""
         url = "https://s3.amazonaws.com/meetings/recording1/"
         is_private = False
         meeting_id = 1
@@ -163,9 +241,206 @@ class MeetingsApiTestCase(unittest.TestCase):
         self.create_viewer(email)
         self.create_meeting(email, password)
         self.create_recording(url, is_private, meeting_id)
-        self.delete_recording(url)
+        rv = self.delete_recording(url)
+        self.assertEqual({'url': url, 'is_private': False, 'meeting_id': 1,
+                          'status': 'purging'}, rv.get_json())
+        self.assertEqual({}, self.app.get('/recording/get/' + url).get_json())
+        self.assertEqual([], self.app.get('/recording/get').get_json())
+        rv = self.has_access_recording(email, url, password)
+        self.assertEqual("The URL " + url + " does not belong to a valid "
+                         "Recording.", rv.get_json()['message'])
+        rv = self.app.get('/recording/delete/status/' + url)
+        self.assertEqual({'url': url, 'status': 'purging'}, rv.get_json())
+
+        self.assertEqual(1, recording_purge.purge_pending(db.session))
         recordings = models.Recording.query.all()
         self.assertEqual([], recordings)
+        rv = self.app.get('/recording/delete/status/' + url)
+        self.assertEqual('purged', rv.get_json()['status'])
+
+    @needs_database
+    def test_delete_shared_recording(self):
+        """Ensure that the shares of a deleted recording are purged in
+        batches"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        email = "test@email.com"
+        self.create_viewer(email)
+        self.create_meeting(email, "pass")
+        self.create_recording(url, False, 1)
+        for i in range(5):
+            self.create_viewer("viewer%d@email.com" % i)
+            self.share_recording("viewer%d@email.com" % i, url)
+        self.delete_recording(url)
+        self.assertEqual(5, len(db.session.query(models.viewers).all()))
+        rv = self.app.get('/viewer/recordings?email=viewer0@email.com')
+        self.assertEqual([], rv.get_json())
+        rv = self.share_recording(email, url)
+        self.assertEqual("The URL " + url + " does not belong to a valid "
+                         "Recording.", rv.get_json()['message'])
+
+        before = recording_purge.stats()
+        app.config['RECORDING_PURGE_BATCH'] = 2
+        try:
+            recording_purge.purge_pending(db.session)
+        finally:
+            app.config['RECORDING_PURGE_BATCH'] = 500
+        after = recording_purge.stats()
+        self.assertEqual(3, after['batches'] - before['batches'])
+        self.assertEqual(5, after['shares'] - before['shares'])
+        self.assertEqual([], db.session.query(models.viewers).all())
+
+    def test_stats_follow_writes(self):
+        """Ensure the stats count creates, shares and deletes"""
+        urls = ["https://s3.amazonaws.com/meetings/recording%d/" % i
+                for i in range(3)]
+        self.create_viewer("host@email.com")
+        self.create_viewer("viewer@email.com")
+        self.create_meeting("host@email.com", "pass")
+        self.create_meeting("host@email.com", "pass")
+        for url in urls:
+            self.create_recording(url, False, 1)
+        self.create_recording("https://s3.amazonaws.com/other/", False, 2)
+        self.share_recordings(urls[0], ["host@email.com",
+                                        "viewer@email.com"])
+        self.share_recording("viewer@email.com", urls[1])
+        self.assertEqual({'viewers': 2, 'meetings': 2, 'recordings': 4,
+                          'shares': 3}, self.app.get('/stats').get_json())
+        self.assertEqual({'meeting_id': 1, 'recordings': 3},
+                         self.app.get('/stats/meeting/1').get_json())
+        self.assertEqual({'url': urls[0], 'shares': 2}, self.app.get(
+            '/stats/recording/' + urls[0]).get_json())
+        self.assertEqual({'url': urls[2], 'shares': 0}, self.app.get(
+            '/stats/recording/' + urls[2]).get_json())
+        self.assertEqual({'email': 'viewer@email.com', 'recordings': 2},
+                         self.app.get(
+                             '/stats/viewer/viewer@email.com').get_json())
+
+        self.delete_recording(urls[0])
+        self.assertEqual({'viewers': 2, 'meetings': 2, 'recordings': 3,
+                          'shares': 1}, self.app.get('/stats').get_json())
+        self.assertEqual(2, self.app.get(
+            '/stats/meeting/1').get_json()['recordings'])
+        # Viewers lose a deleted recording at once, not once it is purged
+        self.assertEqual(1, self.app.get(
+            '/stats/viewer/viewer@email.com').get_json()['recordings'])
+        self.assertEqual(0, self.app.get(
+            '/stats/viewer/host@email.com').get_json()['recordings'])
+
+    def test_viewer_stats_match_viewer_recordings(self):
+        """Ensure a viewer's stat counts what /viewer/recordings lists,
+        private recordings of the meetings they host included"""
+        emails = ["host@email.com", "viewer@email.com"]
+        for email in emails:
+            self.create_viewer(email)
+        self.create_meeting("host@email.com", "pass")
+        self.create_recording("https://rec/public", False, 1)
+        self.create_recording("https://rec/private1", True, 1)
+        self.create_recording("https://rec/private2", True, 1)
+        self.share_recordings("https://rec/public", emails)
+
+        def check(expected):
+            for email, count in zip(emails, expected):
+                listed = self.app.get('/viewer/recordings?email=' + email)
+                self.assertEqual(count, len(listed.get_json()))
+                self.assertEqual(count, self.app.get(
+                    '/stats/viewer/' + email).get_json()['recordings'])
+
+        check([3, 1])
+        self.delete_recording("https://rec/private1")
+        check([2, 1])
+        self.delete_recording("https://rec/public")
+        check([1, 0])
+
+    def test_stats_of_missing_records(self):
+        """Ensure stats are only given for existing records"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        self.assertEqual({'viewers': 0, 'meetings': 0, 'recordings': 0,
+                          'shares': 0}, self.app.get('/stats').get_json())
+        rv = self.app.get('/stats/meeting/1')
+        self.assertEqual("Meeting with id 1 does not exist.",
+                         rv.get_json()['message'])
+        rv = self.app.get('/stats/meeting/one')
+        self.assertEqual("Meeting with id one does not exist.",
+                         rv.get_json()['message'])
+        rv = self.app.get('/stats/recording/' + url)
+        self.assertEqual("The URL " + url + " does not belong to a valid "
+                         "Recording.", rv.get_json()['message'])
+        rv = self.app.get('/stats/viewer/test@email.com')
+        self.assertEqual("The Email test@email.com does not belong to a "
+                         "valid viewer.", rv.get_json()['message'])
+
+    def test_meeting_id_as_string(self):
+        """Ensure a recording created with a string meeting id is counted
+        under its meeting"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        self.create_viewer("test@email.com")
+        self.create_meeting("test@email.com", "pass")
+        rv = self.create_recording(url, False, "1")
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(1, rv.get_json()['meeting_id'])
+        self.assertEqual(1, self.app.get(
+            '/stats/meeting/1').get_json()['recordings'])
+
+    def test_is_private_is_a_boolean(self):
+        """Ensure is_private sent as 0 or 1 is listed as a boolean"""
+        self.create_viewer("test@email.com")
+        self.create_meeting("test@email.com", "pass")
+        self.create_recording("https://rec/a", 0, 1)
+        self.create_recording("https://rec/b", 1, 1)
+        rv = self.app.get('/recording/get?fields=url,is_private')
+        self.assertEqual([("https://rec/a", False), ("https://rec/b", True)],
+                         [(item['url'], item['is_private'])
+                          for item in rv.get_json()])
+        for item in rv.get_json():
+            self.assertIsInstance(item['is_private'], bool)
+
+    @needs_database
+    def test_reconcile_counters(self):
+        """Ensure the reconcile-counters command fixes drifted counters and
+        only those"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        self.create_viewer("test@email.com")
+        self.create_meeting("test@email.com", "pass")
+        self.create_recording(url, False, 1)
+        self.share_recording("test@email.com", url)
+        db.session.execute(models.counters.update().where(
+            models.counters.c.name == 'shares').values(value=7))
+        db.session.execute(models.counters.delete().where(
+            models.counters.c.name == 'meeting:1:recordings'))
+        db.session.commit()
+        result = app.test_cli_runner().invoke(args=['reconcile-counters'])
+        self.assertEqual("main database: fixed 2 counters.\n"
+                         "  meeting:1:recordings\n"
+                         "  shares\n", result.output)
+        self.assertEqual({'viewers': 1, 'meetings': 1, 'recordings': 1,
+                          'shares': 1}, self.app.get('/stats').get_json())
+        self.assertEqual(1, self.app.get(
+            '/stats/meeting/1').get_json()['recordings'])
+        result = app.test_cli_runner().invoke(args=['reconcile-counters'])
+        self.assertEqual("main database: fixed 0 counters.\n",
+                         result.output)
+
+    @needs_database
+    def test_recreate_deleted_recording(self):
+        """Ensure a URL can only be reused once its shares are purged"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        email = "test@email.com"
+        self.create_viewer(email)
+        self.create_meeting(email, "pass")
+        self.create_recording(url, False, 1)
+        self.share_recording(email, url)
+        self.delete_recording(url)
+        rv = self.create_recording(url, False, 1)
+        self.assertEqual("URL is being deleted.", rv.get_json()['message'])
+        rv = self.delete_recording(url)
+        self.assertEqual("URL does not exist.", rv.get_json()['message'])
+
+        recording_purge.purge_pending(db.session)
+        rv = self.create_recording(url, False, 1)
+        self.assertEqual(url, rv.get_json()['url'])
+        rv = self.has_access_recording(email, url, "pass")
+        self.assertEqual("FAIL: Viewer " + email + " does not have access "
+                         "to the Recording.", rv.get_json()['message'])
 
     def test_invalid_url_delete_recording(self):
         """Ensure that the URL given is valid"""
@@ -195,8 +470,9 @@ class MeetingsApiTestCase(unittest.TestCase):
         self.create_recording(url, is_private, meeting_id)
         self.share_recording(email, url)
 
-        viewers = models.Recording.query.get(url).viewers
-        self.assertEqual(email, viewers[0].email)
+        self.assertTrue(storage.repository.is_shared(url, email))
+        self.assertEqual({(url, email)}, storage.repository.shared(
+            [url], [email, "other@email.com"]))
 
     def test_email_without_match_share_recording(self):
         """Ensure that the email given is valid when sharing a recording"""
@@ -349,6 +625,828 @@ class MeetingsApiTestCase(unittest.TestCase):
         message = "FAIL: Viewer " + email + " does not have access to the Recording."
         self.assertEqual(message, json_data['message'])
 
+    # access decision cache tests
+
+    def test_access_decision_is_cached(self):
+        """Ensure repeated access checks are answered from the cache"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        email = "test@email.com"
+        password = "pass"
+        self.create_viewer(email)
+        self.create_meeting(email, password)
+        self.create_recording(url, False, 1)
+        hits = access_cache.stats()['hits']
+        self.has_access_recording(email, url, password)
+        rv = self.has_access_recording(email, url, password)
+        message = "FAIL: Viewer " + email + \
+            " does not have access to the Recording."
+        self.assertEqual(message, rv.get_json()['message'])
+        self.assertEqual(hits + 1, access_cache.stats()['hits'])
+
+    def in_other_process(self, function, *args):
+        """Run `function` in a forked process, like another gunicorn
+        worker: it shares the database but not the access cache"""
+        process = multiprocessing.get_context('fork').Process(
+            target=function, args=args)
+        process.start()
+        process.join()
+        self.assertEqual(0, process.exitcode)
+
+    @needs_database
+    def test_other_process_invalidates_access_decision(self):
+        """Ensure a decision cached in one process is not used once another
+        process shared or deleted the recording"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        host = "host@email.com"
+        email = "test@email.com"
+        self.create_viewer(host)
+        self.create_viewer(email)
+        self.create_meeting(host, "pass")
+        self.create_recording(url, False, 1)
+        self.share_recording(host, url)
+        for viewer in (host, email, host, email):
+            self.has_access_recording(viewer, url, "pass")
+        hits = access_cache.stats()['hits']
+
+        self.in_other_process(self.share_recording, email, url)
+        rv = self.has_access_recording(email, url, "pass")
+        message = "SUCCESS: Viewer " + email + " has access to the Recording."
+        self.assertEqual(message, rv.get_json()['message'])
+
+        self.in_other_process(self.delete_recording, url)
+        rv = self.has_access_recording(host, url, "pass")
+        message = "The URL " + url + " does not belong to a valid Recording."
+        self.assertEqual(message, rv.get_json()['message'])
+        self.assertEqual(hits, access_cache.stats()['hits'])
+
+    def test_share_invalidates_access_decision(self):
+        """Ensure sharing a recording drops the cached decision"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        email = "test@email.com"
+        password = "pass"
+        self.create_viewer(email)
+        self.create_meeting(email, password)
+        self.create_recording(url, False, 1)
+        self.has_access_recording(email, url, password)
+        self.share_recording(email, url)
+        rv = self.has_access_recording(email, url, password)
+        message = "SUCCESS: Viewer " + email + " has access to the Recording."
+        self.assertEqual(message, rv.get_json()['message'])
+
+    def test_delete_invalidates_access_decision(self):
+        """Ensure deleting a recording drops the cached decision"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        email = "test@email.com"
+        password = "pass"
+        self.create_viewer(email)
+        self.create_meeting(email, password)
+        self.create_recording(url, True, 1)
+        self.has_access_recording(email, url, password)
+        self.delete_recording(url)
+        rv = self.has_access_recording(email, url, password)
+        message = "The URL " + url + " does not belong to a valid Recording."
+        self.assertEqual(message, rv.get_json()['message'])
+
+    @needs_database
+    def test_password_change_invalidates_access_decision(self):
+        """Ensure changing a meeting password drops the cached decisions"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        email = "test@email.com"
+        password = "pass"
+        self.create_viewer(email)
+        self.create_meeting(email, password)
+        self.create_recording(url, False, 1)
+        self.share_recording(email, url)
+        self.has_access_recording(email, url, password)
+        meeting = models.Meeting.query.get(1)
+        meeting.password = "newPass"
+        db.session.commit()
+        rv = self.has_access_recording(email, url, password)
+        message = "FAIL: Viewer " + email + \
+            " does not have access to the Recording."
+        self.assertEqual(message, rv.get_json()['message'])
+
+    # "/viewer/recordings" tests
+
+    def create_accessible_recordings(self):
+        """host@email.com hosts meeting 1, with private c and public a and
+        b; viewer@email.com hosts meeting 2, with private d, and has a and
+        b shared with them, b being shared with host@email.com too"""
+        self.create_viewer("host@email.com")
+        self.create_viewer("viewer@email.com")
+        self.create_meeting("host@email.com", "pass")
+        self.create_meeting("viewer@email.com", "pass")
+        self.create_recording("https://rec/c", True, 1)
+        self.create_recording("https://rec/a", False, 1)
+        self.create_recording("https://rec/b", False, 1)
+        self.create_recording("https://rec/d", True, 2)
+        self.share_recordings("https://rec/a", ["viewer@email.com"])
+        self.share_recordings("https://rec/b", ["viewer@email.com",
+                                                "host@email.com"])
+
+    def test_viewer_recordings(self):
+        """Ensure shared public and hosted private recordings are listed"""
+        self.create_accessible_recordings()
+        rv = self.app.get('/viewer/recordings?email=viewer@email.com')
+        self.assertEqual(["https://rec/a", "https://rec/b", "https://rec/d"],
+                         [r['url'] for r in rv.get_json()])
+        rv = self.app.get('/viewer/recordings?email=host@email.com')
+        self.assertEqual([{'url': "https://rec/b", 'is_private': False,
+                           'meeting_id': 1},
+                          {'url': "https://rec/c", 'is_private': True,
+                           'meeting_id': 1}], rv.get_json())
+
+    def test_viewer_recordings_match_has_access(self):
+        """Ensure the list holds exactly the recordings has-access grants
+        with the meeting password"""
+        self.create_accessible_recordings()
+        for email in ("host@email.com", "viewer@email.com"):
+            rv = self.app.get('/viewer/recordings?email=' + email)
+            listed = [r['url'] for r in rv.get_json()]
+            granted = [url for url in ("https://rec/a", "https://rec/b",
+                                       "https://rec/c", "https://rec/d")
+                       if "SUCCESS" in self.has_access_recording(
+                           email, url, "pass").get_json()['message']]
+            self.assertEqual(granted, listed)
+
+    def test_viewer_recordings_pages(self):
+        """Ensure pages follow each other across both rules"""
+        self.create_accessible_recordings()
+        rv = self.app.get('/viewer/recordings?email=viewer@email.com&limit=2'
+                          '&fields=url')
+        self.assertEqual([{'url': "https://rec/a"}, {'url': "https://rec/b"}],
+                         rv.get_json())
+        self.assertIn('after=https%3A%2F%2Frec%2Fb', rv.headers['Link'])
+        rv = self.app.get('/viewer/recordings?email=viewer@email.com&limit=2'
+                          '&fields=url&after=https://rec/b')
+        self.assertEqual([{'url': "https://rec/d"}], rv.get_json())
+        self.assertNotIn('Link', rv.headers)
+
+    def test_viewer_recordings_invalid_email(self):
+        rv = self.app.get('/viewer/recordings?email=nobody@email.com')
+        self.assertEqual({"message": "The Email nobody@email.com does not "
+                                     "belong to a valid viewer."},
+                         rv.get_json())
+
+    # list pagination tests
+
+    def test_list_page_with_next_link(self):
+        """Ensure a full page links to the following one"""
+        for i in range(3):
+            self.create_viewer("test%d@email.com" % i)
+        rv = self.app.get('/viewer/get?limit=2')
+        self.assertEqual(["test0@email.com", "test1@email.com"],
+                         [v['email'] for v in rv.get_json()])
+        self.assertIn('after=2', rv.headers['Link'])
+        rv = self.app.get('/viewer/get?limit=2&after=2')
+        self.assertEqual(["test2@email.com"],
+                         [v['email'] for v in rv.get_json()])
+        self.assertNotIn('Link', rv.headers)
+
+    def test_list_page_by_url(self):
+        """Ensure recordings are paged in URL order"""
+        self.create_viewer("test@email.com")
+        self.create_meeting("test@email.com", "pass")
+        for name in ("c", "a", "b"):
+            self.create_recording("https://rec/" + name, False, 1)
+        rv = self.app.get('/recording/get?limit=2&after=https://rec/a')
+        self.assertEqual(["https://rec/b", "https://rec/c"],
+                         [r['url'] for r in rv.get_json()])
+
+    def test_list_invalid_page_arguments(self):
+        """Ensure bad paging arguments are reported"""
+        rv = self.app.get('/meeting/get?limit=0')
+        self.assertEqual("Invalid limit.", rv.get_json()['message'])
+        rv = self.app.get('/meeting/get?after=abc')
+        self.assertEqual("Invalid cursor.", rv.get_json()['message'])
+        rv = self.app.get('/meeting/get?stream=xml')
+        self.assertEqual("Invalid stream format.", rv.get_json()['message'])
+
+    def test_list_stream_json(self):
+        """Ensure a streamed list matches the regular response"""
+        for i in range(3):
+            self.create_viewer("test%d@email.com" % i)
+        app.config['LIST_STREAM_CHUNK'] = 2
+        try:
+            rv = self.app.get('/viewer/get?stream=json')
+        finally:
+            app.config['LIST_STREAM_CHUNK'] = 500
+        self.assertEqual(self.app.get('/viewer/get').get_json(),
+                         json.loads(rv.get_data(as_text=True)))
+
+    def test_list_stream_ndjson(self):
+        """Ensure a list can be streamed as one object per line"""
+        self.create_viewer("test@email.com")
+        self.create_meeting("test@email.com", "pass")
+        self.create_recording("https://rec/a", False, 1)
+        self.create_recording("https://rec/b", True, 1)
+        rv = self.app.get('/recording/get?stream=ndjson&after=https://rec/a')
+        self.assertEqual('application/x-ndjson', rv.mimetype)
+        lines = rv.get_data(as_text=True).splitlines()
+        self.assertEqual([{"url": "https://rec/b", "is_private": True,
+                           "meeting_id": 1}],
+                         [json.loads(line) for line in lines])
+
+    # "/recording/share/bulk" tests
+
+    def test_bulk_share_recording(self):
+        """Ensure many viewers are added with a report for each of them"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        email = "test@email.com"
+        self.create_viewer(email)
+        self.create_viewer("other@email.com")
+        self.create_meeting(email, "pass")
+        self.create_recording(url, False, 1)
+        self.share_recording(email, url)
+        rv = self.share_recordings(url, [email, "other@email.com",
+                                         "invalid@email.com",
+                                         "other@email.com"])
+        self.assertEqual([
+            "Cannot share meeting:" + url + " with the viewer " +
+            email + " twice.",
+            "Viewer other@email.com added to recording " + url + "!",
+            "The Email invalid@email.com does not belong to a valid viewer.",
+            "Cannot share meeting:" + url +
+            " with the viewer other@email.com twice.",
+        ], [result['message'] for result in rv.get_json()])
+        emails = {e for _, e in storage.repository.shared(
+            [url], [email, "other@email.com"])}
+        self.assertEqual({email, "other@email.com"}, emails)
+
+    def test_bulk_share_pairs(self):
+        """Ensure url/email pairs are checked against their recording"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        private_url = "https://s3.amazonaws.com/meetings/recording2/"
+        invalid_url = "https://s3.amazonaws.com/meetings/invalid/"
+        email = "test@email.com"
+        self.create_viewer(email)
+        self.create_meeting(email, "pass")
+        self.create_recording(url, False, 1)
+        self.create_recording(private_url, True, 1)
+        rv = self.app.post('/recording/share/bulk', json={'shares': [
+            {'url': url, 'email': email},
+            {'url': private_url, 'email': email},
+            {'url': invalid_url, 'email': email}]})
+        self.assertEqual([
+            "Viewer " + email + " added to recording " + url + "!",
+            "Cannot add viewers to a private Recording.",
+            "The URL " + invalid_url +
+            " does not belong to a valid Recording.",
+        ], [result['message'] for result in rv.get_json()])
+
+    @needs_database
+    def test_bulk_share_concurrent_duplicate(self):
+        """Ensure a share committed by another request while a bulk share
+        runs is reported as a duplicate rather than failing the batch"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        email = "test@email.com"
+        self.create_viewer(email)
+        self.create_viewer("other@email.com")
+        self.create_meeting(email, "pass")
+        self.create_recording(url, False, 1)
+        repository = storage.repository
+        shared = repository.shared
+
+        def share_meanwhile(urls, emails):
+            found = shared(urls, emails)
+            if not found:
+                db.engine.execute(models.viewers.insert(), {
+                    'recording_url': url, 'viewer_email': email})
+            return found
+
+        with mock.patch.object(repository, 'shared', share_meanwhile):
+            rv = self.share_recordings(url, [email, "other@email.com"])
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual([
+            "Cannot share meeting:" + url + " with the viewer " +
+            email + " twice.",
+            "Viewer other@email.com added to recording " + url + "!",
+        ], [result['message'] for result in rv.get_json()])
+
+    # "/recording/has-access/batch" tests
+
+    def test_batch_access_check(self):
+        """Ensure a batch of checks follows the single check rules"""
+        public_url = "https://s3.amazonaws.com/meetings/recording1/"
+        private_url = "https://s3.amazonaws.com/meetings/recording2/"
+        invalid_url = "https://s3.amazonaws.com/meetings/invalid/"
+        email = "test@email.com"
+        email_alt = "alternative@email.com"
+        password = "pass"
+        self.create_viewer(email)
+        self.create_viewer(email_alt)
+        self.create_meeting(email, password)
+        self.create_recording(public_url, False, 1)
+        self.create_recording(private_url, True, 1)
+        self.share_recording(email_alt, public_url)
+        checks = [
+            (email_alt, public_url, password),
+            (email_alt, public_url, "wrongPass"),
+            (email, public_url, password),
+            (email, private_url, None),
+            (email_alt, private_url, password),
+            ("invalid@email.com", public_url, password),
+            (email, invalid_url, password),
+        ]
+        rv = self.app.post('/recording/has-access/batch', json={
+            'checks': [{'email': e, 'url': u, 'password': p}
+                       for e, u, p in checks]})
+        batch = [result['message'] for result in rv.get_json()]
+        single = [self.has_access_recording(e, u, p).get_json()['message']
+                  for e, u, p in checks]
+        self.assertEqual(single, batch)
+        self.assertEqual([
+            "SUCCESS: Viewer " + email_alt + " has access to the Recording.",
+            "FAIL: Viewer " + email_alt +
+            " does not have access to the Recording.",
+            "FAIL: Viewer " + email +
+            " does not have access to the Recording.",
+            "SUCCESS: Viewer " + email + " has access to the Recording.",
+            "FAIL: Viewer " + email_alt +
+            " does not have access to the Recording.",
+            "The Email invalid@email.com does not belong to a valid viewer.",
+            "The URL " + invalid_url +
+            " does not belong to a valid Recording.",
+        ], batch)
+
+    @needs_database
+    def test_batch_access_check_loads_recordings_once(self):
+        """Ensure the recordings of a batch are loaded by one query, and
+        the decisions are cached against their versions"""
+        self.create_viewer("test@email.com")
+        self.create_meeting("test@email.com", "pass")
+        urls = ["https://rec/%d" % i for i in range(3)]
+        for url in urls:
+            self.create_recording(url, False, 1)
+        checks = {'checks': [{'email': "test@email.com", 'url': url,
+                              'password': "pass"} for url in urls]}
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            first = self.app.post('/recording/has-access/batch',
+                                  json=checks).get_json()
+            loads = [statement for statement in statements
+                     if 'FROM recording' in statement]
+            self.assertEqual(1, len(loads))
+            del statements[:]
+            self.assertEqual(first, self.app.post(
+                '/recording/has-access/batch', json=checks).get_json())
+            # Answered from the cache
+            self.assertFalse([statement for statement in statements
+                              if 'FROM recording' in statement])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+    @needs_database
+    def test_list_matches_schema_dump(self):
+        """Ensure the projected lists are byte-identical to schema dumps"""
+        self.create_viewer("test@email.com")
+        self.create_viewer("other@email.com")
+        self.create_meeting("test@email.com", "pass")
+        self.create_recording("https://rec/b", False, 1)
+        self.create_recording("https://rec/a", True, 1)
+        self.share_recording("other@email.com", "https://rec/b")
+        for path, model, schema in (
+                ('/meeting/get', models.Meeting, models.meetings_schema),
+                ('/recording/get', models.Recording,
+                 models.recordings_schema),
+                ('/viewer/get', models.Viewer, models.viewers_schema)):
+            with app.test_request_context():
+                expected = app.response_class.get_data(
+                    schema.jsonify(model.query.all()))
+            self.assertEqual(expected, self.app.get(path).get_data())
+
+    def test_list_sparse_fieldset(self):
+        """Ensure ?fields= only returns the requested fields"""
+        self.create_viewer("test@email.com")
+        self.create_meeting("test@email.com", "pass")
+        self.create_recording("https://rec/a", False, 1)
+        self.create_recording("https://rec/b", True, 1)
+        rv = self.app.get('/recording/get?fields=url,is_private')
+        self.assertEqual([{"url": "https://rec/a", "is_private": False},
+                          {"url": "https://rec/b", "is_private": True}],
+                         rv.get_json())
+        rv = self.app.get('/recording/get?fields=meeting_id&limit=1')
+        self.assertEqual([{"meeting_id": 1}], rv.get_json())
+        self.assertIn('after=https', rv.headers['Link'])
+        rv = self.app.get('/meeting/get?fields=id,secret')
+        self.assertEqual("Invalid fields.", rv.get_json()['message'])
+
+    # Conditional GET tests
+
+    @needs_database
+    def test_list_not_modified(self):
+        """Ensure an unchanged list is answered 304 with no list query"""
+        self.create_viewer("test@email.com")
+        rv = self.app.get('/viewer/get')
+        etag = rv.headers['ETag']
+        self.assertIsNotNone(rv.headers.get('Last-Modified'))
+
+        route = {'route': '/viewer/get', 'method': 'GET'}
+        statements = self.metric('meetings_sql_statements_total', **route)
+        rv = self.app.get('/viewer/get', headers={'If-None-Match': etag})
+        self.assertEqual(304, rv.status_code)
+        self.assertEqual(b'', rv.get_data())
+        self.assertEqual(etag, rv.headers['ETag'])
+        # Only the version lookup
+        self.assertEqual(statements + 1, self.metric(
+            'meetings_sql_statements_total', **route))
+
+        self.create_viewer("other@email.com")
+        rv = self.app.get('/viewer/get', headers={'If-None-Match': etag})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(2, len(rv.get_json()))
+        self.assertNotEqual(etag, rv.headers['ETag'])
+
+    def set_modified(self, name, modified):
+        db.session.execute(models.versions.update().where(
+            models.versions.c.name == name).values(modified=modified))
+        db.session.commit()
+
+    @needs_database
+    def test_list_if_modified_since(self):
+        """Ensure Last-Modified can be used to revalidate as well, once the
+        second of the change is over"""
+        self.create_viewer("test@email.com")
+        self.set_modified('viewer', datetime.datetime.utcnow().replace(
+            microsecond=0) - datetime.timedelta(seconds=10))
+        rv = self.app.get('/viewer/get')
+        rv = self.app.get('/viewer/get', headers={
+            'If-Modified-Since': rv.headers['Last-Modified']})
+        self.assertEqual(304, rv.status_code)
+
+    @needs_database
+    def test_list_changed_in_the_second_of_the_fetch(self):
+        """Ensure a change in the second of the fetch is not answered 304
+        on If-Modified-Since"""
+        self.create_viewer("test@email.com")
+        # Ahead of the clock, so the second is still going on
+        fetched = (datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=5)).replace(microsecond=200000)
+        self.set_modified('viewer', fetched)
+        rv = self.app.get('/viewer/get')
+        since = rv.headers['Last-Modified']
+        self.create_viewer("other@email.com")
+        self.set_modified('viewer', fetched.replace(microsecond=700000))
+        rv = self.app.get('/viewer/get', headers={
+            'If-Modified-Since': since})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(2, len(rv.get_json()))
+
+    @needs_database
+    def test_etag_depends_on_representation(self):
+        """Ensure pages and field subsets do not share an ETag"""
+        self.create_viewer("test@email.com")
+        etags = {self.app.get(url).headers['ETag'] for url in (
+            '/viewer/get', '/viewer/get?fields=email',
+            '/viewer/get?limit=1')}
+        self.assertEqual(3, len(etags))
+
+    @needs_database
+    def test_row_not_modified(self):
+        """Ensure rows have their own versions"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        email = "test@email.com"
+        self.create_viewer(email)
+        self.create_meeting(email, "pass")
+        self.create_recording(url, False, 1)
+        meeting_etag = self.app.get('/meeting/get/1').headers['ETag']
+        recording_etag = self.app.get('/recording/get/' + url).headers['ETag']
+        list_etag = self.app.get('/meeting/get').headers['ETag']
+
+        self.create_meeting(email, "pass")
+        rv = self.app.get('/meeting/get/1',
+                          headers={'If-None-Match': meeting_etag})
+        self.assertEqual(304, rv.status_code)
+        rv = self.app.get('/meeting/get', headers={'If-None-Match': list_etag})
+        self.assertEqual(200, rv.status_code)
+
+        self.delete_recording(url)
+        rv = self.app.get('/recording/get/' + url,
+                          headers={'If-None-Match': recording_etag})
+        self.assertEqual(200, rv.status_code)
+        self.assertNotIn('ETag', rv.headers)
+
+    # "/metrics" tests
+
+    def metric(self, name, **labels):
+        """Return the value of a sample on /metrics, or None"""
+        prefix = name + ' '
+        if labels:
+            prefix = name + '{' + ','.join(
+                '%s="%s"' % item for item in sorted(labels.items())) + '} '
+        for line in self.app.get('/metrics').get_data(
+                as_text=True).splitlines():
+            if line.startswith(prefix):
+                return float(line[len(prefix):])
+        return None
+
+    @needs_database
+    def test_metrics_per_route(self):
+        """Ensure requests, SQL statements and serialization are counted"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        email = "test@email.com"
+        self.create_viewer(email)
+        self.create_meeting(email, "pass")
+        self.create_recording(url, True, 1)
+        route = {'route': '/recording/has-access', 'method': 'GET'}
+        hits = self.metric('meetings_access_cache_hits_total')
+        self.has_access_recording(email, url, "pass")
+        statements = self.metric('meetings_sql_statements_total', **route)
+        self.assertGreater(statements, 0)
+        # The second check is answered by the cache, after one lookup of
+        # the versions it was computed from
+        self.has_access_recording(email, url, "pass")
+        self.assertEqual(statements + 1, self.metric(
+            'meetings_sql_statements_total', **route))
+        self.assertEqual(2, self.metric('meetings_requests_total',
+                                        status=200, **route))
+        self.assertEqual(2, self.metric(
+            'meetings_request_duration_seconds_count', **route))
+        self.assertEqual(hits + 1,
+                         self.metric('meetings_access_cache_hits_total'))
+        self.app.get('/meeting/get/1')
+        self.assertGreater(self.metric(
+            'meetings_serialization_duration_seconds_total',
+            route='/meeting/get/<id>', method='GET'), 0)
+
+    def test_metrics_after_failed_statements(self):
+        """Ensure a failed statement leaves no start time behind"""
+        stats = g.request_stats = RequestStats()
+        try:
+            with db.engine.connect() as connection:
+                for _ in range(3):
+                    with self.assertRaises(OperationalError):
+                        connection.execute('SELECT * FROM missing')
+                connection.execute('SELECT 1')
+                self.assertFalse(connection.info.get('metrics_start'))
+        finally:
+            g.pop('request_stats')
+        self.assertEqual(1, stats.sql_statements)
+
+    @needs_database
+    def test_cache_hits_without_validation(self):
+        """Ensure a hit costs no query when stamps are not checked"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        email = "test@email.com"
+        self.create_viewer(email)
+        self.create_meeting(email, "pass")
+        self.create_recording(url, True, 1)
+        route = {'route': '/recording/has-access', 'method': 'GET'}
+        access_cache.validate = False
+        try:
+            self.has_access_recording(email, url, "pass")
+            statements = self.metric('meetings_sql_statements_total',
+                                     **route)
+            rv = self.has_access_recording(email, url, "pass")
+            self.assertIn("SUCCESS", rv.get_json()['message'])
+            self.assertEqual(statements, self.metric(
+                'meetings_sql_statements_total', **route))
+            # Writes of this process still drop the decision
+            self.delete_recording(url)
+            rv = self.has_access_recording(email, url, "pass")
+            self.assertIn("does not belong", rv.get_json()['message'])
+        finally:
+            access_cache.validate = True
+
+    @needs_database
+    def test_metrics_for_streamed_responses(self):
+        """Ensure SQL issued while streaming a body is counted"""
+        self.create_viewer("test@email.com")
+        rv = self.app.get('/viewer/get?stream=ndjson')
+        rv.get_data()
+        rv.close()
+        # The version lookup, then the list itself
+        self.assertEqual(2, self.metric('meetings_sql_statements_total',
+                                        route='/viewer/get', method='GET'))
+
+    @needs_database
+    def test_share_checks_do_not_depend_on_share_count(self):
+        """Ensure sharing and access checks issue the same statements
+        whatever the number of viewers of the recording"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        self.create_viewer("host@email.com")
+        self.create_meeting("host@email.com", "pass")
+        self.create_recording(url, False, 1)
+        emails = ["viewer%d@email.com" % i for i in range(52)]
+        for email in emails:
+            self.create_viewer(email)
+
+        def statements(request, route, method):
+            before = self.metric('meetings_sql_statements_total',
+                                 route=route, method=method) or 0
+            request()
+            return self.metric('meetings_sql_statements_total',
+                               route=route, method=method) - before
+
+        def share_and_check(email):
+            return (statements(lambda: self.share_recording(email, url),
+                               '/recording/share', 'POST'),
+                    statements(lambda: self.has_access_recording(
+                        email, url, "pass"), '/recording/has-access', 'GET'))
+
+        few = share_and_check(emails[0])
+        self.share_recordings(url, emails[1:-1])
+        self.assertEqual(few, share_and_check(emails[-1]))
+        rv = self.has_access_recording(emails[-1], url, "pass")
+        self.assertTrue(rv.get_json()['message'].startswith("SUCCESS"))
+
+
+class MemoryApiTestCase(MeetingsApiTestCase):
+    """The same API tests on the in-memory backend, without a database"""
+
+    def setUp(self):
+        self.context = memory_app.app_context()
+        self.context.push()
+        self.app = memory_app.test_client()
+        metrics.reset()
+
+    def tearDown(self):
+        storage.clear()
+        access_cache.clear()
+        self.context.pop()
+
+    def test_delete_recording_at_once(self):
+        """Ensure a deleted recording and its shares are gone without a
+        purge"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        email = "test@email.com"
+        self.create_viewer(email)
+        self.create_meeting(email, "pass")
+        self.create_recording(url, False, 1)
+        self.share_recording(email, url)
+        rv = self.delete_recording(url)
+        self.assertEqual('purged', rv.get_json()['status'])
+        self.assertEqual([], self.app.get(
+            '/viewer/recordings?email=' + email).get_json())
+        rv = self.create_recording(url, True, 1)
+        self.assertEqual(url, rv.get_json()['url'])
+        self.assertFalse(storage.repository.is_shared(url, email))
+
+    def test_no_change_feed(self):
+        rv = self.app.get('/changes')
+        self.assertEqual("No change feed with the memory storage backend.",
+                         rv.get_json()['message'])
+
+
+class ShardedApiTestCase(MeetingsApiTestCase):
+    """The same API tests with the recordings in two shards"""
+
+    def setUp(self):
+        self.context = sharded_app.app_context()
+        self.context.push()
+        self.app = sharded_app.test_client()
+        db.create_all()
+        shards.create_all()
+        metrics.reset()
+
+    def tearDown(self):
+        db.drop_all()
+        shards.drop_all()
+        access_cache.clear()
+        self.context.pop()
+
+    def test_recordings_follow_their_meeting(self):
+        """Ensure recordings go to the shard of their meeting and lists
+        merge the shards"""
+        self.create_viewer("test@email.com")
+        self.create_meeting("test@email.com", "pass")
+        self.create_meeting("test@email.com", "pass")
+        urls = ["https://s3.amazonaws.com/meetings/recording%d/" % i
+                for i in range(4)]
+        for i, url in enumerate(urls):
+            self.create_recording(url, False, 1 + i % 2)
+            self.share_recording("test@email.com", url)
+        for index, session in enumerate(shards.sessions()):
+            self.assertEqual(
+                sorted(urls[1 - index::2]),
+                sorted(url for url, in session.query(models.Recording.url)))
+            self.assertEqual(2, session.query(models.viewers).count())
+        self.assertEqual(0, models.Recording.query.count())
+
+        rv = self.app.get('/recording/get?limit=3')
+        self.assertEqual(urls[:3], [item['url'] for item in rv.get_json()])
+        rv = self.app.get('/viewer/recordings?email=test@email.com&after=' +
+                          urls[0])
+        self.assertEqual(urls[1:], [item['url'] for item in rv.get_json()])
+
+    def test_delete_purges_the_shard(self):
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        self.create_viewer("test@email.com")
+        self.create_meeting("test@email.com", "pass")
+        self.create_recording(url, False, 1)
+        self.share_recording("test@email.com", url)
+        self.assertEqual('purging',
+                         self.delete_recording(url).get_json()['status'])
+        for session in recording_purge.sessions(sharded_app):
+            recording_purge.purge_pending(session)
+        rv = self.app.get('/recording/delete/status/' + url)
+        self.assertEqual('purged', rv.get_json()['status'])
+        self.assertEqual(0, shards.sessions()[1].query(
+            models.viewers).count())
+
+    def test_url_is_claimed_once_across_shards(self):
+        """Ensure a create of a URL another shard got meanwhile fails, and
+        leaves the claim of the first one"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        self.create_viewer("test@email.com")
+        self.create_meeting("test@email.com", "pass")
+        self.create_meeting("test@email.com", "pass")
+        self.create_recording(url, False, 1)
+        repository = storage.repository
+        status = repository.recording_status
+        statuses = iter([purge.PURGED])
+
+        def created_meanwhile(url):
+            return next(statuses, None) or status(url)
+
+        with mock.patch.object(repository, 'recording_status',
+                               created_meanwhile):
+            rv = self.create_recording(url, False, 2)
+        self.assertEqual("URL already exists.", rv.get_json()['message'])
+        self.assertEqual(0, shards.sessions()[0].query(
+            models.Recording).count())
+        self.assertEqual([(url, 1)], db.session.query(
+            models.recording_shards).all())
+
+    def test_purged_url_can_be_created_in_another_shard(self):
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        self.create_viewer("test@email.com")
+        self.create_meeting("test@email.com", "pass")
+        self.create_meeting("test@email.com", "pass")
+        self.create_recording(url, False, 1)
+        self.delete_recording(url)
+        for session in recording_purge.sessions(sharded_app):
+            recording_purge.purge_pending(session)
+        self.assertEqual([], db.session.query(
+            models.recording_shards).all())
+        # A claim the purge could not drop is taken over
+        db.session.execute(models.recording_shards.insert(),
+                           {'url': url, 'shard': 1})
+        db.session.commit()
+        rv = self.create_recording(url, False, 2)
+        self.assertEqual(url, rv.get_json()['url'])
+        self.assertEqual([(url, 0)], db.session.query(
+            models.recording_shards).all())
+        self.assertEqual(url, self.app.get(
+            '/recording/get').get_json()[0]['url'])
+
+    def test_bulk_share_of_recording_deleted_meanwhile(self):
+        """Ensure a bulk share of a recording deleted while it runs reports
+        the recording as invalid"""
+        url = "https://s3.amazonaws.com/meetings/recording1/"
+        self.create_viewer("test@email.com")
+        self.create_meeting("test@email.com", "pass")
+        self.create_recording(url, False, 1)
+        repository = storage.repository
+        shared = repository.shared
+        recording = models.Recording.__table__
+
+        def delete_meanwhile(urls, emails):
+            shards.engine(1).execute(recording.update().values(
+                deleted=datetime.datetime.utcnow()))
+            return shared(urls, emails)
+
+        with mock.patch.object(repository, 'shared', delete_meanwhile):
+            rv = self.share_recordings(url, ["test@email.com"])
+        self.assertEqual(
+            ["The URL " + url + " does not belong to a valid Recording."],
+            [result['message'] for result in rv.get_json()])
+
+    def test_recording_versions_add_up(self):
+        """Ensure a write to any shard changes the ETag of the list"""
+        self.create_viewer("test@email.com")
+        self.create_meeting("test@email.com", "pass")
+        self.create_meeting("test@email.com", "pass")
+        self.create_recording("https://rec/1", False, 1)
+        etag = self.app.get('/recording/get').headers['ETag']
+        self.create_recording("https://rec/2", False, 2)
+        rv = self.app.get('/recording/get',
+                          headers={'If-None-Match': etag})
+        self.assertEqual(200, rv.status_code)
+        etag = rv.headers['ETag']
+        rv = self.app.get('/recording/get',
+                          headers={'If-None-Match': etag})
+        self.assertEqual(304, rv.status_code)
+
+
+class AppFactoryTestCase(unittest.TestCase):
+
+    def test_config_overrides_defaults(self):
+        """Ensure settings passed to the factory win over the defaults"""
+        other = create_app({'LIST_MAX_LIMIT': 5})
+        self.assertEqual(5, other.config['LIST_MAX_LIMIT'])
+        self.assertEqual(1000, app.config['LIST_MAX_LIMIT'])
+        self.assertIn('upgrade-db', other.cli.commands)
+
+    def test_engine_is_created_lazily(self):
+        """Ensure creating an app does not connect to the database"""
+        other = create_app()
+        self.assertEqual({}, other.extensions['sqlalchemy'].connectors)
+
 
 if __name__ == '__main__':
     unittest.main()
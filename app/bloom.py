@@ -0,0 +1,233 @@
+"""
+In-process Bloom filter of registered viewer emails
+"""
+from flask import current_app, has_app_context
+from sqlalchemy import func, select
+import hashlib
+import math
+import threading
+import time
+import weakref
+
+
+class BloomFilter(object):
+    """Fixed-size Bloom filter of strings, sized for `capacity` values at
+    `error_rate` false positives"""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.bits = max(int(math.ceil(
+            -self.capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(
+            self.bits / float(self.capacity) * math.log(2))), 1)
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, value):
+        # Double hashing: k positions out of one 128-bit digest
+        digest = int.from_bytes(hashlib.blake2b(
+            value.encode('utf-8'), digest_size=16).digest(), 'little')
+        bits = self.bits
+        position, step = (digest >> 64) % bits, (digest | 1) % bits
+        for _ in range(self.hashes):
+            yield position
+            position = (position + step) % bits
+
+    def add(self, value):
+        array = self._array
+        for position in self._positions(value):
+            array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        # Most unknown values stop at the first or second probe
+        array = self._array
+        for position in self._positions(value):
+            if not array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def nbytes(self):
+        return len(self._array)
+
+    def false_positive_rate(self):
+        """Expected rate for the values added so far"""
+        return (1 - math.exp(-self.hashes * self.count / float(self.bits))) \
+            ** self.hashes
+
+
+class _Emails(object):
+    """Filter of one app, with the last viewer id it has seen"""
+
+    def __init__(self, bloom, last_id, refreshed):
+        self.bloom = bloom
+        self.last_id = last_id
+        self.refreshed = refreshed
+        self.lock = threading.Lock()
+
+
+class ViewerFilter(object):
+    """Prefilter answering "no viewer has this email" without a query.
+
+    The filter is built from the viewer table on first use (or by `warm`),
+    emails created in this process are added before their write, and
+    viewers created by other processes are fetched by id at most every
+    VIEWER_FILTER_REFRESH seconds. A negative answer can therefore only be
+    wrong for a viewer another process created within that delay; positive
+    answers still go to the database.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._filters = weakref.WeakKeyDictionary()
+        self.checks = 0
+        self.rejections = 0
+        self.builds = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('VIEWER_FILTER_ENABLED', False)
+        app.config.setdefault('VIEWER_FILTER_ERROR_RATE', 0.01)
+        app.config.setdefault('VIEWER_FILTER_CAPACITY', 100000)
+        app.config.setdefault('VIEWER_FILTER_REFRESH', 1.0)
+        app.extensions['viewer_filter'] = self
+
+    @property
+    def enabled(self):
+        # Built from the viewer table, which the sharded backend keeps in
+        # the main database too
+        return current_app.config['VIEWER_FILTER_ENABLED'] and \
+            current_app.config['STORAGE_BACKEND'] in ('sqlalchemy', 'sharded')
+
+    def warm(self):
+        """Build the filter of the current app now rather than on the
+        first request, e.g. before forking workers"""
+        if self.enabled:
+            self._emails()
+
+    def might_exist(self, email):
+        """False if no viewer has `email`, True if one may have it"""
+        if not self.enabled:
+            return True
+        found = email in self._emails().bloom
+        with self._lock:
+            self.checks += 1
+            if not found:
+                self.rejections += 1
+        return found
+
+    def add(self, email):
+        """Add the email of a viewer about to be created. Adding one whose
+        write then fails only costs a false positive."""
+        if not self.enabled:
+            return
+        emails = self._filters.get(current_app._get_current_object())
+        if emails is not None:
+            with emails.lock:
+                emails.bloom.add(email)
+
+    def stats(self):
+        emails = None
+        if has_app_context():
+            emails = self._filters.get(current_app._get_current_object())
+        with self._lock:
+            stats = {
+                'emails': 0,
+                'bytes': 0,
+                'hashes': 0,
+                'false_positive_rate': 0.0,
+                'checks': self.checks,
+                'rejections': self.rejections,
+                'builds': self.builds,
+            }
+        if emails is not None:
+            bloom = emails.bloom
+            stats.update(emails=bloom.count, bytes=bloom.nbytes,
+                         hashes=bloom.hashes,
+                         false_positive_rate=bloom.false_positive_rate())
+        return stats
+
+    def collect(self):
+        """Counters in the format expected by Metrics.add_collector"""
+        stats = self.stats()
+        return [
+            ('meetings_viewer_filter_emails', 'gauge',
+             'Emails added to the viewer prefilter.',
+             [({}, stats['emails'])]),
+            ('meetings_viewer_filter_bytes', 'gauge',
+             'Memory used by the bits of the viewer prefilter.',
+             [({}, stats['bytes'])]),
+            ('meetings_viewer_filter_false_positive_rate', 'gauge',
+             'Expected false positive rate of the viewer prefilter.',
+             [({}, stats['false_positive_rate'])]),
+            ('meetings_viewer_filter_checks_total', 'counter',
+             'Emails checked against the viewer prefilter.',
+             [({}, stats['checks'])]),
+            ('meetings_viewer_filter_rejections_total', 'counter',
+             'Emails the viewer prefilter answered without a query.',
+             [({}, stats['rejections'])]),
+            ('meetings_viewer_filter_builds_total', 'counter',
+             'Times the viewer prefilter was built from the viewer table.',
+             [({}, stats['builds'])]),
+        ]
+
+    def _emails(self):
+        app = current_app._get_current_object()
+        emails = self._filters.get(app)
+        if emails is None:
+            with self._lock:
+                emails = self._filters.get(app)
+                if emails is None:
+                    emails = self._filters[app] = self._build(app)
+            return emails
+        if time.monotonic() - emails.refreshed >= \
+                app.config['VIEWER_FILTER_REFRESH']:
+            # One thread catches up, the others keep using the filter
+            if emails.lock.acquire(blocking=False):
+                try:
+                    self._refresh(app, emails)
+                finally:
+                    emails.lock.release()
+        return emails
+
+    def _build(self, app, capacity=0):
+        # Callers hold the lock of the filter being replaced, or the
+        # extension's lock for a new one
+        db = app.extensions['sqlalchemy'].db
+        viewer = db.metadata.tables['viewer']
+        count = db.session.execute(select([func.count()]).select_from(
+            viewer)).scalar()
+        bloom = BloomFilter(
+            max(app.config['VIEWER_FILTER_CAPACITY'], capacity, 2 * count),
+            app.config['VIEWER_FILTER_ERROR_RATE'])
+        last_id = 0
+        result = db.session.connection().execution_options(
+            stream_results=True).execute(select([viewer.c.id,
+                                                 viewer.c.email]))
+        for id, email in result:
+            bloom.add(email)
+            last_id = max(last_id, id)
+        self.builds += 1
+        return _Emails(bloom, last_id, time.monotonic())
+
+    def _refresh(self, app, emails):
+        db = app.extensions['sqlalchemy'].db
+        viewer = db.metadata.tables['viewer']
+        last_id = db.session.execute(select([func.max(
+            viewer.c.id)])).scalar() or 0
+        if last_id < emails.last_id or \
+                emails.bloom.count > emails.bloom.capacity:
+            # Viewers were removed (e.g. a recreated database), or the
+            # filter is full: start over
+            rebuilt = self._build(app, 2 * emails.bloom.capacity)
+            emails.bloom, emails.last_id = rebuilt.bloom, rebuilt.last_id
+        elif last_id > emails.last_id:
+            for id, email in db.session.execute(select(
+                    [viewer.c.id, viewer.c.email]).where(
+                    viewer.c.id > emails.last_id)):
+                emails.bloom.add(email)
+            emails.last_id = last_id
+        emails.refreshed = time.monotonic()
@@ -0,0 +1,109 @@
+import os
+import tempfile
+import unittest
+from sqlalchemy import event
+from app import create_app
+from bloom import BloomFilter
+from extensions import db, viewer_filter
+import models
+
+
+class BloomFilterTestCase(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        emails = ["viewer%d@email.com" % i for i in range(1000)]
+        for email in emails:
+            bloom.add(email)
+        self.assertTrue(all(email in bloom for email in emails))
+
+    def test_false_positive_rate(self):
+        """Ensure a full filter stays close to its error rate"""
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add("viewer%d@email.com" % i)
+        false_positives = sum("other%d@email.com" % i in bloom
+                              for i in range(10000))
+        self.assertLess(false_positives, 200)
+        self.assertAlmostEqual(0.01, bloom.false_positive_rate(), places=2)
+        self.assertEqual(1199, bloom.nbytes)
+
+
+class ViewerFilterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(
+                self.directory.name, 'bloom.db'),
+            'PASSWORD_HASH_ITERATIONS': 1000,
+            'VIEWER_FILTER_ENABLED': True,
+            'VIEWER_FILTER_REFRESH': 60,
+        })
+        with self.app.app_context():
+            db.create_all()
+            db.session.execute(models.Viewer.__table__.insert(),
+                               {'email': 'host@email.com'})
+            db.session.commit()
+            viewer_filter.warm()
+            self.statements = []
+            event.listen(db.get_engine(), 'before_cursor_execute',
+                         self.count)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            event.remove(db.get_engine(), 'before_cursor_execute',
+                         self.count)
+            db.get_engine().dispose()
+        self.directory.cleanup()
+
+    def count(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_unknown_email_without_query(self):
+        """Ensure unknown emails are rejected without touching the
+        database"""
+        rv = self.client.post('/meeting/create', json={
+            'host_email': 'nobody@email.com', 'password': 'pass'})
+        self.assertEqual("Invalid host email.", rv.get_json()['message'])
+        rv = self.client.get('/recording/has-access', json={
+            'email': 'nobody@email.com', 'url': 'https://a/'})
+        self.assertEqual("The Email nobody@email.com does not belong to a "
+                         "valid viewer.", rv.get_json()['message'])
+        self.assertEqual([], self.statements)
+
+    def test_known_email_reaches_the_database(self):
+        rv = self.client.post('/meeting/create', json={
+            'host_email': 'host@email.com', 'password': 'pass'})
+        self.assertEqual(1, rv.get_json()['id'])
+
+    def test_created_viewer_is_known_at_once(self):
+        self.client.post('/viewer/create', json={'email': 'new@email.com'})
+        rv = self.client.post('/meeting/create', json={
+            'host_email': 'new@email.com', 'password': 'pass'})
+        self.assertEqual(1, rv.get_json()['id'])
+
+    def test_viewers_of_other_processes_after_refresh(self):
+        """Ensure viewers created elsewhere are fetched on refresh"""
+        with self.app.app_context():
+            db.session.execute(models.Viewer.__table__.insert(),
+                               {'email': 'elsewhere@email.com'})
+            db.session.commit()
+            self.assertFalse(viewer_filter.might_exist('elsewhere@email.com'))
+            self.app.config['VIEWER_FILTER_REFRESH'] = 0
+            self.assertTrue(viewer_filter.might_exist('elsewhere@email.com'))
+            self.assertEqual(2, viewer_filter.stats()['emails'])
+
+    def test_stats(self):
+        with self.app.app_context():
+            stats = viewer_filter.stats()
+        # 100000 emails at 1% take 117 KiB
+        self.assertEqual(119814, stats['bytes'])
+        self.assertEqual(7, stats['hashes'])
+        self.assertEqual(1, stats['emails'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class AccessCache(object):
+    """Bounded LRU/TTL cache of /recording/has-access decisions.
+
+    Entries are keyed on (url, email, password digest) and remember the
+    meeting the recording belongs to, so they can be dropped exactly when
+    a share, a deletion or a change to the meeting touches them in this
+    process. Each entry also keeps a stamp of what it was computed from,
+    e.g. the versions of the recording and meeting rows, which `get`
+    compares with the current one: writes of other processes, which cannot
+    reach this cache, make their decisions stale that way. A single process
+    sees all the writes, so `validate` can be turned off to spare that
+    comparison.
+    """
+
+    def __init__(self, app=None, maxsize=4096, ttl=300.0,
+                 clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = True
+        self.validate = True
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_url = {}
+        self._by_meeting = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ACCESS_CACHE_ENABLED', True)
+        app.config.setdefault('ACCESS_CACHE_SIZE', self.maxsize)
+        app.config.setdefault('ACCESS_CACHE_TTL', self.ttl)
+        app.config.setdefault('ACCESS_CACHE_VALIDATE', self.validate)
+        self.enabled = app.config['ACCESS_CACHE_ENABLED']
+        self.validate = app.config['ACCESS_CACHE_VALIDATE']
+        self.maxsize = app.config['ACCESS_CACHE_SIZE']
+        self.ttl = app.config['ACCESS_CACHE_TTL']
+        app.extensions['access_cache'] = self
+
+    @staticmethod
+    def key(url, email, password):
+        """Build a cache key without keeping the password itself around"""
+        digest = hashlib.sha256(repr(password).encode('utf-8')).digest()
+        return (url, email, digest)
+
+    def get(self, key, current=None):
+        """Return the cached decision for `key` or None.
+
+        `current(url, meeting_id)`, if given, returns the stamp the decision
+        must have been stored with to be used. It is called without the
+        lock, as it usually queries the database, and not at all unless
+        `validate` is on.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            granted, meeting_id, expires, stamp = entry
+            if expires <= self._clock():
+                self._remove(key)
+                self.misses += 1
+                return None
+        if current is not None and self.validate and \
+                current(key[0], meeting_id) != stamp:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self._remove(key)
+                    self.invalidations += 1
+                self.misses += 1
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+        return granted
+
+    def meeting(self, key):
+        """Meeting of the recording of the decision cached for `key`, or
+        None, e.g. to look up the stamps of many entries at once"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else entry[1]
+
+    def generation(self):
+        """Token to pass to `set` so decisions computed while an
+        invalidation was in flight are not stored"""
+        return self._generation
+
+    def set(self, key, granted, meeting_id, generation=None, stamp=None):
+        if not self.enabled or self.maxsize <= 0:
+            return
+        url = key[0]
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (granted, meeting_id,
+                                  self._clock() + self.ttl, stamp)
+            self._by_url.setdefault(url, set()).add(key)
+            self._by_meeting.setdefault(meeting_id, set()).add(url)
+            while len(self._entries) > self.maxsize:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate_recording(self, url, email=None):
+        """Drop decisions about `url`, optionally only those for `email`"""
+        with self._lock:
+            self._generation += 1
+            keys = self._by_url.get(url, ())
+            if email is not None:
+                keys = [key for key in keys if key[1] == email]
+            for key in list(keys):
+                self._remove(key)
+                self.invalidations += 1
+
+    def invalidate_meeting(self, meeting_id):
+        """Drop decisions about every recording of a meeting"""
+        with self._lock:
+            self._generation += 1
+            for url in list(self._by_meeting.get(meeting_id, ())):
+                for key in list(self._by_url.get(url, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._by_url.clear()
+            self._by_meeting.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def collect(self):
+        """Counters in the format expected by Metrics.add_collector"""
+        stats = self.stats()
+        families = [
+            ('meetings_access_cache_entries', 'gauge',
+             'Access decisions currently cached.', [({}, stats['size'])]),
+        ]
+        for name in ('hits', 'misses', 'evictions', 'invalidations'):
+            families.append((
+                'meetings_access_cache_%s_total' % name, 'counter',
+                'Access decision cache %s.' % name, [({}, stats[name])]))
+        return families
+
+    def _remove(self, key):
+        # Callers must hold the lock
+        _, meeting_id, _, _ = self._entries.pop(key)
+        url = key[0]
+        keys = self._by_url.get(url)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_url[url]
+                urls = self._by_meeting.get(meeting_id)
+                if urls is not None:
+                    urls.discard(url)
+                    if not urls:
+                        del self._by_meeting[meeting_id]
@@ -0,0 +1,107 @@
+import unittest
+from cache import AccessCache
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class AccessCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = AccessCache(maxsize=2, ttl=10, clock=self.clock)
+
+    def test_miss_then_hit(self):
+        """Ensure stored decisions are returned and counted"""
+        key = AccessCache.key("url", "a@email.com", "pass")
+        self.assertIsNone(self.cache.get(key))
+        self.cache.set(key, True, 1)
+        self.assertTrue(self.cache.get(key))
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_password_is_part_of_the_key(self):
+        """Ensure a different password does not share a decision"""
+        self.cache.set(AccessCache.key("url", "a@email.com", "pass"), True, 1)
+        key = AccessCache.key("url", "a@email.com", "wrong")
+        self.assertIsNone(self.cache.get(key))
+
+    def test_entries_expire(self):
+        """Ensure decisions older than the TTL are dropped"""
+        key = AccessCache.key("url", "a@email.com", "pass")
+        self.cache.set(key, True, 1)
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(key))
+        self.assertEqual(0, self.cache.stats()['size'])
+
+    def test_least_recently_used_is_evicted(self):
+        """Ensure the cache stays bounded"""
+        first = AccessCache.key("url1", "a@email.com", "pass")
+        second = AccessCache.key("url2", "a@email.com", "pass")
+        third = AccessCache.key("url3", "a@email.com", "pass")
+        self.cache.set(first, True, 1)
+        self.cache.set(second, True, 1)
+        self.cache.get(first)
+        self.cache.set(third, True, 1)
+        self.assertIsNone(self.cache.get(second))
+        self.assertTrue(self.cache.get(first))
+        self.assertEqual(1, self.cache.stats()['evictions'])
+
+    def test_invalidate_recording_for_one_viewer(self):
+        """Ensure only the given viewer's decision is dropped"""
+        first = AccessCache.key("url", "a@email.com", "pass")
+        second = AccessCache.key("url", "b@email.com", "pass")
+        self.cache.set(first, False, 1)
+        self.cache.set(second, False, 1)
+        self.cache.invalidate_recording("url", "a@email.com")
+        self.assertIsNone(self.cache.get(first))
+        self.assertFalse(self.cache.get(second))
+
+    def test_invalidate_meeting(self):
+        """Ensure every recording of a meeting is dropped"""
+        first = AccessCache.key("url1", "a@email.com", "pass")
+        second = AccessCache.key("url2", "a@email.com", "pass")
+        self.cache.set(first, True, 1)
+        self.cache.set(second, True, 2)
+        self.cache.invalidate_meeting(1)
+        self.assertIsNone(self.cache.get(first))
+        self.assertTrue(self.cache.get(second))
+
+    def test_changed_stamp_drops_decision(self):
+        """Ensure a decision is only used with the stamp it was stored
+        with"""
+        key = AccessCache.key("url", "a@email.com", "pass")
+        self.cache.set(key, True, 1, stamp=(1, 1))
+        self.assertTrue(self.cache.get(key, lambda url, meeting: (1, 1)))
+        self.assertIsNone(self.cache.get(key, lambda url, meeting: (2, 1)))
+        self.assertIsNone(self.cache.meeting(key))
+        self.assertEqual(1, self.cache.stats()['invalidations'])
+
+    def test_stamps_are_not_checked_without_validate(self):
+        """Ensure a decision is used as is when validation is off"""
+        self.cache.validate = False
+        key = AccessCache.key("url", "a@email.com", "pass")
+        self.cache.set(key, True, 1, stamp=(1, 1))
+
+        def current(url, meeting):
+            self.fail("stamp looked up")
+        self.assertTrue(self.cache.get(key, current))
+
+    def test_stale_fill_is_ignored(self):
+        """Ensure a decision computed across an invalidation is not kept"""
+        key = AccessCache.key("url", "a@email.com", "pass")
+        generation = self.cache.generation()
+        self.cache.invalidate_recording("url")
+        self.cache.set(key, False, 1, generation)
+        self.assertIsNone(self.cache.get(key))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Feed of create, delete and share events, served as server-sent events.
+
+Events are rows of the `changes` table, inserted in the transaction of the
+write that caused them, so their sequence numbers follow the commit order
+(SQLite has a single writer) and a rolled back write leaves no event.
+"""
+from sqlalchemy import func, select
+import datetime
+import listing
+import models
+import time
+
+# Event names
+MEETING_CREATE = 'meeting.create'
+RECORDING_CREATE = 'recording.create'
+RECORDING_DELETE = 'recording.delete'
+RECORDING_SHARE = 'recording.share'
+VIEWER_CREATE = 'viewer.create'
+# Sent instead of the events a client missed, e.g. pruned ones or bulk
+# imports: it has to fetch the lists again
+RESET = 'reset'
+
+
+def record(bind, event, data):
+    record_many(bind, [(event, data)])
+
+
+def record_many(bind, events):
+    """Insert (event, data) pairs with `bind`, a session or a connection"""
+    if not events:
+        return
+    now = datetime.datetime.utcnow()
+    bind.execute(models.changes.insert(), [
+        {'event': event, 'data': listing.encode(data), 'created': now}
+        for event, data in events])
+
+
+def bounds(bind):
+    """(first, last) sequence numbers still stored, (None, None) if none"""
+    table = models.changes
+    return tuple(bind.execute(select([func.min(table.c.seq),
+                                      func.max(table.c.seq)])).first())
+
+
+def after(bind, since, limit):
+    """Up to `limit` (seq, event, data) rows following `since`"""
+    table = models.changes
+    return bind.execute(
+        select([table.c.seq, table.c.event, table.c.data])
+        .where(table.c.seq > since).order_by(table.c.seq)
+        .limit(limit)).fetchall()
+
+
+def prune(bind, before):
+    """Delete the events created before `before`, returns their number"""
+    return bind.execute(models.changes.delete().where(
+        models.changes.c.created < before)).rowcount
+
+
+def message(seq, event, data):
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (seq, event, data)
+
+
+def follow(session, since, timeout, poll_interval, heartbeat, chunk_size,
+           retry):
+    """Yield the server-sent events following `since`, polling for new ones
+    until `timeout` seconds have passed.
+
+    The session is rolled back after every poll, so a waiting client does
+    not hold a pooled connection or an old snapshot.
+    """
+    deadline = time.monotonic() + timeout
+    yield 'retry: %d\n\n' % int(retry * 1000)
+    first, last = bounds(session)
+    session.rollback()
+    if since is None:
+        since = last or 0
+    elif (first is not None and since < first - 1) or since > (last or 0):
+        # Events were pruned, or the client comes from another database
+        since = last or 0
+        yield message(since, RESET, '{}')
+    idle = time.monotonic()
+    while True:
+        rows = after(session, since, chunk_size)
+        session.rollback()
+        for seq, event, data in rows:
+            yield message(seq, event, data)
+            since = seq
+        if len(rows) == chunk_size:
+            continue
+        now = time.monotonic()
+        if rows:
+            idle = now
+        if now >= deadline:
+            return
+        if now - idle >= heartbeat:
+            # Comment line keeping proxies from closing an idle stream
+            yield ': heartbeat\n\n'
+            idle = now
+        time.sleep(min(poll_interval, deadline - now))
@@ -0,0 +1,121 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from app import create_app
+from extensions import db, recording_purge
+
+
+def parse(body):
+    """(id, event, data) of the events of a server-sent event stream"""
+    events = []
+    for block in body.decode().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines()
+                      if not line.startswith(':'))
+        if 'event' in fields:
+            events.append((int(fields['id']), fields['event'],
+                           json.loads(fields['data'])))
+    return events
+
+
+class ChangesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(
+                self.directory.name, 'changes.db'),
+            'CHANGES_POLL_INTERVAL': 0.05,
+        })
+        with self.app.app_context():
+            db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        recording_purge.close()
+        with self.app.app_context():
+            db.get_engine().dispose()
+        self.directory.cleanup()
+
+    def changes(self, query='since=0&timeout=0', headers=None):
+        response = self.client.get('/changes?' + query, headers=headers)
+        self.assertEqual('text/event-stream', response.mimetype)
+        return parse(response.data)
+
+    def create_shared_recording(self):
+        self.client.post('/viewer/create', json={'email': 'host@email.com'})
+        self.client.post('/meeting/create', json={'host_email':
+                                                  'host@email.com',
+                                                  'password': 'pass'})
+        self.client.post('/recording/create', json={'url': 'https://a/',
+                                                    'is_private': False,
+                                                    'meeting_id': 1})
+        self.client.post('/recording/share', json={'url': 'https://a/',
+                                                   'email':
+                                                   'host@email.com'})
+
+    def test_events_of_the_write_paths(self):
+        """Ensure creates, shares and deletes are sent in order"""
+        self.create_shared_recording()
+        self.client.post('/recording/share', json={'url': 'https://a/',
+                                                   'email':
+                                                   'host@email.com'})
+        self.client.delete('/recording/delete', json={'url': 'https://a/'})
+        recording = {'url': 'https://a/', 'is_private': False,
+                     'meeting_id': 1}
+        self.assertEqual([
+            (1, 'viewer.create', {'id': 1, 'email': 'host@email.com'}),
+            (2, 'meeting.create', {'id': 1, 'host_email': 'host@email.com'}),
+            (3, 'recording.create', recording),
+            (4, 'recording.share', {'url': 'https://a/',
+                                    'email': 'host@email.com'}),
+            (5, 'recording.delete', recording),
+        ], self.changes())
+
+    def test_resume_after_last_event_id(self):
+        """Ensure a reconnecting client only gets the events it missed"""
+        self.create_shared_recording()
+        self.assertEqual([3, 4], [seq for seq, _, _ in self.changes(
+            'since=0&timeout=0', {'Last-Event-ID': '2'})])
+        self.assertEqual([4], [seq for seq, _, _ in self.changes(
+            'since=3&timeout=0')])
+
+    def test_follows_new_events(self):
+        """Ensure a stream without since sends the events written while it
+        is open, and only those"""
+        self.create_shared_recording()
+
+        def share():
+            time.sleep(0.2)
+            self.app.test_client().post(
+                '/recording/share/bulk',
+                json={'url': 'https://a/', 'emails': ['host@email.com',
+                                                      'nobody@email.com']})
+            self.app.test_client().post('/viewer/create',
+                                        json={'email': 'viewer@email.com'})
+
+        thread = threading.Thread(target=share)
+        thread.start()
+        events = self.changes('timeout=1')
+        thread.join()
+        self.assertEqual([(5, 'viewer.create', {'id': 2,
+                                                'email': 'viewer@email.com'})],
+                         events)
+
+    def test_reset_for_unknown_position(self):
+        """Ensure a client ahead of the feed is told to start over"""
+        self.create_shared_recording()
+        self.assertEqual([(4, 'reset', {})], self.changes(
+            'since=10&timeout=0'))
+
+    def test_invalid_since(self):
+        response = self.client.get('/changes?since=x')
+        self.assertEqual({"message": "Invalid since or timeout."},
+                         response.get_json())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+"""
+Default configuration, overridable through the environment
+"""
+import os
+
+# Connect-time pragmas and pool settings for file based SQLite databases.
+# "default" keeps SQLite's own behaviour, "production" is meant for
+# several concurrent workers sharing one database file.
+SQLITE_PROFILES = {
+    'default': {
+        'pragmas': {},
+        'pool_size': None,
+    },
+    'production': {
+        'pragmas': {
+            # Wait for the write lock instead of failing with
+            # "database is locked"
+            'busy_timeout': 5000,
+            # Readers no longer block the writer and commits only fsync
+            # the write-ahead log at checkpoints
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            # 256 MiB of memory mapped I/O and a 64 MiB page cache
+            'mmap_size': 268435456,
+            'cache_size': -65536,
+            'temp_store': 'MEMORY',
+        },
+        'pool_size': 5,
+        'max_overflow': 10,
+    },
+}
+
+
+class Config(object):
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'MEETINGS_DATABASE_URI', 'sqlite:///meetings.db')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # One of SQLITE_PROFILES, plus per-setting overrides
+    SQLITE_PROFILE = os.environ.get('MEETINGS_SQLITE_PROFILE', 'default')
+    SQLITE_PRAGMAS = {}
+    SQLITE_POOL_SIZE = None
+    # Largest page the list endpoints return and rows per streamed chunk
+    LIST_MAX_LIMIT = 1000
+    LIST_STREAM_CHUNK = 500
+    # Values per IN (...) clause, below SQLite's bound parameter limit
+    SQL_IN_CHUNK = 500
+    # Seconds a /changes stream stays open (below gunicorn's 30 s worker
+    # timeout), between polls for new events and between heartbeats when
+    # idle; events sent per poll and the reconnect delay given to clients
+    CHANGES_TIMEOUT = 20
+    CHANGES_POLL_INTERVAL = 0.5
+    CHANGES_HEARTBEAT = 15
+    CHANGES_CHUNK = 500
+    CHANGES_RETRY = 1
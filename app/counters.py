@@ -0,0 +1,210 @@
+"""
+Denormalized counts of viewers, meetings, recordings and shares, for /stats.
+
+Counters are rows of the `counters` table, changed in the transaction of
+the write they count, so a rolled back write leaves them alone and reading
+one is a primary key lookup. Tables are looked up through the app, as
+purge.py, which keeps the per-recording counts, cannot import the models.
+"""
+from flask import current_app
+from sqlalchemy import and_, bindparam, func, literal, select
+import listing
+
+# Totals of the whole database
+VIEWERS = 'viewers'
+MEETINGS = 'meetings'
+RECORDINGS = 'recordings'
+SHARES = 'shares'
+TOTALS = (VIEWERS, MEETINGS, RECORDINGS, SHARES)
+
+# Name of the counter of `viewer`, which `unshare` builds in SQL too
+VIEWER = 'viewer:%s:shares'
+
+
+def meeting(id):
+    """Recordings of the meeting `id`"""
+    return 'meeting:%d:recordings' % id
+
+
+def recording(url):
+    """Viewers the recording `url` is shared with"""
+    return 'recording:%s:shares' % url
+
+
+def viewer(email):
+    """Public recordings shared with `email`"""
+    return VIEWER % email
+
+
+def host(email):
+    """Private recordings of the meetings `email` hosts. With those of
+    `viewer`, the recordings `email` can access."""
+    return 'host:%s:private' % email
+
+
+def _tables():
+    return current_app.extensions['sqlalchemy'].db.metadata.tables
+
+
+def add(bind, deltas, in_chunk=500):
+    """Add the {name: delta} `deltas` to the counters, with `bind` a
+    session or a connection.
+
+    One UPDATE for the counters that exist, then an INSERT of those that
+    did not, which is only looked for when the UPDATE missed some. The
+    UPDATE takes the write lock, so no other writer creates them in
+    between. (An upsert would be one statement, but needs SQLite 3.24.)
+    """
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    table = _tables()['counters']
+    updated = bind.execute(table.update().where(
+        table.c.name == bindparam('key')).values(
+        value=table.c.value + bindparam('delta')),
+        [{'key': name, 'delta': delta}
+         for name, delta in sorted(deltas.items())]).rowcount
+    if updated == len(deltas):
+        return
+    existing = set()
+    for chunk in listing.chunked(sorted(deltas), in_chunk):
+        existing.update(name for name, in bind.execute(
+            select([table.c.name]).where(table.c.name.in_(chunk))))
+    bind.execute(table.insert(), [
+        {'name': name, 'value': delta}
+        for name, delta in sorted(deltas.items()) if name not in existing])
+
+
+def get(bind, names, in_chunk=500):
+    """{name: value} of `names`, 0 for those never counted"""
+    table = _tables()['counters']
+    values = dict.fromkeys(names, 0)
+    for chunk in listing.chunked(sorted(set(names)), in_chunk):
+        values.update((name, value) for name, value in bind.execute(
+            select([table.c.name, table.c.value]).where(
+                table.c.name.in_(chunk))))
+    return values
+
+
+def delete(bind, names):
+    """Drop the counters `names`, e.g. those of a purged recording"""
+    table = _tables()['counters']
+    bind.execute(table.delete().where(table.c.name.in_(list(names))))
+
+
+def unshare(bind, url):
+    """Take the shares of the deleted recording `url` off the counters of
+    their viewers, in one statement whatever their number"""
+    tables = _tables()
+    table, shares = tables['counters'], tables['viewers'].c
+    prefix, suffix = VIEWER.split('%s')
+    bind.execute(table.update().where(table.c.name.in_(
+        select([literal(prefix) + shares.viewer_email + literal(suffix)])
+        .where(shares.recording_url == url))).values(
+        value=table.c.value - 1))
+
+
+def created(meeting_id, host_email=None):
+    """Deltas of creating a recording of the meeting `meeting_id`, given
+    the `host_email` of the meeting if the recording is private"""
+    deltas = {RECORDINGS: 1, meeting(meeting_id): 1}
+    if host_email is not None:
+        deltas[host(host_email)] = 1
+    return deltas
+
+
+def shared(pairs):
+    """Deltas of sharing the recordings of the (url, email) `pairs`"""
+    deltas = {SHARES: 0}
+    for url, email in pairs:
+        deltas[SHARES] += 1
+        deltas[recording(url)] = deltas.get(recording(url), 0) + 1
+        deltas[viewer(email)] = deltas.get(viewer(email), 0) + 1
+    return deltas
+
+
+def hosts(bind):
+    """{meeting id: host email} of the meetings of the database of `bind`"""
+    meeting = _tables()['meeting']
+    return {id: email for id, email in bind.execute(
+        select([meeting.c.id, meeting.c.host_email]))}
+
+
+def count(bind, tables, hosts=None):
+    """{name: value} of every counter, recomputed from `tables` (those of
+    a MetaData) with `bind`, counters at 0 left out. The hosts of the
+    meetings are read with `bind` too, unless given as `hosts` ({meeting
+    id: host email}) for the shards, whose meetings are elsewhere."""
+    recordings = tables['recording']
+    shares = tables['viewers']
+    active = recordings.c.deleted.is_(None)
+    public = and_(active, recordings.c.is_private.is_(False))
+    if hosts is None:
+        meetings = tables['meeting'].c
+        hosts = {id: email for id, email in bind.execute(
+            select([meetings.id, meetings.host_email]))}
+    values = {
+        VIEWERS: bind.execute(select([func.count()]).select_from(
+            tables['viewer'])).scalar(),
+        MEETINGS: bind.execute(select([func.count()]).select_from(
+            tables['meeting'])).scalar(),
+        RECORDINGS: bind.execute(select([func.count()]).select_from(
+            recordings).where(active)).scalar(),
+        SHARES: bind.execute(select([func.count()]).select_from(
+            shares.join(recordings, shares.c.recording_url ==
+                        recordings.c.url)).where(active)).scalar(),
+    }
+    values.update((meeting(id), number) for id, number in bind.execute(
+        select([recordings.c.meeting_id, func.count()]).where(active)
+        .group_by(recordings.c.meeting_id)))
+    # Shares of deleted recordings count until they are purged
+    values.update((recording(url), number) for url, number in bind.execute(
+        select([shares.c.recording_url, func.count()])
+        .group_by(shares.c.recording_url)))
+    values.update((viewer(email), number) for email, number in bind.execute(
+        select([shares.c.viewer_email, func.count()]).select_from(
+            shares.join(recordings, shares.c.recording_url ==
+                        recordings.c.url)).where(public)
+        .group_by(shares.c.viewer_email)))
+    for id, number in bind.execute(
+            select([recordings.c.meeting_id, func.count()]).where(and_(
+                active, recordings.c.is_private.is_(True)))
+            .group_by(recordings.c.meeting_id)):
+        name = host(hosts[id])
+        values[name] = values.get(name, 0) + number
+    return {name: value for name, value in values.items() if value}
+
+
+def recount(bind, tables, hosts=None, in_chunk=500):
+    """Recompute every counter with `count` and write those that differ
+    from the stored ones. Returns the names of the counters that were
+    wrong."""
+    table = tables['counters']
+    stored = {name: value for name, value in bind.execute(
+        select([table.c.name, table.c.value]))}
+    values = count(bind, tables, hosts)
+    wrong = sorted(name for name in set(stored) | set(values)
+                   if stored.get(name, 0) != values.get(name, 0))
+    # Only the wrong counters are written
+    for chunk in listing.chunked(wrong, in_chunk):
+        bind.execute(table.delete().where(table.c.name.in_(chunk)))
+    fixed = [{'name': name, 'value': values[name]} for name in wrong
+             if name in values]
+    if fixed:
+        bind.execute(table.insert(), fixed)
+    return wrong
+
+
+def reconcile(session, hosts=None):
+    """Recompute every counter of the database of `session` in one
+    transaction, holding its write lock meanwhile, with the `hosts` of
+    `count`. Returns the names of the counters that were wrong."""
+    session.execute('BEGIN IMMEDIATE')
+    try:
+        wrong = recount(session, _tables(), hosts,
+                        current_app.config['SQL_IN_CHUNK'])
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return wrong
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+from app import create_app
+from extensions import db, recording_purge, storage
+from sqlalchemy import select
+import counters
+import models
+
+
+class CountersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(
+                self.directory.name, 'counters.db'),
+            'PASSWORD_HASH_ITERATIONS': 1000,
+            'RECORDING_PURGE_WORKER': False,
+            'RECORDING_PURGE_BATCH': 2,
+            'RECORDING_PURGE_PAUSE': 0,
+        })
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine().dispose()
+        self.context.pop()
+        self.directory.cleanup()
+
+    def stored(self):
+        return {name: value for name, value in db.session.execute(
+            select([models.counters]))}
+
+    def test_add_creates_and_increments(self):
+        counters.add(db.session, {'a': 2, 'b': 0})
+        counters.add(db.session, {'a': -1, 'c': 3})
+        db.session.commit()
+        self.assertEqual({'a': 1, 'c': 3}, self.stored())
+        self.assertEqual({'a': 1, 'b': 0, 'c': 3},
+                         counters.get(db.session, ['a', 'b', 'c']))
+
+    def test_rolled_back_write_is_not_counted(self):
+        """Ensure counters change with the transaction of the write"""
+        with self.assertRaises(ZeroDivisionError):
+            with storage.repository.transaction() as repository:
+                repository.add_viewer('test@email.com')
+                1 / 0
+        self.assertEqual({}, self.stored())
+        with storage.repository.transaction() as repository:
+            repository.add_viewer('test@email.com')
+        self.assertEqual({'viewers': 1}, self.stored())
+
+    def test_delete_takes_shares_off_the_viewers(self):
+        """Ensure a delete takes the recording off the counters of its
+        viewers at once, and the purged recording leaves none behind"""
+        url = 'https://a/'
+        emails = ['viewer%d@email.com' % i for i in range(5)]
+        with storage.repository.transaction() as repository:
+            repository.add_viewer('host@email.com')
+            repository.add_meeting('host@email.com', 'pass')
+            repository.add_recording(url, False, 1)
+            repository.add_recording('https://b/', False, 1)
+            repository.share_many([(url, email) for email in emails] +
+                                  [('https://b/', emails[0])])
+        with storage.repository.transaction() as repository:
+            repository.delete_recording(url)
+        stored = self.stored()
+        self.assertEqual(5, stored[counters.recording(url)])
+        self.assertEqual(1, stored[counters.SHARES])
+        self.assertEqual([1, 0, 0, 0, 0], [
+            stored[counters.viewer(email)] for email in emails])
+        self.assertEqual([], counters.reconcile(db.session))
+        recording_purge.purge_pending(db.session)
+        stored = self.stored()
+        self.assertNotIn(counters.recording(url), stored)
+        self.assertEqual([1, 0, 0, 0, 0], [
+            stored[counters.viewer(email)] for email in emails])
+        self.assertEqual([], counters.reconcile(db.session))
+
+    def test_reconcile_fixes_wrong_counters(self):
+        with storage.repository.transaction() as repository:
+            repository.add_viewer('host@email.com')
+            repository.add_meeting('host@email.com', 'pass')
+        counters.add(db.session, {counters.MEETINGS: 4, 'stale': 1})
+        db.session.commit()
+        self.assertEqual([counters.MEETINGS, 'stale'],
+                         counters.reconcile(db.session))
+        self.assertEqual({counters.VIEWERS: 1, counters.MEETINGS: 1},
+                         self.stored())
+
+
+if __name__ == '__main__':
+    unittest.main()
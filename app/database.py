@@ -0,0 +1,113 @@
+"""
+Flask-SQLAlchemy with the SQLite engine profiles from config.py
+"""
+from functools import partial
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
+from flask_sqlalchemy import SignallingSession, _EngineConnector
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+import config
+import os
+import weakref
+
+# Every engine created in this process
+_engines = weakref.WeakSet()
+
+# Bind of the engine read-only requests use, see routing.py
+READ_BIND = 'read'
+
+
+def sqlite_profile(app):
+    """Return (pragmas, pool_size, max_overflow) for the configured profile"""
+    name = app.config.get('SQLITE_PROFILE') or 'default'
+    try:
+        profile = config.SQLITE_PROFILES[name]
+    except KeyError:
+        raise ValueError("Unknown SQLITE_PROFILE %r" % name)
+    pragmas = dict(profile['pragmas'])
+    pragmas.update(app.config.get('SQLITE_PRAGMAS') or {})
+    pool_size = app.config.get('SQLITE_POOL_SIZE') or profile['pool_size']
+    return pragmas, pool_size, profile.get('max_overflow', 0)
+
+
+def dispose_engines():
+    """Drop pooled connections inherited from a parent process.
+
+    Connections must not be shared across a fork, so each worker opens its
+    own the first time it needs one.
+    """
+    for engine in list(_engines):
+        engine.dispose()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=dispose_engines)
+
+
+def set_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # The busy timeout has to be in place before anything takes a lock
+    for name in sorted(pragmas, key=lambda name: name != 'busy_timeout'):
+        cursor.execute("PRAGMA %s = %s" % (name, pragmas[name]))
+    cursor.close()
+
+
+class EngineConnector(_EngineConnector):
+
+    def get_options(self, sa_url, echo):
+        options = super(EngineConnector, self).get_options(sa_url, echo)
+        # Connections of the read engine refuse to write, even when it is
+        # the primary database file opened a second time
+        if self._bind == READ_BIND and sa_url.drivername == 'sqlite':
+            options.setdefault('sqlite_pragmas', {})['query_only'] = 'ON'
+        return options
+
+
+class RoutingSession(SignallingSession):
+    """Session sending the statements of read-only requests to the read
+    engine, when one is configured"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_app_context() and g.get('read_only') and \
+                READ_BIND in (self.app.config['SQLALCHEMY_BINDS'] or ()):
+            return self.app.extensions['sqlalchemy'].db.get_engine(
+                self.app, bind=READ_BIND)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+
+    def make_connector(self, app=None, bind=None):
+        return EngineConnector(self, self.get_app(app), bind)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super(SQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername != 'sqlite' or \
+                sa_url.database in (None, '', ':memory:'):
+            return
+
+        pragmas, pool_size, max_overflow = sqlite_profile(app)
+        if pragmas:
+            options['sqlite_pragmas'] = pragmas
+        # Keep connections open per process instead of reconnecting and
+        # re-running the pragmas on every request
+        if pool_size:
+            options['poolclass'] = QueuePool
+            options['pool_size'] = pool_size
+            options['max_overflow'] = max_overflow
+            connect_args = options.setdefault('connect_args', {})
+            connect_args['check_same_thread'] = False
+            if 'busy_timeout' in pragmas:
+                connect_args['timeout'] = pragmas['busy_timeout'] / 1000.0
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop('sqlite_pragmas', None)
+        engine = super(SQLAlchemy, self).create_engine(sa_url, engine_opts)
+        _engines.add(engine)
+        if pragmas:
+            event.listen(engine, 'connect', partial(set_pragmas, pragmas))
+        return engine
@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+from flask import Flask
+from database import SQLAlchemy
+
+
+class SQLiteProfileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + \
+            os.path.join(self.directory.name, 'profile.db')
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        self.db = SQLAlchemy(self.app)
+
+    def tearDown(self):
+        with self.app.app_context():
+            self.db.get_engine().dispose()
+        self.directory.cleanup()
+
+    def pragma(self, name):
+        with self.app.app_context():
+            return self.db.session.execute("PRAGMA " + name).scalar()
+
+    def test_default_profile(self):
+        """Ensure the default profile keeps SQLite's settings"""
+        self.assertEqual('delete', self.pragma('journal_mode'))
+        self.assertEqual('NullPool',
+                         type(self.db.get_engine(self.app).pool).__name__)
+
+    def test_production_profile(self):
+        """Ensure the production profile sets up WAL and a pool"""
+        self.app.config['SQLITE_PROFILE'] = 'production'
+        self.assertEqual('wal', self.pragma('journal_mode'))
+        self.assertEqual(1, self.pragma('synchronous'))
+        self.assertEqual(5000, self.pragma('busy_timeout'))
+        self.assertEqual(-65536, self.pragma('cache_size'))
+        self.assertEqual('QueuePool',
+                         type(self.db.get_engine(self.app).pool).__name__)
+
+    def test_pragma_overrides(self):
+        """Ensure single pragmas can be overridden"""
+        self.app.config['SQLITE_PROFILE'] = 'production'
+        self.app.config['SQLITE_PRAGMAS'] = {'busy_timeout': 100}
+        self.assertEqual(100, self.pragma('busy_timeout'))
+        self.assertEqual('wal', self.pragma('journal_mode'))
+
+    def test_unknown_profile(self):
+        """Ensure a typo in the profile name is reported"""
+        self.app.config['SQLITE_PROFILE'] = 'fast'
+        with self.assertRaises(ValueError):
+            self.pragma('journal_mode')
+        self.app.config['SQLITE_PROFILE'] = 'default'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+"""
+Extensions shared by every application created with app.create_app
+"""
+from flask_marshmallow import Marshmallow
+from admission import AdmissionControl
+from bloom import ViewerFilter
+from cache import AccessCache
+from database import SQLAlchemy
+from group_commit import GroupCommit
+from metrics import Metrics
+from passwords import CredentialCache
+from profiling import RequestProfiler
+from purge import RecordingPurge
+from routing import ReadRouting
+from shards import Shards
+from storage import Storage
+
+# Init db
+db = SQLAlchemy()
+# Init ma
+ma = Marshmallow()
+# Init repository of the configured storage backend
+storage = Storage()
+# Init shard databases of the sharded storage backend
+shards = Shards()
+# Init access decision cache
+access_cache = AccessCache()
+# Init prefilter of viewer emails
+viewer_filter = ViewerFilter()
+# Init cache of verified meeting passwords
+credential_cache = CredentialCache()
+# Init background purge of deleted recordings
+recording_purge = RecordingPurge()
+# Init routing of read-only requests to the read engine
+read_routing = ReadRouting()
+# Init group commit of write requests
+group_commit = GroupCommit()
+# Init per-route metrics
+metrics = Metrics()
+# Init per-route admission control
+admission = AdmissionControl()
+# Init opt-in profiling of sampled requests
+profiler = RequestProfiler()
+metrics.add_collector(access_cache.collect)
+metrics.add_collector(credential_cache.collect)
+metrics.add_collector(viewer_filter.collect)
+metrics.add_collector(group_commit.collect)
+metrics.add_collector(recording_purge.collect)
+metrics.add_collector(admission.collect)
+metrics.add_collector(profiler.collect)
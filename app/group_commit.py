@@ -0,0 +1,235 @@
+"""
+Group commit: concurrent write requests of a process share one transaction
+"""
+from functools import partial
+from flask import current_app
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+import database
+import os
+import queue
+import threading
+import time
+import weakref
+
+# Seconds between checks that the writer of a waiting unit is still alive
+ALIVE_CHECK_INTERVAL = 0.5
+
+
+class Job(object):
+    """A write unit waiting for the writer thread"""
+    __slots__ = ('unit', 'args', 'done', 'result', 'error')
+
+    def __init__(self, unit, args):
+        self.unit = unit
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def manual_transactions(dbapi_connection, connection_record):
+    # Let SQLAlchemy emit BEGIN and SAVEPOINT itself instead of pysqlite
+    dbapi_connection.isolation_level = None
+
+
+class GroupCommit(object):
+    """Runs the write units of request threads on one writer thread.
+
+    The writer takes the units queued within GROUP_COMMIT_WINDOW seconds of
+    the first one, up to GROUP_COMMIT_MAX_BATCH of them, runs each in its
+    own savepoint and commits them together, so a batch costs one fsync.
+    A unit that raises only rolls back its own savepoint and the error is
+    re-raised in the request that submitted it. If the writer itself dies,
+    e.g. because its engine cannot be created, the units it left queued
+    fail and the next unit submitted starts a new writer.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        # app -> (pid, queue, thread) of its writer
+        self._writers = weakref.WeakKeyDictionary()
+        self.batches = 0
+        self.units = 0
+        self.failures = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('GROUP_COMMIT_ENABLED', False)
+        app.config.setdefault('GROUP_COMMIT_WINDOW', 0.002)
+        app.config.setdefault('GROUP_COMMIT_MAX_BATCH', 64)
+        app.config.setdefault('GROUP_COMMIT_SYNCHRONOUS', None)
+        app.extensions['group_commit'] = self
+
+    @property
+    def enabled(self):
+        return current_app.config['GROUP_COMMIT_ENABLED']
+
+    def submit(self, unit, *args):
+        """Run `unit(session, *args)` in the next batch and return its
+        result once the batch is committed"""
+        job = Job(unit, args)
+        jobs, thread = self._writer(current_app._get_current_object())
+        jobs.put(job)
+        while not job.done.wait(ALIVE_CHECK_INTERVAL):
+            # Queued after the writer failed the units it had
+            if not thread.is_alive() and not job.done.is_set():
+                raise RuntimeError("The group commit writer stopped")
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def close(self):
+        """Stop the writer threads after the units already queued"""
+        with self._lock:
+            writers = list(self._writers.values())
+            self._writers.clear()
+        for pid, jobs, thread in writers:
+            if pid == os.getpid():
+                jobs.put(None)
+                thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'units': self.units,
+                'failures': self.failures,
+            }
+
+    def collect(self):
+        """Counters in the format expected by Metrics.add_collector"""
+        stats = self.stats()
+        return [
+            ('meetings_group_commit_batches_total', 'counter',
+             'Transactions committed by the group commit writer.',
+             [({}, stats['batches'])]),
+            ('meetings_group_commit_units_total', 'counter',
+             'Write units run by the group commit writer.',
+             [({}, stats['units'])]),
+            ('meetings_group_commit_failures_total', 'counter',
+             'Write units that raised or whose batch failed to commit.',
+             [({}, stats['failures'])]),
+        ]
+
+    def _writer(self, app):
+        # Threads do not survive a fork, each worker starts its own writer,
+        # and starts it again if it died
+        with self._lock:
+            pid, jobs, thread = self._writers.get(app, (None, None, None))
+            if pid != os.getpid() or not thread.is_alive():
+                jobs = queue.Queue()
+                thread = threading.Thread(target=self._run, args=(app, jobs),
+                                          name='group-commit', daemon=True)
+                thread.start()
+                self._writers[app] = (os.getpid(), jobs, thread)
+            return jobs, thread
+
+    def _create_engine(self, app):
+        # Same database as the app, through a connection of our own
+        url = app.extensions['sqlalchemy'].db.get_engine(app).url
+        if url.drivername != 'sqlite':
+            return create_engine(url)
+        engine = create_engine(url, poolclass=StaticPool)
+        pragmas, _, _ = database.sqlite_profile(app)
+        if app.config['GROUP_COMMIT_SYNCHRONOUS'] is not None:
+            pragmas['synchronous'] = app.config['GROUP_COMMIT_SYNCHRONOUS']
+        event.listen(engine, 'connect', manual_transactions)
+        event.listen(engine, 'connect', partial(database.set_pragmas,
+                                                pragmas))
+        # Take the write lock up front rather than failing to upgrade a
+        # read lock half way through the batch
+        event.listen(engine, 'begin',
+                     lambda conn: conn.execute('BEGIN IMMEDIATE'))
+        return engine
+
+    def _run(self, app, jobs):
+        engine = None
+        with app.app_context():
+            window = app.config['GROUP_COMMIT_WINDOW']
+            max_batch = app.config['GROUP_COMMIT_MAX_BATCH']
+            try:
+                engine = self._create_engine(app)
+                while True:
+                    batch, stop = self._take(jobs, window, max_batch)
+                    if batch:
+                        self._commit(engine, batch)
+                    if stop:
+                        break
+            except Exception as e:
+                app.logger.exception("Group commit writer stopped")
+                self._fail(jobs, e)
+            finally:
+                if engine is not None:
+                    engine.dispose()
+
+    def _fail(self, jobs, error):
+        """Fail the units left in the queue of a dying writer"""
+        failures = 0
+        while True:
+            try:
+                job = jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job.error = error
+                failures += 1
+                job.done.set()
+        with self._lock:
+            self.failures += failures
+
+    def _take(self, jobs, window, max_batch):
+        """Wait for a unit, then gather the ones queued within the window.
+        Returns (batch, stop)"""
+        job = jobs.get()
+        if job is None:
+            return [], True
+        batch = [job]
+        deadline = time.monotonic() + window
+        while len(batch) < max_batch:
+            try:
+                job = jobs.get(
+                    timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if job is None:
+                return batch, True
+            batch.append(job)
+        return batch, False
+
+    def _commit(self, engine, batch):
+        failures = 0
+        try:
+            with engine.connect() as connection:
+                transaction = connection.begin()
+                session = Session(bind=connection)
+                try:
+                    for job in batch:
+                        savepoint = session.begin_nested()
+                        try:
+                            job.result = job.unit(session, *job.args)
+                            savepoint.commit()
+                        except Exception as e:
+                            savepoint.rollback()
+                            job.error = e
+                            failures += 1
+                    session.commit()
+                    transaction.commit()
+                except Exception:
+                    transaction.rollback()
+                    raise
+                finally:
+                    session.close()
+        except Exception as e:
+            for job in batch:
+                if job.error is None:
+                    job.error = e
+                    failures += 1
+        with self._lock:
+            self.batches += 1
+            self.units += len(batch)
+            self.failures += failures
+        for job in batch:
+            job.done.set()
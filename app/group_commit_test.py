@@ -0,0 +1,127 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from app import create_app
+from extensions import db, group_commit
+import models
+
+
+class GroupCommitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(
+                self.directory.name, 'group_commit.db'),
+            'GROUP_COMMIT_ENABLED': True,
+            'GROUP_COMMIT_WINDOW': 0.05,
+        })
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        group_commit.close()
+        with self.app.app_context():
+            db.get_engine().dispose()
+        self.directory.cleanup()
+
+    def post_concurrently(self, requests):
+        """Send (path, body) requests from one thread each, return the
+        response bodies in order"""
+        results = [None] * len(requests)
+
+        def send(i, path, body):
+            with self.app.test_client() as client:
+                results[i] = client.post(path, json=body).get_json()
+
+        threads = [threading.Thread(target=send, args=(i, path, body))
+                   for i, (path, body) in enumerate(requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_creates_share_transactions(self):
+        """Ensure each request gets its own result from a shared batch"""
+        batches = group_commit.stats()['batches']
+        emails = ["viewer%d@email.com" % i for i in range(20)]
+        results = self.post_concurrently(
+            [('/viewer/create', {'email': email}) for email in emails] +
+            [('/viewer/create', {'email': emails[0]})])
+
+        self.assertEqual(sorted(emails), sorted(
+            result['email'] for result in results if 'email' in result))
+        self.assertEqual([{"message": "Email already in use."}],
+                         [result for result in results
+                          if 'email' not in result])
+        self.assertEqual(sorted(range(1, 21)), sorted(
+            result['id'] for result in results if 'id' in result))
+        self.assertLess(group_commit.stats()['batches'] - batches, 21)
+        with self.app.app_context():
+            self.assertEqual(20, models.Viewer.query.count())
+
+    def test_failing_unit_only_rolls_back_itself(self):
+        """Ensure an error in one unit leaves the rest of the batch"""
+        def insert(session, email):
+            session.add(models.Viewer(email))
+            session.flush()
+            return email
+
+        def fail(session, email):
+            insert(session, email)
+            raise RuntimeError("unit failed")
+
+        results = [None] * 3
+
+        def submit(i, unit, email):
+            with self.app.app_context():
+                try:
+                    results[i] = group_commit.submit(unit, email)
+                except RuntimeError as e:
+                    results[i] = str(e)
+
+        threads = [threading.Thread(target=submit, args=args) for args in (
+            (0, insert, "a@email.com"), (1, fail, "b@email.com"),
+            (2, insert, "c@email.com"))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(["a@email.com", "unit failed", "c@email.com"],
+                         results)
+        with self.app.app_context():
+            self.assertEqual(["a@email.com", "c@email.com"], sorted(
+                viewer.email for viewer in models.Viewer.query))
+
+    def test_dead_writer_is_restarted(self):
+        """Ensure units fail rather than wait forever when the writer dies,
+        and the next one starts a new writer"""
+        def insert(session, email):
+            session.add(models.Viewer(email))
+            session.flush()
+            return email
+
+        with self.app.app_context():
+            with mock.patch.object(group_commit, '_create_engine',
+                                   side_effect=ValueError("no engine")):
+                with self.assertRaises((ValueError, RuntimeError)):
+                    group_commit.submit(insert, "a@email.com")
+            self.assertEqual("b@email.com",
+                             group_commit.submit(insert, "b@email.com"))
+            self.assertEqual(["b@email.com"], [
+                viewer.email for viewer in models.Viewer.query])
+
+    def test_disabled_by_default(self):
+        """Ensure writes are committed by the request itself by default"""
+        app = create_app({'TESTING': True})
+        with app.app_context():
+            self.assertFalse(group_commit.enabled)
+
+
+if __name__ == '__main__':
+    unittest.main()
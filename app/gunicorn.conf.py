@@ -0,0 +1,20 @@
+"""
+Gunicorn settings for running the API with several worker processes
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('MEETINGS_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('MEETINGS_WORKERS',
+                             multiprocessing.cpu_count() * 2 + 1))
+# More than one thread per worker switches to the gthread worker, which
+# lets GROUP_COMMIT_ENABLED batch the writes of concurrent requests
+threads = int(os.environ.get('MEETINGS_THREADS', 1))
+# Import and configure the app once in the master, then fork the workers
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Python < 3.7 has no os.register_at_fork
+    from database import dispose_engines
+    dispose_engines()
@@ -0,0 +1,112 @@
+"""
+Keyset pagination and streaming helpers for the list endpoints
+"""
+from flask import json
+from werkzeug.urls import url_encode
+
+PAGE_ARGS = ('limit', 'after', 'stream')
+STREAM_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class InvalidArgument(ValueError):
+    """Raised with the message to return for bad list arguments"""
+
+
+def wants_page(args):
+    """True if the request asked for a page or a stream"""
+    return any(arg in args for arg in PAGE_ARGS)
+
+
+def parse_page_args(args, key, max_limit):
+    """Return (after, limit, stream) from the query string.
+
+    `after` is converted to the type of the `key` column, `limit` is
+    required unless the response is streamed.
+    """
+    stream = args.get('stream')
+    if stream is not None and stream not in STREAM_FORMATS:
+        raise InvalidArgument("Invalid stream format.")
+
+    after = args.get('after')
+    if after is not None:
+        try:
+            after = key.type.python_type(after)
+        except ValueError:
+            raise InvalidArgument("Invalid cursor.")
+
+    limit = args.get('limit')
+    if limit is None:
+        if stream is None:
+            limit = max_limit
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise InvalidArgument("Invalid limit.")
+        if limit < 1 or (stream is None and limit > max_limit):
+            raise InvalidArgument("Invalid limit.")
+    return after, limit, stream
+
+
+def parse_fields(value, allowed):
+    """Return the requested subset of `allowed` field names, in the order
+    of `allowed`"""
+    names = set(name for name in value.split(',') if name)
+    if not names or not names.issubset(allowed):
+        raise InvalidArgument("Invalid fields.")
+    return tuple(name for name in allowed if name in names)
+
+
+def keyset(query, key, after=None, limit=None):
+    """Restrict `query` to the rows following `after` in `key` order"""
+    if after is not None:
+        query = query.filter(key > after)
+    query = query.order_by(key)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def next_link(base_url, args, after, limit):
+    """Build a RFC 5988 Link header value pointing at the next page"""
+    params = args.to_dict()
+    params['after'] = after
+    params['limit'] = limit
+    return '<%s?%s>; rel="next"' % (base_url, url_encode(params))
+
+
+def encode(item):
+    return json.dumps(item, separators=(',', ':'))
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def stream_json(items, ndjson=False, chunk_size=500):
+    """Encode `items` lazily as a JSON array or as NDJSON.
+
+    Items are grouped into chunks of `chunk_size` so the server does not
+    issue one write per row.
+    """
+    chunks = chunked((encode(item) for item in items), chunk_size)
+    if ndjson:
+        for chunk in chunks:
+            yield '\n'.join(chunk) + '\n'
+        return
+    yield '['
+    prefix = ''
+    for chunk in chunks:
+        yield prefix + ','.join(chunk)
+        prefix = ','
+    yield ']\n'
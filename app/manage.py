@@ -0,0 +1,10 @@
+"""
+Management commands, e.g. `python app/manage.py upgrade-db`
+"""
+from flask.cli import FlaskGroup
+from app import create_app
+
+cli = FlaskGroup(create_app=lambda: create_app())
+
+if __name__ == '__main__':
+    cli()
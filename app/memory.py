@@ -0,0 +1,219 @@
+"""
+In-memory storage backend: dicts of records and sorted per-key indexes
+"""
+from bisect import bisect_right, insort
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from heapq import merge
+from itertools import islice
+from storage import AccessRow, Repository
+import counters
+import purge
+import threading
+
+Viewer = namedtuple('Viewer', 'id email')
+Meeting = namedtuple('Meeting', 'id host_email password')
+Recording = namedtuple('Recording', 'url is_private meeting_id')
+
+
+def _integer(value):
+    """`value` as SQLite matches it against an integer column: numbers and
+    numeric strings of a whole number, None for anything else"""
+    if isinstance(value, int):
+        return int(value)
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return int(number) if number.is_integer() else None
+
+
+def _boolean(value):
+    """`value` as a Boolean column of SQLAlchemy stores it, which only
+    takes None, True, False, 0 and 1"""
+    if value not in (None, True, False):
+        raise TypeError("Not a boolean value: %r" % (value,))
+    return None if value is None else bool(value)
+
+
+def _after(keys, after, limit):
+    """Slice of the sorted list `keys` following `after`"""
+    start = 0 if after is None else bisect_right(keys, after)
+    return keys[start:None if limit is None else start + limit]
+
+
+class MemoryRepository(Repository):
+    """Repository keeping everything in the memory of the process.
+
+    Lookups are dict hits, lists and pages are slices of sorted key lists,
+    and the recordings a viewer can access come from per-viewer and
+    per-host indexes. Every operation holds one lock, so transactions run
+    one at a time, and nothing is persisted or shared between processes:
+    it suits a single process edge tier and the tests. Deleting a
+    recording removes it and its shares at once, there is no purge.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.RLock()
+        # Viewers by email and by id
+        self._viewers = {}
+        self._viewer_records = {}
+        self._meetings = {}
+        self._recordings = {}
+        # Sorted keys of the lists
+        self._viewer_ids = []
+        self._meeting_ids = []
+        self._urls = []
+        # url -> emails, email -> sorted urls
+        self._shares = {}
+        self._shared_with = {}
+        # host email -> meeting ids, meeting id -> private urls
+        self._hosted = {}
+        self._private = {}
+        # Named as the counters of the databases
+        self._counts = Counter()
+
+    @contextmanager
+    def transaction(self):
+        # Writes apply in place: units validate before writing anything
+        with self._lock:
+            yield self
+
+    def viewer(self, email):
+        return self._viewers.get(email)
+
+    def meeting(self, id):
+        return self._meetings.get(_integer(id))
+
+    def recording(self, url):
+        return self._recordings.get(url)
+
+    def recording_status(self, url):
+        return purge.ACTIVE if url in self._recordings else purge.PURGED
+
+    def is_shared(self, url, email):
+        with self._lock:
+            return email in self._shares.get(url, ())
+
+    def existing_emails(self, emails):
+        return {email for email in emails if email in self._viewers}
+
+    def recordings(self, urls):
+        with self._lock:
+            return {url: self._recordings[url] for url in urls
+                    if url in self._recordings}
+
+    def access_rows(self, urls):
+        with self._lock:
+            rows = {}
+            for url, recording in self.recordings(urls).items():
+                meeting = self._meetings[recording.meeting_id]
+                rows[url] = AccessRow(url, recording.is_private,
+                                      recording.meeting_id,
+                                      meeting.host_email, meeting.password)
+            return rows
+
+    def shared(self, urls, emails):
+        emails = set(emails)
+        with self._lock:
+            return {(url, email) for url in urls
+                    for email in self._shares.get(url, set()) & emails}
+
+    def rows(self, table, columns, ordered=False, after=None, limit=None,
+             chunk=None):
+        with self._lock:
+            records, keys = {
+                'meeting': (self._meetings, self._meeting_ids),
+                'recording': (self._recordings, self._urls),
+                'viewer': (self._viewer_records, self._viewer_ids),
+            }[table]
+            if ordered:
+                keys = _after(keys, after, limit)
+            else:
+                # Creation order
+                keys = list(records)
+            return [tuple(getattr(records[key], column)
+                          for column in columns) for key in keys]
+
+    def viewer_recordings(self, email, columns, after=None, limit=None,
+                          chunk=None):
+        with self._lock:
+            shared = _after(self._shared_with.get(email, []), after, limit)
+            hosted = _after(sorted(
+                url for id in self._hosted.get(email, ())
+                for url in self._private.get(id, ())), after, limit)
+            return [tuple(getattr(self._recordings[url], column)
+                          for column in columns)
+                    for url in islice(merge(shared, hosted), limit)]
+
+    def version(self, name):
+        return None
+
+    def versions(self, names):
+        return {}
+
+    def counters(self, names):
+        with self._lock:
+            return {name: self._counts[name] for name in names}
+
+    def add_viewer(self, email):
+        with self._lock:
+            viewer = Viewer(len(self._viewer_ids) + 1, email)
+            self._viewers[email] = self._viewer_records[viewer.id] = viewer
+            self._viewer_ids.append(viewer.id)
+            self._counts[counters.VIEWERS] += 1
+            return viewer
+
+    def add_meeting(self, host_email, password):
+        with self._lock:
+            meeting = Meeting(len(self._meeting_ids) + 1, host_email,
+                              password)
+            self._meetings[meeting.id] = meeting
+            self._meeting_ids.append(meeting.id)
+            self._hosted.setdefault(host_email, set()).add(meeting.id)
+            self._counts[counters.MEETINGS] += 1
+            return meeting
+
+    def add_recording(self, url, is_private, meeting_id):
+        is_private, meeting_id = _boolean(is_private), _integer(meeting_id)
+        with self._lock:
+            recording = Recording(url, is_private, meeting_id)
+            self._recordings[url] = recording
+            insort(self._urls, url)
+            host_email = None
+            if is_private:
+                self._private.setdefault(meeting_id, set()).add(url)
+                host_email = self._meetings[meeting_id].host_email
+            self._counts.update(counters.created(meeting_id, host_email))
+            return recording
+
+    def share_many(self, pairs):
+        pairs = list(pairs)
+        with self._lock:
+            for url, email in pairs:
+                self._shares.setdefault(url, set()).add(email)
+                insort(self._shared_with.setdefault(email, []), url)
+            self._counts.update(counters.shared(pairs))
+
+    def delete_recording(self, url):
+        with self._lock:
+            recording = self._recordings.pop(url)
+            del self._urls[bisect_right(self._urls, url) - 1]
+            self._private.get(recording.meeting_id, set()).discard(url)
+            emails = self._shares.pop(url, ())
+            for email in emails:
+                urls = self._shared_with[email]
+                del urls[bisect_right(urls, url) - 1]
+            self._counts.subtract(counters.shared(
+                (url, email) for email in emails))
+            host_email = None
+            if recording.is_private:
+                host_email = self._meetings[recording.meeting_id].host_email
+            self._counts.subtract(counters.created(recording.meeting_id,
+                                                   host_email))
+            del self._counts[counters.recording(url)]
+            return purge.PURGED
+
+    def record_many(self, events):
+        # No change feed without a database
+        pass
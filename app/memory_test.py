@@ -0,0 +1,64 @@
+import unittest
+from memory import MemoryRepository
+
+
+class MemoryRepositoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.repository = MemoryRepository()
+        with self.repository.transaction() as repository:
+            repository.add_viewer('host@email.com')
+            repository.add_viewer('viewer@email.com')
+            repository.add_meeting('viewer@email.com', 'hash')
+            for url in ('https://rec/c', 'https://rec/a', 'https://rec/e'):
+                repository.add_recording(url, False, 1)
+            for url in ('https://rec/d', 'https://rec/b'):
+                repository.add_recording(url, True, 1)
+            repository.share_many([('https://rec/e', 'viewer@email.com'),
+                                   ('https://rec/a', 'viewer@email.com'),
+                                   ('https://rec/c', 'viewer@email.com'),
+                                   ('https://rec/a', 'host@email.com')])
+
+    def urls(self, rows):
+        return [url for url, in rows]
+
+    def test_pages_in_key_order(self):
+        """Ensure pages follow the key whatever the creation order"""
+        rows = self.repository.rows
+        self.assertEqual(['https://rec/c', 'https://rec/a', 'https://rec/e',
+                          'https://rec/d', 'https://rec/b'],
+                         self.urls(rows('recording', ['url'])))
+        self.assertEqual(['https://rec/c', 'https://rec/d'], self.urls(rows(
+            'recording', ['url'], True, 'https://rec/b', 2)))
+        self.assertEqual([(2, 'viewer@email.com')],
+                         rows('viewer', ['id', 'email'], True, 1))
+
+    def test_viewer_recordings_merge_both_rules(self):
+        recordings = self.repository.viewer_recordings
+        self.assertEqual(['https://rec/a', 'https://rec/b', 'https://rec/c'],
+                         self.urls(recordings('viewer@email.com', ['url'],
+                                              limit=3)))
+        self.assertEqual(['https://rec/d', 'https://rec/e'],
+                         self.urls(recordings('viewer@email.com', ['url'],
+                                              'https://rec/c', 3)))
+        self.assertEqual(['https://rec/a'], self.urls(recordings(
+            'host@email.com', ['url'])))
+
+    def test_delete_updates_the_indexes(self):
+        with self.repository.transaction() as repository:
+            repository.delete_recording('https://rec/a')
+            repository.delete_recording('https://rec/b')
+        self.assertEqual(['https://rec/c', 'https://rec/d', 'https://rec/e'],
+                         self.urls(self.repository.rows('recording', ['url'],
+                                                        True)))
+        self.assertEqual(['https://rec/c', 'https://rec/d', 'https://rec/e'],
+                         self.urls(self.repository.viewer_recordings(
+                             'viewer@email.com', ['url'])))
+        self.assertEqual(set(), self.repository.shared(
+            ['https://rec/a'], ['host@email.com', 'viewer@email.com']))
+        self.assertEqual('purged',
+                         self.repository.recording_status('https://rec/a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+"""
+Per-route request, SQL and serialization metrics in Prometheus text format
+"""
+import threading
+import time
+from flask import Response, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Request latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+_listening = False
+
+
+class RequestStats(object):
+    """What one request spent, collected in `g` while it runs"""
+    __slots__ = ('start', 'status', 'sql_statements', 'sql_seconds',
+                 'serialization_seconds')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.status = 500
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.serialization_seconds = 0.0
+
+
+class RouteStats(object):
+    """Totals for one route since the process started"""
+    __slots__ = ('statuses', 'buckets', 'seconds', 'count', 'sql_statements',
+                 'sql_seconds', 'serialization_seconds')
+
+    def __init__(self):
+        self.statuses = {}
+        self.buckets = [0] * len(BUCKETS)
+        self.seconds = 0.0
+        self.count = 0
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.serialization_seconds = 0.0
+
+
+def current():
+    """Stats of the request being handled, or None"""
+    if has_app_context():
+        return g.get('request_stats')
+    return None
+
+
+def record_serialization(seconds):
+    stats = current()
+    if stats is not None:
+        stats.serialization_seconds += seconds
+
+
+# The start time is kept on the execution context of the statement, which
+# is dropped with it when the statement fails. Statements run without a
+# context (dialect internals) are not timed.
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = getattr(context, '_metrics_start', None)
+    stats = current()
+    if start is not None and stats is not None:
+        stats.sql_statements += 1
+        stats.sql_seconds += time.perf_counter() - start
+
+
+def listen_to_engines():
+    """Time every statement executed by any engine of the process"""
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+
+def _labels(**labels):
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace(
+        '\\', '\\\\').replace('"', '\\"')) for name, value in
+        sorted(labels.items())) + '}'
+
+
+class Metrics(object):
+    """Collects per-route metrics and serves them on /metrics.
+
+    Other components can add their own samples with `add_collector`.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._collectors = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.extensions['metrics'] = self
+        if not app.config['METRICS_ENABLED']:
+            return
+        listen_to_engines()
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+
+    def add_collector(self, collector):
+        """Register a callable returning (name, type, help, samples) tuples,
+        samples being a list of (labels dict, value)"""
+        self._collectors.append(collector)
+
+    def _before_request(self):
+        g.request_stats = RequestStats()
+
+    def _after_request(self, response):
+        stats = current()
+        if stats is not None:
+            stats.status = response.status_code
+        return response
+
+    def _teardown_request(self, exc):
+        # Runs once a streamed body has been sent as well
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return
+        elapsed = time.perf_counter() - stats.start
+        rule = request.url_rule
+        key = (rule.rule if rule is not None else 'unmatched',
+               request.method)
+        with self._lock:
+            route = self._routes.get(key)
+            if route is None:
+                route = self._routes[key] = RouteStats()
+            route.statuses[stats.status] = \
+                route.statuses.get(stats.status, 0) + 1
+            for i, bound in enumerate(BUCKETS):
+                if elapsed <= bound:
+                    route.buckets[i] += 1
+                    break
+            route.seconds += elapsed
+            route.count += 1
+            route.sql_statements += stats.sql_statements
+            route.sql_seconds += stats.sql_seconds
+            route.serialization_seconds += stats.serialization_seconds
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+    def render(self):
+        """The metrics in Prometheus text exposition format"""
+        with self._lock:
+            routes = sorted((key, self._copy(route))
+                            for key, route in self._routes.items())
+        lines = []
+
+        def family(name, kind, help):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        family('meetings_requests_total', 'counter',
+               'Requests handled, by route, method and status.')
+        for (rule, method), route in routes:
+            for status, count in sorted(route.statuses.items()):
+                lines.append('meetings_requests_total%s %d' % (_labels(
+                    route=rule, method=method, status=status), count))
+
+        family('meetings_request_duration_seconds', 'histogram',
+               'Request latency, including streamed bodies.')
+        for (rule, method), route in routes:
+            cumulative = 0
+            for bound, count in zip(BUCKETS, route.buckets):
+                cumulative += count
+                lines.append('meetings_request_duration_seconds_bucket%s %d'
+                             % (_labels(route=rule, method=method,
+                                        le=repr(bound)), cumulative))
+            labels = _labels(route=rule, method=method)
+            lines.append('meetings_request_duration_seconds_bucket%s %d' % (
+                _labels(route=rule, method=method, le='+Inf'), route.count))
+            lines.append('meetings_request_duration_seconds_sum%s %r' % (
+                labels, route.seconds))
+            lines.append('meetings_request_duration_seconds_count%s %d' % (
+                labels, route.count))
+
+        for name, attr, kind, help in (
+                ('meetings_sql_statements_total', 'sql_statements',
+                 'counter', 'SQL statements issued.'),
+                ('meetings_sql_duration_seconds_total', 'sql_seconds',
+                 'counter', 'Time spent executing SQL statements.'),
+                ('meetings_serialization_duration_seconds_total',
+                 'serialization_seconds', 'counter',
+                 'Time spent dumping objects with marshmallow schemas.')):
+            family(name, kind, help)
+            for (rule, method), route in routes:
+                lines.append('%s%s %r' % (name, _labels(
+                    route=rule, method=method), getattr(route, attr)))
+
+        for collector in self._collectors:
+            for name, kind, help, samples in collector():
+                family(name, kind, help)
+                for labels, value in samples:
+                    lines.append('%s%s %r' % (
+                        name, _labels(**labels) if labels else '', value))
+        return '\n'.join(lines) + '\n'
+
+    def view(self):
+        return Response(self.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    @staticmethod
+    def _copy(route):
+        copy = RouteStats()
+        for attr in RouteStats.__slots__:
+            value = getattr(route, attr)
+            setattr(copy, attr, value.copy() if hasattr(value, 'copy')
+                    else value)
+        return copy
@@ -0,0 +1,118 @@
+"""
+In-place, idempotent upgrades of existing databases to the current models
+"""
+from sqlalchemy import bindparam, inspect, select
+from sqlalchemy.schema import CreateColumn
+import counters
+import passwords
+
+
+def create_missing_tables(engine, metadata):
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    missing = [table for table in metadata.sorted_tables
+               if table.name not in existing]
+    metadata.create_all(engine, tables=missing)
+    return ["created table " + table.name for table in missing]
+
+
+def add_missing_columns(engine, metadata):
+    """Add the nullable columns of the models that existing tables lack"""
+    inspector = inspect(engine)
+    applied = []
+    for table in metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(
+            table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                    engine.dialect.identifier_preparer.format_table(table),
+                    CreateColumn(column).compile(dialect=engine.dialect)))
+                applied.append("added column %s.%s" % (table.name,
+                                                       column.name))
+    return applied
+
+
+def create_missing_indexes(engine, metadata):
+    inspector = inspect(engine)
+    applied = []
+    for table in metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(
+            table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                index.create(bind=engine)
+                applied.append("created index " + index.name)
+    return applied
+
+
+def recreate_changed_indexes(engine, metadata):
+    """Rebuild the indexes whose columns differ from the models'"""
+    inspector = inspect(engine)
+    applied = []
+    for table in metadata.sorted_tables:
+        existing = {index['name']: index['column_names']
+                    for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            columns = [column.name for column in index.columns]
+            if existing.get(index.name, columns) != columns:
+                index.drop(bind=engine)
+                index.create(bind=engine)
+                applied.append("recreated index " + index.name)
+    return applied
+
+
+# Steps run in order; each one only does what is still missing
+STEPS = [
+    create_missing_tables,
+    add_missing_columns,
+    create_missing_indexes,
+    recreate_changed_indexes,
+]
+
+
+def hash_plaintext_passwords(engine, metadata, iterations):
+    """Replace the plaintext meeting passwords of older databases by
+    hashes, in one transaction"""
+    table = metadata.tables['meeting']
+    with engine.begin() as connection:
+        rows = connection.execute(select([table.c.id, table.c.password]).where(
+            ~table.c.password.startswith(passwords.PREFIX))).fetchall()
+        if rows:
+            connection.execute(
+                table.update().where(table.c.id == bindparam('key')).values(
+                    password=bindparam('hash')),
+                [{'key': id,
+                  'hash': passwords.hash_password(password, iterations)}
+                 for id, password in rows])
+    return ["hashed %d meeting passwords" % len(rows)] if rows else []
+
+
+def fill_counters(engine, metadata, hosts=None):
+    """Recount the records behind the counters and fix those that are
+    missing or wrong, e.g. in databases from before the counters table or
+    from before a counter was kept. One transaction holding the write
+    lock, with the `hosts` of counters.count."""
+    with engine.begin() as connection:
+        connection.execute('BEGIN IMMEDIATE')
+        wrong = counters.recount(connection, metadata.tables, hosts)
+    return ["filled %d counters" % len(wrong)] if wrong else []
+
+
+def upgrade(engine, metadata,
+            password_iterations=passwords.DEFAULT_ITERATIONS, hosts=None):
+    """Bring the database behind `engine` up to date with `metadata`. The
+    hosts of the meetings of a shard are in another database, and given as
+    `hosts` ({meeting id: host email}).
+
+    Returns a description of every change that was made, so running it on
+    an up to date database returns an empty list.
+    """
+    applied = []
+    for step in STEPS:
+        applied.extend(step(engine, metadata))
+    # Data upgrades run once the schema is current
+    applied.extend(fill_counters(engine, metadata, hosts))
+    applied.extend(hash_plaintext_passwords(engine, metadata,
+                                            password_iterations))
+    return applied
@@ -0,0 +1,134 @@
+import os
+import tempfile
+import unittest
+from sqlalchemy import create_engine, inspect, select
+from werkzeug.security import check_password_hash
+from extensions import db
+import migrations
+import models
+import passwords
+
+
+class MigrationsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        """Create a database with the tables but none of the indexes"""
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            'sqlite:///' + os.path.join(self.directory.name, 'old.db'))
+        db.metadata.create_all(self.engine)
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(bind=self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_upgrade_adds_missing_indexes(self):
+        """Ensure the hot lookup columns get their indexes"""
+        applied = migrations.upgrade(self.engine, db.metadata)
+        self.assertEqual(["created index ix_changes_created",
+                          "created index ix_meeting_host_email",
+                          "created index ix_recording_deleted",
+                          "created index ix_recording_meeting_id",
+                          "created index ix_viewers_viewer_email"], applied)
+        indexes = inspect(self.engine).get_indexes('viewers')
+        self.assertEqual([['viewer_email', 'recording_url']],
+                         [index['column_names'] for index in indexes])
+
+    def test_upgrade_is_idempotent(self):
+        """Ensure upgrading an up to date database changes nothing"""
+        migrations.upgrade(self.engine, db.metadata)
+        self.assertEqual([], migrations.upgrade(self.engine, db.metadata))
+
+    def test_upgrade_recreates_changed_indexes(self):
+        """Ensure an index created with other columns is rebuilt"""
+        migrations.upgrade(self.engine, db.metadata)
+        self.engine.execute("DROP INDEX ix_viewers_viewer_email")
+        self.engine.execute("CREATE INDEX ix_viewers_viewer_email "
+                            "ON viewers (viewer_email)")
+        self.assertEqual(["recreated index ix_viewers_viewer_email"],
+                         migrations.upgrade(self.engine, db.metadata))
+        indexes = inspect(self.engine).get_indexes('viewers')
+        self.assertEqual([['viewer_email', 'recording_url']],
+                         [index['column_names'] for index in indexes])
+
+    def test_upgrade_hashes_plaintext_passwords(self):
+        """Ensure passwords of older databases are hashed, once"""
+        table = models.Meeting.__table__
+        self.engine.execute(table.insert(), [
+            {'host_email': 'host@email.com', 'password': 'pass'},
+            {'host_email': 'host@email.com',
+             'password': passwords.hash_password('other', 1000)}])
+        applied = migrations.upgrade(self.engine, db.metadata, 1000)
+        self.assertEqual("hashed 1 meeting passwords", applied[-1])
+        hashed = dict(self.engine.execute(
+            select([table.c.id, table.c.password])).fetchall())
+        self.assertTrue(check_password_hash(hashed[1], 'pass'))
+        self.assertTrue(check_password_hash(hashed[2], 'other'))
+        self.assertEqual([], migrations.upgrade(self.engine, db.metadata))
+
+    def test_upgrade_fills_counters(self):
+        """Ensure records of databases without counters are counted"""
+        models.counters.drop(bind=self.engine)
+        self.engine.execute(models.Meeting.__table__.insert(), {
+            'host_email': 'host@email.com', 'password': 'pass'})
+        self.engine.execute(models.Recording.__table__.insert(), [
+            {'url': 'https://a/', 'is_private': False, 'meeting_id': 1},
+            {'url': 'https://b/', 'is_private': False, 'meeting_id': 1}])
+        self.engine.execute(models.viewers.insert(), {
+            'recording_url': 'https://a/', 'viewer_email': 'v@email.com'})
+        applied = migrations.upgrade(self.engine, db.metadata, 1000)
+        self.assertEqual("created table counters", applied[0])
+        self.assertIn("filled 6 counters", applied)
+        self.assertEqual({'meetings': 1, 'recordings': 2, 'shares': 1,
+                          'meeting:1:recordings': 2,
+                          'recording:https://a/:shares': 1,
+                          'viewer:v@email.com:shares': 1},
+                         dict(self.engine.execute(
+                             select([models.counters])).fetchall()))
+        self.assertEqual([], migrations.upgrade(self.engine, db.metadata))
+
+    def test_upgrade_repairs_partly_filled_counters(self):
+        """Ensure counters missing from a table that has some, or wrong,
+        are recounted"""
+        migrations.upgrade(self.engine, db.metadata, 1000)
+        self.engine.execute(models.Meeting.__table__.insert(), {
+            'host_email': 'host@email.com', 'password': 'pass'})
+        self.engine.execute(models.Recording.__table__.insert(), {
+            'url': 'https://a/', 'is_private': True, 'meeting_id': 1})
+        self.engine.execute(models.counters.insert(), [
+            {'name': 'meetings', 'value': 1},
+            {'name': 'recordings', 'value': 5}])
+        applied = migrations.upgrade(self.engine, db.metadata, 1000)
+        self.assertIn("filled 3 counters", applied)
+        self.assertEqual({'meetings': 1, 'recordings': 1,
+                          'meeting:1:recordings': 1,
+                          'host:host@email.com:private': 1},
+                         dict(self.engine.execute(
+                             select([models.counters])).fetchall()))
+        self.assertEqual([], migrations.upgrade(self.engine, db.metadata))
+
+    def test_upgrade_adds_missing_columns(self):
+        """Ensure columns added to the models are added to their table,
+        keeping its rows"""
+        self.engine.execute("ALTER TABLE recording DROP COLUMN deleted")
+        self.engine.execute(models.Recording.__table__.insert(), {
+            'url': 'https://a/', 'is_private': False, 'meeting_id': 1})
+        applied = migrations.upgrade(self.engine, db.metadata)
+        self.assertEqual("added column recording.deleted", applied[0])
+        self.assertIn("created index ix_recording_deleted", applied)
+        self.assertEqual([('https://a/', None)], self.engine.execute(
+            "SELECT url, deleted FROM recording").fetchall())
+
+    def test_upgrade_creates_missing_tables(self):
+        """Ensure tables added to the models are created"""
+        models.viewers.drop(bind=self.engine)
+        applied = migrations.upgrade(self.engine, db.metadata)
+        self.assertEqual("created table viewers", applied[0])
+        self.assertNotIn("created index ix_viewers_viewer_email", applied)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,23 @@
-from app import db, ma
+from extensions import db, ma
+import metrics
+import re
+import time
+
+# Valid viewer emails
+EMAIL_REGEX = re.compile(
+    r"^[A-Za-z0-9\.\+_-]+@[A-Za-z0-9\._-]+\.[a-zA-Z]*$")
 
 # Meeting Class/Model
 
 
 class Meeting(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    host_email = db.Column(db.String(100), nullable=False)
-    password = db.Column(db.String(100), nullable=False)
+    host_email = db.Column(db.String(100), nullable=False, index=True)
+    # Salted hash, see passwords.py
+    password = db.Column(db.String(200), nullable=False)
+    # Shard the recordings of the meeting go to, with the sharded storage
+    # backend (see shardstorage.py)
+    shard = db.Column(db.Integer)
     recordings = db.relationship(
         'Recording', backref='meeting', lazy=True, uselist=False)
 
@@ -20,10 +31,18 @@ class Recording(db.Model):
     url = db.Column(db.String(255), primary_key=True)
     is_private = db.Column(db.Boolean, nullable=False)
     meeting_id = db.Column(db.Integer, db.ForeignKey('meeting.id'),
-                           nullable=False)
-
-    viewers = db.relationship('Viewer', secondary="viewers", lazy='subquery',
-                              backref=db.backref('recordings', lazy=True))
+                           nullable=False, index=True)
+    # Set when the recording is deleted. Deleted recordings are hidden
+    # from the API until purge.py removes their shares and the row.
+    deleted = db.Column(db.DateTime, index=True)
+
+    # Recordings can be shared with many viewers: never load the whole
+    # collection, and remove association rows with one DELETE (see
+    # purge.py) instead of loading them on delete
+    viewers = db.relationship('Viewer', secondary="viewers", lazy='dynamic',
+                              passive_deletes=True,
+                              backref=db.backref('recordings',
+                                                 lazy='dynamic'))
 
     def __init__(self, url, is_private, meeting_id):
         self.url = url
@@ -46,22 +65,72 @@ viewers = db.Table('viewers',
                    db.Column('recording_url', db.String(255),
                              db.ForeignKey('recording.url'), primary_key=True),
                    db.Column('viewer_email', db.String(100),
-                             db.ForeignKey('viewer.email'), primary_key=True)
+                             db.ForeignKey('viewer.email'), primary_key=True),
+                   # The primary key leads with recording_url, so lookups
+                   # by viewer need their own index. It is ordered by url
+                   # too, so a viewer's recordings page by range scan.
+                   db.Index('ix_viewers_viewer_email', 'viewer_email',
+                            'recording_url')
+                   )
+
+# Shard of every recording of the sharded storage backend, in the main
+# database, see shardstorage.py. The primary key keeps urls unique across
+# the shards.
+recording_shards = db.Table('recording_shards',
+                            db.Column('url', db.String(255),
+                                      primary_key=True),
+                            db.Column('shard', db.Integer, nullable=False)
+                            )
+
+# Version counters of tables and rows, see versions.py
+versions = db.Table('versions',
+                    db.Column('name', db.String(300), primary_key=True),
+                    db.Column('version', db.Integer, nullable=False),
+                    db.Column('modified', db.DateTime, nullable=False)
+                    )
+
+# Counts of viewers, meetings, recordings and shares, see counters.py
+counters = db.Table('counters',
+                    db.Column('name', db.String(300), primary_key=True),
+                    db.Column('value', db.Integer, nullable=False)
+                    )
+
+# Create, delete and share events, see changes.py. AUTOINCREMENT keeps
+# sequence numbers from being reused once the last events are pruned.
+changes = db.Table('changes',
+                   db.Column('seq', db.Integer, primary_key=True),
+                   db.Column('event', db.String(30), nullable=False),
+                   db.Column('data', db.Text, nullable=False),
+                   db.Column('created', db.DateTime, nullable=False,
+                             index=True),
+                   sqlite_autoincrement=True
                    )
 
 
 # Schemas
-class MeetingSchema(ma.Schema):
+class TimedSchema(ma.Schema):
+    """Schema reporting the time spent dumping to the request metrics"""
+
+    def dump(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super(TimedSchema, self).dump(*args, **kwargs)
+        finally:
+            metrics.record_serialization(time.perf_counter() - start)
+
+
+# The password hash is never sent back
+class MeetingSchema(TimedSchema):
     class Meta:
-        fields = ('id', 'host_email', 'password')
+        fields = ('id', 'host_email')
 
 
-class RecordingSchema(ma.Schema):
+class RecordingSchema(TimedSchema):
     class Meta:
         fields = ('url', 'is_private', 'meeting_id')
 
 
-class ViewerSchema(ma.Schema):
+class ViewerSchema(TimedSchema):
     class Meta:
         fields = ('id', 'email')
 
@@ -0,0 +1,104 @@
+"""
+Salted PBKDF2 hashes of meeting passwords, and a cache of verified ones
+"""
+from collections import OrderedDict
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+import hashlib
+import threading
+
+# Werkzeug's default cost, about 90 ms per hash on a single core
+DEFAULT_ITERATIONS = 150000
+PREFIX = 'pbkdf2:'
+
+
+def hash_password(password, iterations=DEFAULT_ITERATIONS):
+    return generate_password_hash(
+        password, 'pbkdf2:sha256:%d' % iterations, salt_length=16)
+
+
+def is_hashed(value):
+    """Tell hashes from the plaintext passwords of older databases"""
+    return value.startswith(PREFIX)
+
+
+class CredentialCache(object):
+    """Bounded LRU cache of meeting passwords verified against their hash.
+
+    Only successful checks are remembered, keyed on the meeting id and a
+    digest of the stored hash and the password: changing the password
+    changes the hash, so stale entries are never hit and age out.
+    """
+
+    def __init__(self, app=None, maxsize=1024,
+                 iterations=DEFAULT_ITERATIONS):
+        self.maxsize = maxsize
+        # Default of PASSWORD_HASH_ITERATIONS
+        self.iterations = iterations
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_ITERATIONS', self.iterations)
+        app.config.setdefault('CREDENTIAL_CACHE_SIZE', self.maxsize)
+        self.maxsize = app.config['CREDENTIAL_CACHE_SIZE']
+        app.extensions['credential_cache'] = self
+
+    def hash(self, password):
+        """Hash a new password with the cost of the current app"""
+        return hash_password(
+            password, current_app.config['PASSWORD_HASH_ITERATIONS'])
+
+    def verify(self, meeting_id, password, stored):
+        """Check `password` against the `stored` hash of a meeting"""
+        if not isinstance(password, str) or not is_hashed(stored):
+            return False
+        digest = hashlib.sha256(
+            (stored + '\0' + password).encode('utf-8')).digest()
+        key = (meeting_id, digest)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+        # The key derivation runs without the lock
+        if not check_password_hash(stored, password):
+            return False
+        if self.maxsize > 0:
+            with self._lock:
+                self._entries[key] = True
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def collect(self):
+        """Counters in the format expected by Metrics.add_collector"""
+        stats = self.stats()
+        return [
+            ('meetings_credential_cache_entries', 'gauge',
+             'Verified meeting passwords currently cached.',
+             [({}, stats['size'])]),
+            ('meetings_credential_cache_hits_total', 'counter',
+             'Password checks answered without hashing.',
+             [({}, stats['hits'])]),
+            ('meetings_credential_cache_misses_total', 'counter',
+             'Password checks that ran the key derivation.',
+             [({}, stats['misses'])]),
+        ]
@@ -0,0 +1,46 @@
+import unittest
+from passwords import CredentialCache, hash_password, is_hashed
+
+
+class CredentialCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = CredentialCache(maxsize=2)
+        self.stored = hash_password("pass", 1000)
+
+    def test_hash_is_salted(self):
+        """Ensure the same password gets a different hash every time"""
+        self.assertTrue(is_hashed(self.stored))
+        self.assertNotEqual(self.stored, hash_password("pass", 1000))
+
+    def test_verified_password_skips_hashing(self):
+        """Ensure a repeated check is answered from the cache"""
+        self.assertTrue(self.cache.verify(1, "pass", self.stored))
+        self.assertTrue(self.cache.verify(1, "pass", self.stored))
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_wrong_password_is_not_cached(self):
+        self.assertFalse(self.cache.verify(1, "wrong", self.stored))
+        self.assertFalse(self.cache.verify(1, "wrong", self.stored))
+        self.assertEqual(0, self.cache.stats()['size'])
+
+    def test_changed_password_is_not_hit(self):
+        """Ensure a cached password stops working once the hash changes"""
+        self.assertTrue(self.cache.verify(1, "pass", self.stored))
+        self.assertFalse(self.cache.verify(1, "pass",
+                                           hash_password("new", 1000)))
+
+    def test_plaintext_is_never_accepted(self):
+        self.assertFalse(self.cache.verify(1, "pass", "pass"))
+        self.assertFalse(self.cache.verify(1, None, self.stored))
+
+    def test_least_recently_used_is_evicted(self):
+        for meeting_id in (1, 2, 3):
+            self.cache.verify(meeting_id, "pass", self.stored)
+        self.assertEqual(2, self.cache.stats()['size'])
+
+
+if __name__ == '__main__':
+    unittest.main()
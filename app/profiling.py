@@ -0,0 +1,229 @@
+"""
+Opt-in profiling of sampled requests: cProfile stats, SQL statements and
+their query plans written to files
+"""
+import cProfile
+import hmac
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Suffixes of the files written for each profiled request
+STATS = '.pstats'
+REPORT = '.json'
+
+_listening = False
+
+
+class RequestProfile(object):
+    """What is collected while one sampled request runs"""
+    __slots__ = ('name', 'profiler', 'start', 'statements', 'status')
+
+    def __init__(self, name):
+        self.name = name
+        self.profiler = cProfile.Profile()
+        self.start = time.perf_counter()
+        # (engine, statement, parameters, seconds)
+        self.statements = []
+        self.status = 500
+
+
+def current():
+    """Profile of the request being handled, or None"""
+    if has_app_context():
+        return g.get('request_profile')
+    return None
+
+
+# Like metrics.py, the start time is kept on the execution context, so a
+# failed statement does not leave it behind on the connection
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None and current() is not None:
+        context._profile_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    profile = current()
+    start = getattr(context, '_profile_start', None)
+    if profile is not None and start is not None:
+        seconds = time.perf_counter() - start
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+        profile.statements.append((conn.engine, statement, parameters,
+                                   seconds))
+
+
+def listen_to_engines():
+    """Time the statements of profiled requests on every engine"""
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+
+def query_plan(engine, statement, parameters):
+    """Rows of EXPLAIN QUERY PLAN for a SELECT run on SQLite, else None"""
+    if engine.dialect.name != 'sqlite' or \
+            not statement.lstrip().upper().startswith('SELECT'):
+        return None
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        plan = [list(row) for row in cursor.fetchall()]
+        cursor.close()
+        return plan
+    except Exception as e:
+        return [str(e)]
+    finally:
+        connection.close()
+
+
+class RequestProfiler(object):
+    """Profiles the requests asking for it with PROFILE_HEADER set to
+    PROFILE_TOKEN, and a PROFILE_SAMPLE_RATE fraction of the others.
+
+    Each profiled request leaves two files in PROFILE_DIR: the cProfile
+    stats of its thread (`.pstats`, for pstats, snakeviz or flameprof) and
+    a report (`.json`) of its SQL statements with their durations and query
+    plans. The response names them in the PROFILE_HEADER header. Only the
+    last PROFILE_KEEP requests are kept. With PROFILE_ENABLED off nothing
+    is registered, so requests do not pay for it.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._sequence = itertools.count(1)
+        self.profiles = 0
+        self.failures = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILE_ENABLED', False)
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILE_HEADER', 'X-Profile')
+        app.config.setdefault('PROFILE_TOKEN', None)
+        app.config.setdefault('PROFILE_ENDPOINTS', None)
+        app.config.setdefault('PROFILE_DIR', 'profiles')
+        app.config.setdefault('PROFILE_KEEP', 200)
+        app.extensions['profiler'] = self
+        if not app.config['PROFILE_ENABLED']:
+            return
+        listen_to_engines()
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def directory(self, app):
+        return os.path.join(app.root_path, app.config['PROFILE_DIR'])
+
+    def _wanted(self, config):
+        endpoints = config['PROFILE_ENDPOINTS']
+        if endpoints is not None and request.endpoint not in endpoints:
+            return False
+        token = request.headers.get(config['PROFILE_HEADER'])
+        if token is not None and config['PROFILE_TOKEN'] is not None:
+            return hmac.compare_digest(token, config['PROFILE_TOKEN'])
+        return random.random() < config['PROFILE_SAMPLE_RATE']
+
+    def _before_request(self):
+        if not self._wanted(current_app.config):
+            return
+        name = '%s-%d-%06d-%s' % (
+            time.strftime('%Y%m%dT%H%M%S', time.gmtime()), os.getpid(),
+            next(self._sequence), request.endpoint or 'unmatched')
+        profile = g.request_profile = RequestProfile(name)
+        profile.profiler.enable()
+
+    def _after_request(self, response):
+        profile = current()
+        if profile is not None:
+            profile.status = response.status_code
+            response.headers[current_app.config['PROFILE_HEADER']] = \
+                profile.name
+        return response
+
+    def _teardown_request(self, exc):
+        # Runs once a streamed body has been sent as well
+        profile = g.pop('request_profile', None)
+        if profile is None:
+            return
+        profile.profiler.disable()
+        elapsed = time.perf_counter() - profile.start
+        try:
+            self._write(current_app._get_current_object(), profile, elapsed)
+        except Exception:
+            current_app.logger.exception("Writing profile %s failed",
+                                         profile.name)
+            with self._lock:
+                self.failures += 1
+        else:
+            with self._lock:
+                self.profiles += 1
+
+    def _write(self, app, profile, elapsed):
+        directory = self.directory(app)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, profile.name)
+        profile.profiler.dump_stats(path + STATS)
+        # Plans are asked for once the request is over, once per statement
+        plans = {}
+        statements = []
+        for engine, statement, parameters, seconds in profile.statements:
+            if statement not in plans:
+                plans[statement] = query_plan(engine, statement, parameters)
+            statements.append({
+                'database': str(engine.url),
+                'statement': statement,
+                'parameters': [repr(value) for value in parameters],
+                'ms': seconds * 1000,
+                'plan': plans[statement],
+            })
+        with open(path + REPORT, 'w') as f:
+            json.dump({
+                'method': request.method,
+                'path': request.full_path,
+                'endpoint': request.endpoint,
+                'status': profile.status,
+                'ms': elapsed * 1000,
+                'sql_ms': sum(item['ms'] for item in statements),
+                'statements': statements,
+            }, f, indent=1)
+        self._prune(directory, app.config['PROFILE_KEEP'])
+
+    def _prune(self, directory, keep):
+        # Names start with the time, oldest sort first
+        names = sorted(name[:-len(REPORT)] for name in os.listdir(directory)
+                       if name.endswith(REPORT))
+        for name in names[:max(len(names) - keep, 0)]:
+            for suffix in (STATS, REPORT):
+                try:
+                    os.remove(os.path.join(directory, name + suffix))
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {'profiles': self.profiles, 'failures': self.failures}
+
+    def collect(self):
+        """Counters in the format expected by Metrics.add_collector"""
+        stats = self.stats()
+        return [
+            ('meetings_profiles_total', 'counter',
+             'Requests profiled and written to PROFILE_DIR.',
+             [({}, stats['profiles'])]),
+            ('meetings_profile_failures_total', 'counter',
+             'Profiles that could not be written.',
+             [({}, stats['failures'])]),
+        ]
@@ -0,0 +1,115 @@
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+from app import create_app
+from extensions import db, profiler
+from flask import g
+from profiling import RequestProfile
+from sqlalchemy.exc import OperationalError
+
+
+class RequestProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_app(self, **config):
+        settings = {
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(
+                self.directory, 'test.db'),
+            'PASSWORD_HASH_ITERATIONS': 1000,
+            'PROFILE_ENABLED': True,
+            'PROFILE_TOKEN': 'secret',
+            'PROFILE_DIR': os.path.join(self.directory, 'profiles'),
+        }
+        settings.update(config)
+        app = create_app(settings)
+        with app.app_context():
+            db.create_all()
+        return app
+
+    def reports(self):
+        directory = os.path.join(self.directory, 'profiles')
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name for name in os.listdir(directory)
+                      if name.endswith('.json'))
+
+    def test_disabled_registers_nothing(self):
+        """Ensure requests pay nothing for the profiler when it is off"""
+        app = self.create_app(PROFILE_ENABLED=False)
+        for functions in (app.before_request_funcs,
+                          app.after_request_funcs,
+                          app.teardown_request_funcs):
+            for function in functions.get(None, ()):
+                self.assertIsNot(profiler, getattr(function, '__self__',
+                                                   None))
+        rv = app.test_client().get('/viewer/get',
+                                   headers={'X-Profile': 'secret'})
+        self.assertNotIn('X-Profile', rv.headers)
+        self.assertEqual([], self.reports())
+
+    def test_header_profiles_the_request(self):
+        app = self.create_app()
+        client = app.test_client()
+        client.post('/viewer/create', json={'email': 'test@email.com'})
+        rv = client.get('/viewer/recordings?email=test@email.com',
+                        headers={'X-Profile': 'secret'})
+        name = rv.headers['X-Profile']
+        self.assertEqual([name + '.json'], self.reports())
+
+        path = os.path.join(self.directory, 'profiles', name)
+        stats = pstats.Stats(path + '.pstats')
+        self.assertTrue(any(function == 'get_viewer_recordings'
+                            for _, _, function in stats.stats))
+        with open(path + '.json') as f:
+            report = json.load(f)
+        self.assertEqual('api.get_viewer_recordings', report['endpoint'])
+        self.assertEqual(200, report['status'])
+        plans = [' '.join(str(column) for column in row)
+                 for statement in report['statements']
+                 for row in statement['plan'] or ()]
+        self.assertTrue(any('USING' in row and 'INDEX' in row
+                            for row in plans))
+
+    def test_wrong_token_is_ignored(self):
+        app = self.create_app()
+        rv = app.test_client().get('/viewer/get',
+                                   headers={'X-Profile': 'guess'})
+        self.assertNotIn('X-Profile', rv.headers)
+        self.assertEqual([], self.reports())
+
+    def test_sampling_is_limited_to_endpoints(self):
+        app = self.create_app(PROFILE_SAMPLE_RATE=1.0, PROFILE_KEEP=2,
+                              PROFILE_ENDPOINTS=['api.get_viewers'])
+        client = app.test_client()
+        client.get('/meeting/get')
+        names = [client.get('/viewer/get').headers['X-Profile']
+                 for _ in range(3)]
+        # Only the last PROFILE_KEEP are kept
+        self.assertEqual([name + '.json' for name in names[1:]],
+                         self.reports())
+
+    def test_failed_statements_leave_nothing_behind(self):
+        app = self.create_app()
+        with app.app_context():
+            profile = g.request_profile = RequestProfile('test')
+            with db.engine.connect() as connection:
+                for _ in range(3):
+                    with self.assertRaises(OperationalError):
+                        connection.execute('SELECT * FROM missing')
+                connection.execute('SELECT 1')
+                self.assertFalse(connection.info.get('profile_start'))
+        self.assertEqual(['SELECT 1'], [statement for _, statement, _, _
+                                        in profile.statements])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+"""
+Background purge of the shares of deleted recordings
+"""
+from flask import current_app
+from sqlalchemy import and_, select
+import counters
+import os
+import threading
+import time
+import weakref
+
+# Values of the status field of deleted recordings
+ACTIVE = 'active'
+PURGING = 'purging'
+PURGED = 'purged'
+
+
+class RecordingPurge(object):
+    """Deletes the shares of tombstoned recordings in small transactions.
+
+    Deleting a recording only sets its `deleted` column, which hides it
+    from the API at once. The shares are then removed RECORDING_PURGE_BATCH
+    rows per transaction, pausing RECORDING_PURGE_PAUSE seconds between
+    transactions so other writers get the database lock, and the recording
+    row goes last. Each batch takes the shares it removes off the counter
+    of the recording; its viewers and host dropped it from theirs when it
+    was deleted (see counters.py). Each process
+    runs one worker thread, woken by `schedule` and every
+    RECORDING_PURGE_INTERVAL seconds to pick up the recordings other
+    processes left behind.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        # app -> (pid, wake, stop, thread) of its worker
+        self._workers = weakref.WeakKeyDictionary()
+        self.batches = 0
+        self.shares = 0
+        self.recordings = 0
+        self.failures = 0
+        self._callbacks = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RECORDING_PURGE_WORKER', True)
+        app.config.setdefault('RECORDING_PURGE_BATCH', 500)
+        app.config.setdefault('RECORDING_PURGE_PAUSE', 0.01)
+        app.config.setdefault('RECORDING_PURGE_INTERVAL', 60.0)
+        app.extensions['recording_purge'] = self
+
+    def on_purged(self, callback):
+        """Call `callback(session, url)` once the row of the recording
+        `url` is deleted from the database of `session`"""
+        self._callbacks.append(callback)
+
+    def schedule(self):
+        """Wake the worker of the current app after a recording was
+        deleted. Without a worker, `purge_pending` has to be run."""
+        if current_app.config['RECORDING_PURGE_WORKER']:
+            self._worker(current_app._get_current_object()).set()
+
+    def purge_pending(self, session):
+        """Purge every deleted recording, oldest first. Returns the number
+        of recordings removed."""
+        recording = self._table().c
+        urls = [url for url, in session.execute(select(
+            [recording.url]).where(recording.deleted.isnot(None)).order_by(
+            recording.deleted))]
+        session.commit()
+        for url in urls:
+            self.purge(session, url)
+        return len(urls)
+
+    def purge(self, session, url):
+        """Delete the shares of the deleted recording `url`, one batch per
+        transaction, then the recording itself"""
+        config = current_app.config
+        table = self._table().metadata.tables['viewers']
+        shares = table.c
+        while True:
+            # Under the write lock, so that the counters are only taken off
+            # once when the workers of two processes purge the same url
+            session.execute('BEGIN IMMEDIATE')
+            emails = [email for email, in session.execute(
+                select([shares.viewer_email]).where(
+                    shares.recording_url == url).limit(
+                    config['RECORDING_PURGE_BATCH']))]
+            count = 0
+            if emails:
+                count = session.execute(table.delete().where(and_(
+                    shares.recording_url == url,
+                    shares.viewer_email.in_(emails)))).rowcount
+                counters.add(session, {counters.recording(url): -len(emails)})
+            session.commit()
+            with self._lock:
+                self.batches += 1
+                self.shares += count
+            if count < config['RECORDING_PURGE_BATCH']:
+                break
+            time.sleep(config['RECORDING_PURGE_PAUSE'])
+        # The API stopped showing the recording when it was deleted, so
+        # removing the row leaves the versions alone
+        recording = self._table()
+        purged = session.execute(recording.delete().where(and_(
+            recording.c.url == url,
+            recording.c.deleted.isnot(None)))).rowcount
+        if purged:
+            counters.delete(session, [counters.recording(url)])
+            with self._lock:
+                self.recordings += 1
+        session.commit()
+        if purged:
+            for callback in self._callbacks:
+                callback(session, url)
+
+    def sessions(self, app):
+        """Sessions of the databases holding recordings: the database of
+        `app` and its shards, if any (see shards.py)"""
+        sessions = [app.extensions['sqlalchemy'].db.session]
+        if app.config.get('SHARD_DATABASE_URIS'):
+            sessions.extend(app.extensions['shards'].sessions(app))
+        return sessions
+
+    def close(self):
+        """Stop the worker threads once their current purge is done"""
+        with self._lock:
+            workers = list(self._workers.values())
+            self._workers.clear()
+        for pid, wake, stop, thread in workers:
+            if pid == os.getpid():
+                stop.set()
+                wake.set()
+                thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'shares': self.shares,
+                'recordings': self.recordings,
+                'failures': self.failures,
+            }
+
+    def collect(self):
+        """Counters in the format expected by Metrics.add_collector"""
+        stats = self.stats()
+        return [
+            ('meetings_recording_purge_batches_total', 'counter',
+             'Transactions run by the recording purge.',
+             [({}, stats['batches'])]),
+            ('meetings_recording_purge_shares_total', 'counter',
+             'Shares of deleted recordings removed by the purge.',
+             [({}, stats['shares'])]),
+            ('meetings_recording_purge_recordings_total', 'counter',
+             'Deleted recordings whose purge finished.',
+             [({}, stats['recordings'])]),
+            ('meetings_recording_purge_failures_total', 'counter',
+             'Purge runs that failed and were left for the next one.',
+             [({}, stats['failures'])]),
+        ]
+
+    def _table(self):
+        return current_app.extensions['sqlalchemy'].db.metadata.tables[
+            'recording']
+
+    def _worker(self, app):
+        # Threads do not survive a fork, each worker process starts its own
+        with self._lock:
+            pid, wake, stop, thread = self._workers.get(
+                app, (None, None, None, None))
+            if pid != os.getpid():
+                wake, stop = threading.Event(), threading.Event()
+                thread = threading.Thread(target=self._run,
+                                          args=(app, wake, stop),
+                                          name='recording-purge', daemon=True)
+                thread.start()
+                self._workers[app] = (os.getpid(), wake, stop, thread)
+            return wake
+
+    def _run(self, app, wake, stop):
+        with app.app_context():
+            while not stop.is_set():
+                wake.clear()
+                for session in self.sessions(app):
+                    try:
+                        self.purge_pending(session)
+                    except Exception:
+                        app.logger.exception(
+                            "Purge of deleted recordings failed")
+                        session.rollback()
+                        with self._lock:
+                            self.failures += 1
+                    finally:
+                        session.remove()
+                wake.wait(app.config['RECORDING_PURGE_INTERVAL'])
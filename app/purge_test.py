@@ -0,0 +1,88 @@
+import os
+import tempfile
+import time
+import unittest
+from app import create_app
+from extensions import db, recording_purge
+import models
+
+
+class RecordingPurgeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(
+                self.directory.name, 'purge.db'),
+            'PASSWORD_HASH_ITERATIONS': 1000,
+            'RECORDING_PURGE_BATCH': 10,
+            'RECORDING_PURGE_PAUSE': 0,
+        })
+        with self.app.app_context():
+            db.create_all()
+        self.client = self.app.test_client()
+        self.client.post('/viewer/create', json={'email': 'host@email.com'})
+        self.client.post('/meeting/create', json={'host_email':
+                                                  'host@email.com',
+                                                  'password': 'pass'})
+        self.client.post('/recording/create', json={'url': 'https://a/',
+                                                    'is_private': False,
+                                                    'meeting_id': 1})
+        with self.app.app_context():
+            db.session.execute(models.Viewer.__table__.insert(), [
+                {'email': 'viewer%d@email.com' % i} for i in range(25)])
+            db.session.execute(models.viewers.insert(), [
+                {'recording_url': 'https://a/',
+                 'viewer_email': 'viewer%d@email.com' % i}
+                for i in range(25)])
+            db.session.commit()
+
+    def tearDown(self):
+        recording_purge.close()
+        with self.app.app_context():
+            db.get_engine().dispose()
+        self.directory.cleanup()
+
+    def status(self):
+        return self.client.get(
+            '/recording/delete/status/https://a/').get_json()['status']
+
+    def test_worker_purges_in_the_background(self):
+        """Ensure the worker removes the shares and the recording after the
+        delete request returned"""
+        before = recording_purge.stats()
+        rv = self.client.delete('/recording/delete',
+                                json={'url': 'https://a/'})
+        self.assertEqual('purging', rv.get_json()['status'])
+        deadline = time.monotonic() + 5
+        while self.status() != 'purged' and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual('purged', self.status())
+        with self.app.app_context():
+            self.assertEqual(0, db.session.query(models.viewers).count())
+        after = recording_purge.stats()
+        self.assertEqual(3, after['batches'] - before['batches'])
+        self.assertEqual(25, after['shares'] - before['shares'])
+        self.assertEqual(1, after['recordings'] - before['recordings'])
+
+    def test_active_status(self):
+        self.assertEqual('active', self.status())
+
+    def test_purge_command(self):
+        """Ensure purge-recordings purges without a worker"""
+        self.app.config['RECORDING_PURGE_WORKER'] = False
+        self.client.delete('/recording/delete', json={'url': 'https://a/'})
+        self.assertEqual('purging', self.status())
+        result = self.app.test_cli_runner().invoke(
+            args=['purge-recordings'])
+        self.assertIn("Purged 1 recordings.", result.output)
+        self.assertEqual('purged', self.status())
+
+    def test_metrics(self):
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('meetings_recording_purge_shares_total', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
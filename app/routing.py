@@ -0,0 +1,68 @@
+"""
+Routing of read-only requests to a separate read engine
+"""
+from functools import wraps
+from flask import current_app, g, request
+from database import READ_BIND
+import math
+import time
+
+UNSAFE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+class ReadRouting(object):
+    """Sends the queries of views decorated with `read_only` to the engine
+    of SQLALCHEMY_READ_DATABASE_URI, e.g. a replica of the database file.
+
+    A client that sent a write keeps reading from the primary for
+    READ_YOUR_WRITES_WINDOW seconds, remembered in a cookie, so it sees
+    its own writes even if the replica lags behind.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_READ_DATABASE_URI', None)
+        app.config.setdefault('READ_YOUR_WRITES_WINDOW', 5.0)
+        app.config.setdefault('READ_YOUR_WRITES_COOKIE', 'meetings_wrote')
+        uri = app.config['SQLALCHEMY_READ_DATABASE_URI']
+        if uri is not None:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds[READ_BIND] = uri
+            app.config['SQLALCHEMY_BINDS'] = binds
+            app.after_request(self._after_request)
+        app.extensions['read_routing'] = self
+
+    def read_only(self, view):
+        """Decorate a view that never writes to use the read engine"""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            g.read_only = not self._wrote_recently()
+            return view(*args, **kwargs)
+        return wrapper
+
+    def routed(self):
+        """Tell whether the queries of the current request go to the read
+        engine, whose data may lag behind the primary's"""
+        return bool(g.get('read_only')) and READ_BIND in (
+            current_app.config['SQLALCHEMY_BINDS'] or ())
+
+    def _wrote_recently(self):
+        value = request.cookies.get(
+            current_app.config['READ_YOUR_WRITES_COOKIE'])
+        try:
+            return value is not None and float(value) > time.time()
+        except ValueError:
+            return False
+
+    def _after_request(self, response):
+        if request.method in UNSAFE_METHODS and 'read_only' not in g:
+            window = current_app.config['READ_YOUR_WRITES_WINDOW']
+            if window:
+                response.set_cookie(
+                    current_app.config['READ_YOUR_WRITES_COOKIE'],
+                    '%.3f' % (time.time() + window),
+                    max_age=int(math.ceil(window)), httponly=True)
+        return response
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from app import create_app
+from extensions import access_cache, db
+import models
+
+
+class ReadRoutingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.primary = 'sqlite:///' + self.path('primary.db')
+        self.replica = 'sqlite:///' + self.path('replica.db')
+        # The replica is a separate, initially empty copy of the schema
+        engine = create_engine(self.replica)
+        db.Model.metadata.create_all(engine)
+        engine.dispose()
+        self.app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': self.primary,
+            'SQLALCHEMY_READ_DATABASE_URI': self.replica,
+        })
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.get_engine().dispose()
+            db.get_engine(bind='read').dispose()
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_reads_use_the_replica(self):
+        """Ensure a client that did not write reads from the replica"""
+        writer = self.app.test_client()
+        writer.post('/viewer/create', json={'email': 'viewer@email.com'})
+
+        reader = self.app.test_client()
+        self.assertEqual([], reader.get('/viewer/get').get_json())
+
+    def test_read_your_writes(self):
+        """Ensure a client reads from the primary right after a write"""
+        client = self.app.test_client()
+        response = client.post('/viewer/create',
+                               json={'email': 'viewer@email.com'})
+        self.assertIn('meetings_wrote', response.headers['Set-Cookie'])
+        self.assertEqual(['viewer@email.com'], [
+            viewer['email'] for viewer in client.get('/viewer/get').get_json()
+        ])
+
+    def test_read_your_writes_expires(self):
+        """Ensure reads go back to the replica once the window is over"""
+        self.app.config['READ_YOUR_WRITES_WINDOW'] = 0
+        client = self.app.test_client()
+        response = client.post('/viewer/create',
+                               json={'email': 'viewer@email.com'})
+        self.assertNotIn('Set-Cookie', response.headers)
+        self.assertEqual([], client.get('/viewer/get').get_json())
+
+    def test_replica_access_decisions_are_not_cached(self):
+        """Ensure has-access decisions read from the replica are not
+        cached"""
+        url = 'https://s3.amazonaws.com/meetings/recording1/'
+        engine = create_engine(self.replica)
+        engine.execute(models.Viewer.__table__.insert(),
+                       {'email': 'host@email.com'})
+        engine.execute(models.Meeting.__table__.insert(),
+                       {'host_email': 'host@email.com', 'password': 'x'})
+        engine.execute(models.Recording.__table__.insert(),
+                       {'url': url, 'is_private': True, 'meeting_id': 1})
+        engine.dispose()
+        access_cache.clear()
+
+        response = self.app.test_client().get(
+            '/recording/has-access',
+            json={'email': 'host@email.com', 'url': url})
+        self.assertTrue(response.get_json()['message'].startswith(
+            'SUCCESS'))
+        self.assertEqual(0, access_cache.stats()['size'])
+
+    def test_read_engine_refuses_writes(self):
+        """Ensure connections of the read engine are query only"""
+        with self.app.app_context():
+            with self.assertRaises(OperationalError):
+                db.get_engine(bind='read').execute(
+                    models.Viewer.__table__.insert(),
+                    {'email': 'viewer@email.com'})
+
+
+class NoReadRoutingTestCase(unittest.TestCase):
+
+    def test_without_read_database(self):
+        """Ensure reads use the primary without SQLALCHEMY_READ_DATABASE_URI
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            app = create_app({
+                'TESTING': True,
+                'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(
+                    directory, 'primary.db'),
+            })
+            with app.app_context():
+                db.create_all()
+            response = app.test_client().post(
+                '/viewer/create', json={'email': 'viewer@email.com'})
+            self.assertNotIn('Set-Cookie', response.headers)
+            self.assertEqual(1, len(
+                app.test_client().get('/viewer/get').get_json()))
+            with app.app_context():
+                db.get_engine().dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Engines and sessions of the shard databases of the sharded storage backend
+"""
+from flask import _app_ctx_stack, current_app
+from sqlalchemy import orm
+import threading
+import weakref
+
+
+def bind(index):
+    """Flask-SQLAlchemy bind of the shard `index`"""
+    return 'shard%d' % index
+
+
+class Shards(object):
+    """The databases of SHARD_DATABASE_URIS, which hold the recordings and
+    their shares in the sharded storage backend (see shardstorage.py).
+
+    They are registered as binds, so their engines get the SQLite profile
+    and are disposed of after a fork like the main one. Each shard has a
+    scoped session, removed at the end of the app context like db.session.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        # app -> scoped session of each shard
+        self._sessions = weakref.WeakKeyDictionary()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SHARD_DATABASE_URIS', [])
+        uris = app.config['SHARD_DATABASE_URIS']
+        if uris:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds.update((bind(index), uri) for index, uri in enumerate(uris))
+            app.config['SQLALCHEMY_BINDS'] = binds
+            app.teardown_appcontext(self._remove)
+        app.extensions['shards'] = self
+
+    @property
+    def count(self):
+        return len(current_app.config['SHARD_DATABASE_URIS'])
+
+    def home(self, meeting_id):
+        """Shard the recordings of a new meeting go to"""
+        return meeting_id % self.count
+
+    def engine(self, index, app=None):
+        app = current_app._get_current_object() if app is None else app
+        return app.extensions['sqlalchemy'].db.get_engine(app,
+                                                          bind=bind(index))
+
+    def sessions(self, app=None):
+        """Scoped session of every shard of `app`, the current app by
+        default"""
+        app = current_app._get_current_object() if app is None else app
+        sessions = self._sessions.get(app)
+        if sessions is None:
+            with self._lock:
+                sessions = self._sessions.get(app)
+                if sessions is None:
+                    sessions = self._sessions[app] = [
+                        orm.scoped_session(
+                            orm.sessionmaker(bind=self.engine(index, app)),
+                            scopefunc=_app_ctx_stack.__ident_func__)
+                        for index in range(
+                            len(app.config['SHARD_DATABASE_URIS']))]
+        return sessions
+
+    def create_all(self):
+        """Create the tables in every shard. Shards have the schema of the
+        main database, only the recording, viewers, versions and counters
+        tables are used."""
+        metadata = current_app.extensions['sqlalchemy'].db.metadata
+        for index in range(self.count):
+            metadata.create_all(self.engine(index))
+
+    def drop_all(self):
+        metadata = current_app.extensions['sqlalchemy'].db.metadata
+        for index in range(self.count):
+            metadata.drop_all(self.engine(index))
+
+    def _remove(self, exception):
+        for session in self._sessions.get(
+                current_app._get_current_object(), ()):
+            session.remove()
@@ -0,0 +1,566 @@
+"""
+Sharded storage backend: viewers and meetings in the main database, the
+recordings and their shares spread over the shards by meeting
+"""
+from contextlib import contextmanager
+from flask import current_app, g
+from heapq import merge
+from itertools import groupby, islice
+from operator import itemgetter
+from sqlalchemy import and_, bindparam, exists, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from extensions import db, shards
+from sqlstorage import SQLAlchemyRepository
+from storage import AccessRow, Repository, Retry
+import counters
+import listing
+import models
+import purge
+import versions
+
+# Insert a share only while its recording is in the shard: a rebalance may
+# have moved it since the write unit looked it up
+SHARE = models.viewers.insert().from_select(
+    ['recording_url', 'viewer_email'],
+    select([bindparam('url', type_=db.String),
+            bindparam('email', type_=db.String)]).where(exists().where(and_(
+                models.Recording.url == bindparam('url'),
+                models.Recording.deleted.is_(None)))))
+
+CLAIMS = models.recording_shards
+
+
+def _with_url(columns):
+    return columns if 'url' in columns else columns + ['url']
+
+
+def _holds(session, url):
+    """Whether the database of `session` has a row for the recording
+    `url`, deleted or not"""
+    return session.query(exists().where(
+        models.Recording.url == url)).scalar()
+
+
+def _merge(pages, columns, requested, limit, chunk):
+    """Rows of the url ordered `pages` of the shards, in url order. Rows of
+    a recording a rebalance is moving, in two shards for a while, come out
+    once. `columns` are those of the pages, `requested` those to return."""
+    key = itemgetter(columns.index('url'))
+    rows = islice((next(group) for url, group in groupby(
+        merge(*pages, key=key), key)), limit)
+    if columns is not requested:
+        rows = (row[:-1] for row in rows)
+    return rows if chunk else list(rows)
+
+
+class ShardedRepository(Repository):
+    """Repository over the main database, which is the directory of the
+    viewers and meetings, and the shards of SHARD_DATABASE_URIS, which hold
+    the recordings and their shares.
+
+    New recordings go to the shard in the `shard` column of their meeting,
+    and claim their url in the `recording_shards` table of the main
+    database, whose primary key keeps urls unique across the shards.
+    Recordings are looked up there, in one query whatever the number of
+    shards, and the shard found is remembered until the end of the
+    request. A rebalance points the claims at the new shard before the
+    recordings leave the old one. Lists merge the pages of every shard. A
+    write unit writes to one shard, and to the main database. There is no
+    change feed, whose single sequence of events would serialise the writes
+    of the shards again.
+    """
+
+    def __init__(self):
+        self.directory = SQLAlchemyRepository()
+
+    @classmethod
+    def from_app(cls, app):
+        if not app.config['SHARD_DATABASE_URIS']:
+            raise ValueError("The sharded storage backend needs "
+                             "SHARD_DATABASE_URIS")
+        return cls()
+
+    def _shards(self):
+        return [SQLAlchemyRepository(session, self.directory)
+                for session in shards.sessions()]
+
+    def _shard(self, index):
+        return SQLAlchemyRepository(shards.sessions()[index], self.directory)
+
+    def _locate(self, urls):
+        """{url: shard} of the recordings of `urls`, deleted ones
+        included"""
+        urls = list(urls)
+        found = g.setdefault('recording_shards', {})
+        missing = {url for url in urls if url not in found}
+        for chunk in listing.chunked(list(missing),
+                                     current_app.config['SQL_IN_CHUNK']):
+            found.update((url, index) for url, index in
+                         self.directory.session.execute(select(
+                             [CLAIMS.c.url, CLAIMS.c.shard]).where(
+                             CLAIMS.c.url.in_(chunk))))
+        return {url: found[url] for url in urls if url in found}
+
+    def _by_shard(self, urls):
+        """{shard: urls} of the recordings of `urls`"""
+        by_shard = {}
+        for url, index in self._locate(urls).items():
+            by_shard.setdefault(index, []).append(url)
+        return by_shard
+
+    def _located(self, url):
+        index = self._locate([url]).get(url)
+        return None if index is None else self._shard(index)
+
+    @contextmanager
+    def transaction(self):
+        sessions = [self.directory.session] + shards.sessions()
+        try:
+            yield self
+            # Only the databases the unit wrote to have anything to commit.
+            # The main database goes last, so a claimed url always has its
+            # recording committed in the shard of the claim.
+            for session in sessions[1:] + sessions[:1]:
+                session.commit()
+        except Exception:
+            for session in sessions:
+                session.rollback()
+            # Where the unit found its recordings may be what changed
+            g.pop('recording_shards', None)
+            raise
+
+    def viewer(self, email):
+        return self.directory.viewer(email)
+
+    def meeting(self, id):
+        return self.directory.meeting(id)
+
+    def recording(self, url):
+        shard = self._located(url)
+        return None if shard is None else shard.recording(url)
+
+    def recording_status(self, url):
+        shard = self._located(url)
+        return purge.PURGED if shard is None else shard.recording_status(url)
+
+    def is_shared(self, url, email):
+        shard = self._located(url)
+        return shard is not None and shard.is_shared(url, email)
+
+    def existing_emails(self, emails):
+        return self.directory.existing_emails(emails)
+
+    def recordings(self, urls):
+        found = {}
+        for index, shard_urls in self._by_shard(urls).items():
+            found.update(self._shard(index).recordings(shard_urls))
+        return found
+
+    def access_rows(self, urls):
+        recordings = self.recordings(urls)
+        meetings = {}
+        session = self.directory.session
+        for chunk in listing.chunked(
+                list({row.meeting_id for row in recordings.values()}),
+                current_app.config['SQL_IN_CHUNK']):
+            meetings.update((row.id, row) for row in session.query(
+                models.Meeting.id, models.Meeting.host_email,
+                models.Meeting.password).filter(models.Meeting.id.in_(chunk)))
+        return {url: AccessRow(url, row.is_private, row.meeting_id,
+                               meetings[row.meeting_id].host_email,
+                               meetings[row.meeting_id].password)
+                for url, row in recordings.items()
+                if row.meeting_id in meetings}
+
+    def shared(self, urls, emails):
+        emails = list(emails)
+        found = set()
+        for index, shard_urls in self._by_shard(urls).items():
+            found.update(self._shard(index).shared(shard_urls, emails))
+        return found
+
+    # Recordings are listed in url order whether `ordered` or not, which
+    # lets the pages of the shards be merged
+    def rows(self, table, columns, ordered=False, after=None, limit=None,
+             chunk=None):
+        if table != 'recording':
+            return self.directory.rows(table, columns, ordered, after, limit,
+                                       chunk)
+        fetched = _with_url(columns)
+        return _merge([shard.rows(table, fetched, True, after, limit, chunk)
+                       for shard in self._shards()],
+                      fetched, columns, limit, chunk)
+
+    def viewer_recordings(self, email, columns, after=None, limit=None,
+                          chunk=None):
+        hosted = [id for id, in self.directory.session.query(
+            models.Meeting.id).filter(models.Meeting.host_email == email)]
+        fetched = _with_url(columns)
+        return _merge([shard.viewer_recordings(email, fetched, after, limit,
+                                               chunk, hosted)
+                       for shard in self._shards()],
+                      fetched, columns, limit, chunk)
+
+    def version(self, name):
+        table, _, url = name.partition(':')
+        if table != 'recording':
+            return self.directory.version(name)
+        if url:
+            shard = self._located(url)
+            return None if shard is None else shard.version(name)
+        # Every shard counts the writes to its own recordings, a write to
+        # any of them raises the sum
+        found = [version for version in (
+            shard.version(name) for shard in self._shards())
+            if version is not None]
+        if not found:
+            return None
+        return (sum(version for version, _ in found),
+                max(modified for _, modified in found))
+
+    # Row versions of recordings are in their shard, the others in the main
+    # database
+    def versions(self, names):
+        names = list(names)
+        urls = {name: name.partition(':')[2] for name in names
+                if name.partition(':')[0] == 'recording'}
+        found = self.directory.versions(
+            [name for name in names if name not in urls])
+        located = self._locate(url for url in urls.values() if url)
+        by_shard = {}
+        for name, url in urls.items():
+            if not url:
+                version = self.version(name)
+                if version is not None:
+                    found[name] = version
+            elif url in located:
+                by_shard.setdefault(located[url], []).append(name)
+        for index, shard_names in by_shard.items():
+            found.update(self._shard(index).versions(shard_names))
+        return found
+
+    # Viewers and meetings are counted in the main database, recordings and
+    # shares where they are, which is the main database too until a
+    # rebalance moved its old recordings
+    def counters(self, names):
+        names = list(names)
+        found = self.directory.counters(names)
+        for shard in self._shards():
+            for name, value in shard.counters(names).items():
+                found[name] += value
+        return found
+
+    def add_viewer(self, email):
+        return self.directory.add_viewer(email)
+
+    def add_meeting(self, host_email, password):
+        meeting = self.directory.add_meeting(host_email, password)
+        meeting.shard = shards.home(meeting.id)
+        self.directory.session.flush()
+        return meeting
+
+    def add_recording(self, url, is_private, meeting_id):
+        index = self.directory.meeting(meeting_id).shard
+        if index is None or index >= shards.count:
+            # Meetings older than the shards, until rebalanced
+            index = shards.home(meeting_id)
+        try:
+            recording = self._shard(index).add_recording(url, is_private,
+                                                         meeting_id)
+        except IntegrityError:
+            # Created in that shard since the unit looked
+            raise Retry()
+        self._claim(url, index)
+        g.setdefault('recording_shards', {})[url] = index
+        return recording
+
+    def _claim(self, url, index):
+        """Claim `url` for the shard `index` in the main database. A claim
+        is only committed once its recording is (see `transaction`), so one
+        on a shard without the url was left by the purge of its recording,
+        and is taken over."""
+        session = self.directory.session
+        claimed = session.execute(select([CLAIMS.c.shard]).where(
+            CLAIMS.c.url == url)).scalar()
+        try:
+            if claimed is None:
+                session.execute(CLAIMS.insert(), {'url': url, 'shard': index})
+                return
+            taken = session.execute(CLAIMS.update().where(and_(
+                CLAIMS.c.url == url, CLAIMS.c.shard == claimed)).values(
+                shard=index)).rowcount
+        except IntegrityError:
+            # Claimed since the unit looked
+            raise Retry()
+        # Under the write lock of the main database, a recording created in
+        # the claimed shard meanwhile is committed there. The recording just
+        # added would have collided with one in its own shard.
+        if not taken or (claimed != index and
+                         _holds(shards.sessions()[claimed], url)):
+            raise Retry()
+
+    def share_many(self, pairs):
+        """Not atomic across shards: `transaction` commits the shards one
+        after the other, so the shares of the shards committed before a
+        failing commit are kept."""
+        pairs = list(pairs)
+        located = self._locate(url for url, _ in pairs)
+        by_shard = {}
+        for url, email in pairs:
+            if url not in located:
+                raise Retry()
+            by_shard.setdefault(located[url], []).append(
+                {'url': url, 'email': email})
+        sessions = shards.sessions()
+        for index, params in by_shard.items():
+            try:
+                inserted = sessions[index].execute(SHARE, params).rowcount
+            except IntegrityError:
+                # Shared since the unit looked
+                raise Retry()
+            if inserted < len(params):
+                raise Retry()
+            counters.add(sessions[index], counters.shared(
+                (param['url'], param['email']) for param in params))
+            versions.bump(sessions[index].connection(), versions.shared(
+                param['url'] for param in params),
+                current_app.config['SQL_IN_CHUNK'])
+
+    def delete_recording(self, url):
+        shard = self._located(url)
+        if shard is None or shard.recording(url) is None:
+            raise Retry()
+        try:
+            return shard.delete_recording(url)
+        except StaleDataError:
+            raise Retry()
+
+    def record_many(self, events):
+        # No change feed with shards
+        pass
+
+
+def plan(loads, placement, count, slack=0.1):
+    """Shard of every meeting of `loads` ({meeting id: rows}) over `count`
+    shards, given their current `placement` ({meeting id: shard or None}).
+
+    Meetings without one of the shards go to the lightest shard, heaviest
+    first. Meetings then move from the heaviest shard to the lightest, each
+    time the one leaving them closest to even, until the heaviest shard is
+    within `slack` of the mean or no move narrows the gap.
+    """
+    totals = [0] * count
+    members = [{} for _ in range(count)]
+    target = {}
+
+    def put(meeting, shard):
+        target[meeting] = shard
+        totals[shard] += loads[meeting]
+        members[shard][meeting] = loads[meeting]
+
+    unplaced = []
+    for meeting in sorted(loads):
+        shard = placement.get(meeting)
+        if shard is not None and 0 <= shard < count:
+            put(meeting, shard)
+        else:
+            unplaced.append(meeting)
+    for meeting in sorted(unplaced, key=lambda meeting: -loads[meeting]):
+        put(meeting, min(range(count), key=lambda shard: totals[shard]))
+
+    mean = sum(totals) / float(count)
+    # Each move lowers the sum of the squared totals, so this ends
+    while True:
+        heavy = max(range(count), key=lambda shard: totals[shard])
+        light = min(range(count), key=lambda shard: totals[shard])
+        gap = totals[heavy] - totals[light]
+        if totals[heavy] <= mean * (1 + slack):
+            break
+        candidates = [meeting for meeting, load in members[heavy].items()
+                      if 0 < load < gap]
+        if not candidates:
+            break
+        meeting = min(candidates, key=lambda meeting: (
+            abs(gap - 2 * loads[meeting]), meeting))
+        totals[heavy] -= loads[meeting]
+        del members[heavy][meeting]
+        put(meeting, light)
+    return target
+
+
+def _loads(session):
+    """{meeting id: recordings and shares} of the database of `session`"""
+    loads = dict(session.query(
+        models.Recording.meeting_id, func.count(models.Recording.url)
+    ).group_by(models.Recording.meeting_id))
+    for meeting_id, count in session.query(
+            models.Recording.meeting_id, func.count()).join(
+            models.viewers,
+            models.viewers.c.recording_url == models.Recording.url).group_by(
+            models.Recording.meeting_id):
+        loads[meeting_id] += count
+    session.commit()
+    return loads
+
+
+def move(source, target, meeting_id, in_chunk, batch=10000):
+    """Copy the recordings of `meeting_id` and their shares from the
+    database of the session `source` to that of `target`, then delete them
+    from `source`. Returns the numbers of recordings and shares moved.
+
+    The write lock of `source` is held throughout, so no share is added
+    there meanwhile: writes to it wait, and a share of a recording that is
+    gone once they get the lock is retried in its new shard. The claims of
+    the moved urls point at `target`, one of the shards, before they leave
+    `source`. The counters of what moved go with it.
+    """
+    recording = models.Recording.__table__
+    shares = models.viewers
+    source.execute('BEGIN IMMEDIATE')
+    try:
+        rows = source.execute(select([recording]).where(
+            recording.c.meeting_id == meeting_id)).fetchall()
+        urls = [row.url for row in rows]
+        if rows:
+            target.execute(recording.insert(), [dict(row) for row in rows])
+        active = {row.url for row in rows if row.deleted is None}
+        private = {row.url for row in rows
+                   if row.deleted is None and row.is_private}
+        deltas = {counters.RECORDINGS: len(active),
+                  counters.meeting(meeting_id): len(active),
+                  counters.SHARES: 0}
+        if private:
+            host_email = db.session.query(models.Meeting.host_email).filter(
+                models.Meeting.id == meeting_id).scalar()
+            deltas[counters.host(host_email)] = len(private)
+        moved = 0
+        for chunk in listing.chunked(urls, in_chunk):
+            result = source.execute(select([shares]).where(
+                shares.c.recording_url.in_(chunk)))
+            for fetched in iter(lambda: result.fetchmany(batch), []):
+                target.execute(shares.insert(),
+                               [dict(row) for row in fetched])
+                moved += len(fetched)
+                for row in fetched:
+                    names = [counters.recording(row.recording_url)]
+                    if row.recording_url in active:
+                        deltas[counters.SHARES] += 1
+                        if row.recording_url not in private:
+                            names.append(counters.viewer(row.viewer_email))
+                    for name in names:
+                        deltas[name] = deltas.get(name, 0) + 1
+        counters.add(target, deltas)
+        # The lists of the target changed, and its row versions start over
+        versions.bump(target.connection(), ['recording'] + [
+            versions.row('recording', url) for url in urls], in_chunk)
+        target.commit()
+        _reclaim(urls, shards.sessions().index(target), in_chunk)
+        # Committed with the source when that is the main database
+        if source is not db.session:
+            db.session.commit()
+        for chunk in listing.chunked(urls, in_chunk):
+            source.execute(shares.delete().where(
+                shares.c.recording_url.in_(chunk)))
+            source.execute(recording.delete().where(
+                recording.c.url.in_(chunk)))
+        counters.add(source, {name: -delta
+                              for name, delta in deltas.items()})
+        source.commit()
+    except Exception:
+        target.rollback()
+        db.session.rollback()
+        source.rollback()
+        raise
+    return len(urls), moved
+
+
+def _reclaim(urls, index, in_chunk):
+    """Claim `urls` for the shard `index`, whichever shard claimed them"""
+    for chunk in listing.chunked(urls, in_chunk):
+        db.session.execute(CLAIMS.insert().prefix_with('OR REPLACE'),
+                           [{'url': url, 'shard': index} for url in chunk])
+
+
+def release(session, url):
+    """Drop the claim of the shard of `session` on `url`, whose recording
+    the purge removed from it, so the url can be created again. Meant for
+    RecordingPurge.on_purged."""
+    sessions = shards.sessions() if shards.count else []
+    if session not in sessions:
+        return
+    db.session.execute(CLAIMS.delete().where(and_(
+        CLAIMS.c.url == url, CLAIMS.c.shard == sessions.index(session))))
+    # Under the write lock of the main database, a recording created again
+    # in the shard meanwhile is committed there, and keeps its claim
+    if _holds(session, url):
+        db.session.rollback()
+    else:
+        db.session.commit()
+
+
+def fill_directory(in_chunk):
+    """Claim the recordings of the shards that have no claim, those of
+    shards filled before the claims existed. Returns the number of urls
+    claimed."""
+    recording = models.Recording.__table__
+    claimed = 0
+    for index, session in enumerate(shards.sessions()):
+        urls = [url for url, in session.execute(select([recording.c.url]))]
+        session.commit()
+        for chunk in listing.chunked(urls, in_chunk):
+            claimed += db.session.execute(
+                CLAIMS.insert().prefix_with('OR IGNORE'),
+                [{'url': url, 'shard': index} for url in chunk]).rowcount
+        db.session.commit()
+    return claimed
+
+
+def rebalance(slack=0.1, dry_run=False, on_move=None):
+    """Move the recordings of the main database and of the shards to the
+    shards `plan` gives their meetings, and record those in the `shard`
+    column of the meetings. Databases are numbered as shards, None being
+    the main database, which holds the recordings of before the shards.
+
+    Returns the moves as (meeting id, source, target) tuples; `on_move` is
+    called with each one and the numbers of recordings and shares moved.
+    """
+    in_chunk = current_app.config['SQL_IN_CHUNK']
+    sessions = dict(enumerate(shards.sessions()))
+    sessions[None] = db.session
+    located = {}
+    for database, session in sessions.items():
+        for meeting_id, load in _loads(session).items():
+            located.setdefault(meeting_id, {})[database] = load
+    placement = dict(db.session.query(models.Meeting.id,
+                                      models.Meeting.shard))
+    db.session.commit()
+    loads = {meeting_id: 1 for meeting_id in placement}
+    for meeting_id, where in located.items():
+        loads[meeting_id] = 1 + sum(where.values())
+    target = plan(loads, placement, shards.count, slack)
+
+    moves = sorted(((meeting_id, database, target[meeting_id])
+                    for meeting_id, where in located.items()
+                    for database in where if database != target[meeting_id]),
+                   key=lambda move: (move[0], move[1] is not None, move[1]))
+    if dry_run:
+        return moves
+
+    # New recordings go to the new shard from now on, and the old ones are
+    # found wherever they are until they are moved
+    changed = [{'key': meeting_id, 'shard': shard}
+               for meeting_id, shard in sorted(target.items())
+               if meeting_id in placement and placement[meeting_id] != shard]
+    if changed:
+        meeting = models.Meeting.__table__
+        db.session.execute(meeting.update().where(
+            meeting.c.id == bindparam('key')).values(
+            shard=bindparam('shard')), changed)
+        db.session.commit()
+    for meeting_id, source, destination in moves:
+        counts = move(sessions[source], sessions[destination], meeting_id,
+                      in_chunk)
+        if on_move is not None:
+            on_move((meeting_id, source, destination), *counts)
+    return moves
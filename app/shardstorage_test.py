@@ -0,0 +1,215 @@
+import os
+import shutil
+import tempfile
+import unittest
+from app import create_app
+from extensions import db, shards, storage
+from storage import Retry
+import counters
+import models
+import shardstorage
+
+
+class PlanTestCase(unittest.TestCase):
+
+    def test_unplaced_meetings_fill_the_lightest_shard(self):
+        target = shardstorage.plan({1: 10, 2: 6, 3: 5, 4: 1},
+                                   {1: None, 2: None, 3: None, 4: None}, 2)
+        self.assertEqual({1: 0, 2: 1, 3: 1, 4: 0}, target)
+
+    def test_placed_meetings_stay_when_even(self):
+        placement = {1: 1, 2: 0, 3: 1}
+        self.assertEqual(placement, shardstorage.plan({1: 5, 2: 9, 3: 4},
+                                                      placement, 2))
+
+    def test_new_shard_takes_from_the_heaviest(self):
+        loads = {1: 4, 2: 4, 3: 4, 4: 4, 5: 4, 6: 4}
+        placement = {1: 0, 2: 0, 3: 0, 4: 1, 5: 1, 6: 1}
+        target = shardstorage.plan(loads, placement, 3)
+        totals = [sum(loads[meeting] for meeting in target
+                      if target[meeting] == shard) for shard in range(3)]
+        self.assertEqual([8, 8, 8], totals)
+        # Only the two meetings the new shard needs moved
+        self.assertEqual(2, sum(target[meeting] != placement[meeting]
+                                for meeting in loads))
+
+    def test_out_of_range_shards_are_replaced(self):
+        self.assertEqual({1: 0, 2: 1}, shardstorage.plan(
+            {1: 3, 2: 2}, {1: 0, 2: 5}, 2))
+
+
+class RebalanceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_app(self, shard_count, backend='sharded'):
+        uri = 'sqlite:///' + os.path.join(self.directory, '%s.db')
+        return create_app({
+            'TESTING': True,
+            'STORAGE_BACKEND': backend,
+            'SQLALCHEMY_DATABASE_URI': uri % 'main',
+            'SHARD_DATABASE_URIS': [uri % ('shard%d' % index)
+                                    for index in range(shard_count)],
+            'PASSWORD_HASH_ITERATIONS': 1000,
+            'RECORDING_PURGE_WORKER': False,
+        })
+
+    def seed(self, client, meetings, recordings):
+        client.post('/viewer/create', json={'email': 'host@email.com'})
+        client.post('/viewer/create', json={'email': 'viewer@email.com'})
+        for meeting in range(meetings):
+            client.post('/meeting/create', json={
+                'host_email': 'host@email.com', 'password': 'pass'})
+        for i in range(recordings):
+            url = 'https://rec/%03d' % i
+            client.post('/recording/create', json={
+                'url': url, 'is_private': False,
+                'meeting_id': 1 + i % meetings})
+            client.post('/recording/share', json={
+                'url': url, 'email': 'viewer@email.com'})
+
+    def counts(self):
+        return [session.query(models.Recording).count()
+                for session in shards.sessions()]
+
+    def claims(self):
+        return sorted(db.session.query(models.recording_shards))
+
+    def listed(self, client):
+        return [item['url'] for item in client.get(
+            '/viewer/recordings?email=viewer@email.com').get_json()]
+
+    def test_moves_unsharded_recordings(self):
+        """Ensure the recordings of a database without shards move to the
+        shards with their shares"""
+        before = self.create_app(2, 'sqlalchemy')
+        with before.app_context():
+            db.create_all()
+            shards.create_all()
+            self.seed(before.test_client(), 4, 12)
+        app = self.create_app(2)
+        with app.app_context():
+            moves = shardstorage.rebalance()
+            self.assertEqual([(meeting, None, (meeting - 1) % 2)
+                              for meeting in range(1, 5)], moves)
+            self.assertEqual([6, 6], self.counts())
+            self.assertEqual(0, models.Recording.query.count())
+            self.assertEqual([0, 1, 0, 1], [
+                meeting.shard for meeting in models.Meeting.query.order_by(
+                    models.Meeting.id)])
+            self.assertEqual(['https://rec/%03d' % i for i in range(12)],
+                             self.listed(app.test_client()))
+            self.assertEqual([], shardstorage.rebalance())
+            self.assertEqual([('https://rec/%03d' % i, i % 2)
+                              for i in range(12)], self.claims())
+
+    def test_added_shard_takes_its_share(self):
+        app = self.create_app(2)
+        with app.app_context():
+            db.create_all()
+            shards.create_all()
+            self.seed(app.test_client(), 6, 24)
+        grown = self.create_app(3)
+        with grown.app_context():
+            shards.create_all()
+            planned = shardstorage.rebalance(dry_run=True)
+            self.assertEqual([12, 12, 0], self.counts())
+            moves = shardstorage.rebalance()
+            self.assertEqual(planned, moves)
+            self.assertEqual(2, len(moves))
+            self.assertEqual([8, 8, 8], self.counts())
+            self.assertEqual(24, len(self.listed(grown.test_client())))
+
+    def test_claims_follow_the_moves(self):
+        app = self.create_app(2)
+        with app.app_context():
+            db.create_all()
+            shards.create_all()
+            self.seed(app.test_client(), 6, 24)
+            before = self.claims()
+        grown = self.create_app(3)
+        with grown.app_context():
+            shards.create_all()
+            moves = shardstorage.rebalance()
+            targets = {meeting: target for meeting, _, target in moves}
+            self.assertEqual([(url, targets.get(1 + i % 6, shard))
+                              for i, (url, shard) in enumerate(before)],
+                             self.claims())
+
+    def test_fill_directory_claims_existing_recordings(self):
+        app = self.create_app(2)
+        with app.app_context():
+            db.create_all()
+            shards.create_all()
+            self.seed(app.test_client(), 4, 12)
+            claims = self.claims()
+            db.session.execute(models.recording_shards.delete().where(
+                models.recording_shards.c.url > 'https://rec/005'))
+            db.session.commit()
+            self.assertEqual(6, shardstorage.fill_directory(500))
+            self.assertEqual(claims, self.claims())
+            self.assertEqual(0, shardstorage.fill_directory(500))
+
+    def test_counters_move_with_the_recordings(self):
+        """Ensure the stats are the same once recordings moved, and that
+        every database holds the counters of what it holds"""
+        app = self.create_app(2)
+        with app.app_context():
+            db.create_all()
+            shards.create_all()
+            client = app.test_client()
+            self.seed(client, 4, 12)
+            client.post('/recording/create', json={
+                'url': 'https://rec/private', 'is_private': True,
+                'meeting_id': 1})
+            client.delete('/recording/delete', json={'url': 'https://rec/000'})
+            stats = client.get('/stats').get_json()
+            self.assertEqual({'viewers': 2, 'meetings': 4, 'recordings': 12,
+                              'shares': 11}, stats)
+        grown = self.create_app(3)
+        with grown.app_context():
+            shards.create_all()
+            self.assertTrue(shardstorage.rebalance())
+            client = grown.test_client()
+            self.assertEqual(stats, client.get('/stats').get_json())
+            self.assertEqual(11, client.get(
+                '/stats/viewer/viewer@email.com').get_json()['recordings'])
+            self.assertEqual(1, client.get(
+                '/stats/viewer/host@email.com').get_json()['recordings'])
+            hosts = counters.hosts(db.session)
+            self.assertEqual([], counters.reconcile(db.session))
+            for session in shards.sessions():
+                self.assertEqual([], counters.reconcile(session, hosts))
+
+    def test_share_of_a_moved_recording_is_retried(self):
+        app = self.create_app(2)
+        with app.app_context():
+            db.create_all()
+            shards.create_all()
+            self.seed(app.test_client(), 1, 1)
+            app.test_client().post('/viewer/create',
+                                   json={'email': 'late@email.com'})
+            repository = storage.repository
+            # Looked up in shard 1, then moved to shard 0
+            self.assertIsNotNone(repository.recording('https://rec/000'))
+            shardstorage.move(shards.sessions()[1], shards.sessions()[0],
+                              1, 500)
+            with self.assertRaises(Retry):
+                with repository.transaction():
+                    repository.share('https://rec/000', 'late@email.com')
+            rv = app.test_client().post('/recording/share', json={
+                'url': 'https://rec/000', 'email': 'late@email.com'})
+            self.assertEqual("Viewer late@email.com added to recording "
+                             "https://rec/000!", rv.get_json()['message'])
+            self.assertEqual(2, shards.sessions()[0].query(
+                models.viewers).count())
+            self.assertEqual(0, shards.sessions()[1].query(
+                models.viewers).count())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,248 @@
+"""
+SQLAlchemy storage backend: the models, through a session
+"""
+from contextlib import contextmanager
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from extensions import db
+from storage import Repository, Retry
+import changes
+import counters
+import datetime
+import listing
+import models
+import purge
+import versions
+
+KEYS = {
+    'meeting': models.Meeting.id,
+    'recording': models.Recording.url,
+    'viewer': models.Viewer.id,
+}
+# Rows of the lists, deleted recordings aside
+VISIBLE = {
+    'recording': (models.Recording.deleted.is_(None),),
+}
+
+
+def run(session, unit, *args):
+    """Run a write unit with the session of the group commit writer"""
+    return unit(SQLAlchemyRepository(session), *args)
+
+
+class SQLAlchemyRepository(Repository):
+    """Repository over the database of the app, through `session` (the
+    scoped session of the requests by default, or e.g. the session of the
+    group commit writer). The hosts of meetings are looked up in
+    `meetings`, this repository by default, or e.g. the main database of
+    the shards."""
+
+    def __init__(self, session=None, meetings=None):
+        self.session = db.session if session is None else session
+        self.meetings = self if meetings is None else meetings
+
+    @classmethod
+    def from_app(cls, app):
+        return cls()
+
+    @contextmanager
+    def transaction(self):
+        try:
+            yield self
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def _chunk(self):
+        return current_app.config['SQL_IN_CHUNK']
+
+    def viewer(self, email):
+        return self.session.query(models.Viewer).filter_by(
+            email=email).first()
+
+    def meeting(self, id):
+        return self.session.query(models.Meeting).get(id)
+
+    def recording(self, url):
+        recording = self.session.query(models.Recording).get(url)
+        if recording is None or recording.deleted is not None:
+            return None
+        return recording
+
+    def recording_status(self, url):
+        recording = self.session.query(models.Recording).get(url)
+        if recording is None:
+            return purge.PURGED
+        return purge.ACTIVE if recording.deleted is None else purge.PURGING
+
+    def is_shared(self, url, email):
+        # An existence query on the primary key of the viewers table
+        return self.session.query(db.exists().where(db.and_(
+            models.viewers.c.recording_url == url,
+            models.viewers.c.viewer_email == email))).scalar()
+
+    def existing_emails(self, emails):
+        found = set()
+        for chunk in listing.chunked(list(emails), self._chunk()):
+            found.update(email for email, in self.session.query(
+                models.Viewer.email).filter(models.Viewer.email.in_(chunk)))
+        return found
+
+    def recordings(self, urls):
+        found = {}
+        for chunk in listing.chunked(list(urls), self._chunk()):
+            found.update((row.url, row) for row in self.session.query(
+                models.Recording.url, models.Recording.is_private,
+                models.Recording.meeting_id).filter(
+                models.Recording.url.in_(chunk),
+                models.Recording.deleted.is_(None)))
+        return found
+
+    def access_rows(self, urls):
+        found = {}
+        for chunk in listing.chunked(list(urls), self._chunk()):
+            found.update((row.url, row) for row in self.session.query(
+                models.Recording.url, models.Recording.is_private,
+                models.Recording.meeting_id, models.Meeting.host_email,
+                models.Meeting.password).join(
+                models.Meeting,
+                models.Meeting.id == models.Recording.meeting_id).filter(
+                models.Recording.url.in_(chunk),
+                models.Recording.deleted.is_(None)))
+        return found
+
+    def shared(self, urls, emails):
+        found = set()
+        size = self._chunk()
+        shares = models.viewers.c
+        for url_chunk in listing.chunked(list(urls), size):
+            for email_chunk in listing.chunked(list(emails), size):
+                found.update(self.session.query(
+                    shares.recording_url, shares.viewer_email).filter(
+                    shares.recording_url.in_(url_chunk),
+                    shares.viewer_email.in_(email_chunk)))
+        return found
+
+    # Only the requested columns are selected, and rows are returned
+    # without going through the ORM
+    def rows(self, table, columns, ordered=False, after=None, limit=None,
+             chunk=None):
+        key = KEYS[table]
+        query = self.session.query(*[getattr(key.class_, column)
+                                     for column in columns]).filter(
+            *VISIBLE.get(table, ()))
+        if ordered:
+            query = listing.keyset(query, key, after, limit)
+        return self._fetch(query, chunk)
+
+    def _fetch(self, query, chunk):
+        if chunk:
+            # Straight from a server-side cursor
+            return query.yield_per(chunk)
+        return query.all()
+
+    # Each rule is one indexed join: public recordings shared with the
+    # viewer (ix_viewers_viewer_email is ordered by url) and private
+    # recordings of the meetings they host. Both are cut to the page before
+    # their union. Given the `meeting_ids` the viewer hosts, the second rule
+    # does without the meeting table, e.g. in a shard (see shardstorage.py).
+    def viewer_recordings(self, email, columns, after=None, limit=None,
+                          chunk=None, meeting_ids=None):
+        key = models.Recording.url
+        columns = [getattr(models.Recording, name) for name in columns]
+        shares = models.viewers.c
+        shared = self.session.query(*columns).join(
+            models.viewers, shares.recording_url == key).filter(
+            shares.viewer_email == email,
+            models.Recording.is_private.is_(False),
+            models.Recording.deleted.is_(None))
+        if meeting_ids is None:
+            hosted = self.session.query(*columns).join(
+                models.Meeting,
+                models.Meeting.id == models.Recording.meeting_id).filter(
+                models.Meeting.host_email == email)
+        else:
+            hosted = self.session.query(*columns).filter(
+                models.Recording.meeting_id.in_(meeting_ids))
+        hosted = hosted.filter(models.Recording.is_private.is_(True),
+                               models.Recording.deleted.is_(None))
+        # SQLite only takes a LIMIT in a compound select through a
+        # subquery. The shared branch is ordered by the index column rather
+        # than by the equal recording.url, which SQLite would sort in a
+        # temporary b-tree.
+        query = listing.keyset(shared, shares.recording_url, after,
+                               limit).from_self().union_all(
+            listing.keyset(hosted, key, after, limit).from_self())
+        return self._fetch(listing.keyset(query, key, limit=limit), chunk)
+
+    def version(self, name):
+        return versions.get(self.session, name)
+
+    def versions(self, names):
+        return versions.get_many(self.session, names, self._chunk())
+
+    def counters(self, names):
+        return counters.get(self.session, names, self._chunk())
+
+    # Counters change in the transaction of the write they count
+
+    def add_viewer(self, email):
+        viewer = models.Viewer(email)
+        self.session.add(viewer)
+        self.session.flush()
+        counters.add(self.session, {counters.VIEWERS: 1})
+        return viewer
+
+    def add_meeting(self, host_email, password):
+        meeting = models.Meeting(host_email, password)
+        self.session.add(meeting)
+        self.session.flush()
+        counters.add(self.session, {counters.MEETINGS: 1})
+        return meeting
+
+    def _host(self, recording):
+        """Host email of the meeting of `recording` if it is private"""
+        if not recording.is_private:
+            return None
+        return self.meetings.meeting(recording.meeting_id).host_email
+
+    def add_recording(self, url, is_private, meeting_id):
+        recording = models.Recording(url, is_private, meeting_id)
+        self.session.add(recording)
+        self.session.flush()
+        counters.add(self.session, counters.created(
+            meeting_id, self._host(recording)))
+        return recording
+
+    def share_many(self, pairs):
+        # One statement, the callers only pass missing shares. One of them
+        # may have been inserted since the unit looked, running it again
+        # reports it.
+        pairs = list(pairs)
+        try:
+            self.session.execute(models.viewers.insert(), [
+                {'recording_url': url, 'viewer_email': email}
+                for url, email in pairs])
+        except IntegrityError:
+            raise Retry()
+        counters.add(self.session, counters.shared(pairs))
+        versions.bump(self.session.connection(),
+                      versions.shared(url for url, _ in pairs), self._chunk())
+
+    def delete_recording(self, url):
+        # A tombstone: the shares and the row are left to purge.py, but the
+        # counters of the recording's viewers and host drop it at once
+        recording = self.session.query(models.Recording).get(url)
+        recording.deleted = datetime.datetime.utcnow()
+        self.session.flush()
+        shares = counters.get(self.session, [counters.recording(url)])
+        deltas = {name: -delta for name, delta in counters.created(
+            recording.meeting_id, self._host(recording)).items()}
+        deltas[counters.SHARES] = -shares[counters.recording(url)]
+        counters.add(self.session, deltas)
+        counters.unshare(self.session, url)
+        return purge.PURGING
+
+    def record_many(self, events):
+        changes.record_many(self.session, events)
@@ -0,0 +1,172 @@
+"""
+Repository interface between the routes and the data, and its selection
+"""
+from collections import namedtuple
+from flask import current_app
+import threading
+import weakref
+
+# Row of Repository.access_rows, for backends building their own
+AccessRow = namedtuple('AccessRow',
+                       'url is_private meeting_id host_email password')
+
+
+class Retry(Exception):
+    """Raised by a write when the records its unit read moved or changed
+    before it wrote, e.g. to another shard or because another request
+    inserted the same share: running the unit again sees them as they are
+    now"""
+
+
+class Repository(object):
+    """Operations the routes need, implemented by each storage backend.
+
+    Records are returned as objects with the attributes of the schemas
+    (`id`, `email`, `host_email`, `password`, `url`, `is_private`,
+    `meeting_id`). Deleted recordings are never returned. Writes go
+    through `transaction`, whose validation and changes see one snapshot.
+    """
+
+    def transaction(self):
+        """Context manager yielding the repository to write with, committed
+        when the block exits and rolled back if it raises"""
+        raise NotImplementedError
+
+    # Single records
+
+    def viewer(self, email):
+        raise NotImplementedError
+
+    def meeting(self, id):
+        raise NotImplementedError
+
+    def recording(self, url):
+        raise NotImplementedError
+
+    def recording_status(self, url):
+        """purge.ACTIVE, PURGING (deleted, shares left) or PURGED (no
+        recording at `url`)"""
+        raise NotImplementedError
+
+    def is_shared(self, url, email):
+        raise NotImplementedError
+
+    # Set-wise lookups
+
+    def existing_emails(self, emails):
+        """The subset of `emails` belonging to viewers"""
+        raise NotImplementedError
+
+    def recordings(self, urls):
+        """{url: recording} for the recordings of `urls`"""
+        raise NotImplementedError
+
+    def access_rows(self, urls):
+        """{url: row} with the recording attributes and the `host_email`
+        and `password` of its meeting, for the recordings of `urls`"""
+        raise NotImplementedError
+
+    def shared(self, urls, emails):
+        """The (url, email) pairs of `urls` x `emails` that are shared"""
+        raise NotImplementedError
+
+    # Lists. Keys are id for meetings and viewers, url for recordings.
+
+    def rows(self, table, columns, ordered=False, after=None, limit=None,
+             chunk=None):
+        """Tuples of `columns` of the rows of `table`, in storage order or,
+        if `ordered`, in key order from after `after`. `chunk` asks for
+        rows to be fetched that many at a time."""
+        raise NotImplementedError
+
+    def viewer_recordings(self, email, columns, after=None, limit=None,
+                          chunk=None):
+        """Tuples of `columns` of the public recordings shared with `email`
+        and the private recordings of the meetings they host"""
+        raise NotImplementedError
+
+    def version(self, name):
+        """(version, modified) of a table or row, see versions.py, or None
+        if the backend does not keep versions"""
+        raise NotImplementedError
+
+    def versions(self, names):
+        """{name: (version, modified)} of the tables and rows `names` that
+        have a version"""
+        raise NotImplementedError
+
+    def counters(self, names):
+        """{name: value} of the counters `names`, see counters.py, 0 for
+        those never counted"""
+        raise NotImplementedError
+
+    # Writes, inside a transaction
+
+    def add_viewer(self, email):
+        raise NotImplementedError
+
+    def add_meeting(self, host_email, password):
+        raise NotImplementedError
+
+    def add_recording(self, url, is_private, meeting_id):
+        raise NotImplementedError
+
+    def share(self, url, email):
+        self.share_many([(url, email)])
+
+    def share_many(self, pairs):
+        raise NotImplementedError
+
+    def delete_recording(self, url):
+        """Make the recording invisible, returns its recording_status"""
+        raise NotImplementedError
+
+    def record(self, event, data):
+        """Add an event to the change feed, see changes.py"""
+        self.record_many([(event, data)])
+
+    def record_many(self, events):
+        raise NotImplementedError
+
+
+class Storage(object):
+    """Gives the routes the repository of the STORAGE_BACKEND of their app.
+
+    Backends are registered with `add_backend(name, factory)`, `factory`
+    being called with the app, once per app, to create its repository.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._factories = {}
+        self._repositories = weakref.WeakKeyDictionary()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('STORAGE_BACKEND', 'sqlalchemy')
+        app.extensions['storage'] = self
+
+    def add_backend(self, name, factory):
+        self._factories[name] = factory
+
+    @property
+    def backend(self):
+        return current_app.config['STORAGE_BACKEND']
+
+    @property
+    def repository(self):
+        app = current_app._get_current_object()
+        repository = self._repositories.get(app)
+        if repository is None:
+            with self._lock:
+                repository = self._repositories.get(app)
+                if repository is None:
+                    factory = self._factories[app.config['STORAGE_BACKEND']]
+                    repository = self._repositories[app] = factory(app)
+        return repository
+
+    def clear(self):
+        """Forget the repository of the current app, and with it the data
+        of an in-memory backend"""
+        self._repositories.pop(current_app._get_current_object(), None)
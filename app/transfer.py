@@ -0,0 +1,306 @@
+"""
+Streaming NDJSON export and import of the whole database
+"""
+from sqlalchemy import and_, exists, select
+import changes
+import json
+import listing
+import models
+import os
+import passwords
+import versions
+
+# Record types in dependency order, with their table and (field, column,
+# type) triples. `id` fields are optional on import.
+KINDS = ('viewer', 'meeting', 'recording', 'share')
+TABLES = {
+    'viewer': (models.Viewer.__table__, (
+        ('id', 'id', int),
+        ('email', 'email', str))),
+    'meeting': (models.Meeting.__table__, (
+        ('id', 'id', int),
+        ('host_email', 'host_email', str),
+        ('password', 'password', str))),
+    'recording': (models.Recording.__table__, (
+        ('url', 'url', str),
+        ('is_private', 'is_private', bool),
+        ('meeting_id', 'meeting_id', int))),
+    'share': (models.viewers, (
+        ('url', 'recording_url', str),
+        ('email', 'viewer_email', str))),
+}
+# Deleted recordings, and their shares until they are purged, are left out
+# of exports
+EXPORTED = {
+    'recording': models.Recording.deleted.is_(None),
+    'share': ~exists().where(and_(
+        models.Recording.url == models.viewers.c.recording_url,
+        models.Recording.deleted.isnot(None))),
+}
+
+
+# Record types the shards of the sharded storage backend hold as well, see
+# shardstorage.py
+SHARDED = ('recording', 'share')
+
+
+def export(connection, out, chunk_size=1000, shards=()):
+    """Write every row to `out` as one JSON object per line, parents
+    before children. Recordings and shares are read from the connections
+    `shards` too, after those of `connection`. Returns the number of rows
+    per type."""
+    counts = {}
+    for kind in KINDS:
+        table, fields = TABLES[kind]
+        query = select([table.c[column] for _, column, _ in fields]) \
+            .order_by(*table.primary_key.columns)
+        if kind in EXPORTED:
+            query = query.where(EXPORTED[kind])
+        counts[kind] = 0
+        sources = [connection] + (list(shards) if kind in SHARDED else [])
+        for source in sources:
+            result = source.execution_options(
+                stream_results=True).execute(query)
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                out.write('\n'.join(listing.encode(dict(
+                    [('type', kind)] + [(field, value) for (field, _, _),
+                                        value in zip(fields, row)]))
+                    for row in rows) + '\n')
+                counts[kind] += len(rows)
+    return counts
+
+
+def read_checkpoint(path):
+    """Number of input lines a previous import committed, or 0"""
+    if path is None or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return int(f.read().strip() or 0)
+
+
+def write_checkpoint(path, line):
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+        f.write('%d\n' % line)
+    os.replace(temporary, path)
+
+
+def load(engine, lines, chunk_size=10000, in_chunk=500, start=0,
+         on_commit=None, on_reject=None,
+         hash_password=passwords.hash_password):
+    """Validate and insert NDJSON records, one transaction per chunk.
+
+    Lines up to `start` are skipped. `on_commit(line)` is called with the
+    number of the last line of each committed chunk and
+    `on_reject(line, message)` for every record that is not inserted.
+    Meeting passwords that are not hashed yet, from exports of older
+    databases, are hashed with `hash_password`. Returns the number of
+    inserted rows per type.
+    """
+    counts = dict.fromkeys(KINDS, 0)
+
+    def reject(line, message):
+        if on_reject is not None:
+            on_reject(line, message)
+
+    def flush(chunk, last):
+        with engine.begin() as connection:
+            for kind, count in Chunk(connection, chunk, in_chunk, reject,
+                                     hash_password).insert().items():
+                counts[kind] += count
+        if on_commit is not None:
+            on_commit(last)
+        return last
+
+    chunk = []
+    number = committed = start
+    for number, line in enumerate(lines, 1):
+        if number <= start or not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            reject(number, "Invalid JSON.")
+            continue
+        if not isinstance(record, dict) or record.get('type') not in TABLES:
+            reject(number, "Invalid record type.")
+            continue
+        chunk.append((number, record))
+        if len(chunk) >= chunk_size:
+            committed = flush(chunk, number)
+            chunk = []
+    if number > committed:
+        flush(chunk, number)
+    return counts
+
+
+class Chunk(object):
+    """The records of one chunk, checked with the rules of the create and
+    share endpoints against the database and the records before them"""
+
+    def __init__(self, connection, records, in_chunk, reject,
+                 hash_password=passwords.hash_password):
+        self.connection = connection
+        self.in_chunk = in_chunk
+        self.reject = reject
+        self.hash_password = hash_password
+        self.records = dict((kind, []) for kind in KINDS)
+        for line, record in records:
+            row = self.row(line, record)
+            if row is not None:
+                self.records[record['type']].append((line, row))
+
+    def row(self, line, record):
+        """Map a record to table columns, or reject it if a field is
+        missing or of the wrong type"""
+        row = {}
+        for field, column, kind in TABLES[record['type']][1]:
+            value = record.get(field)
+            if value is None and field == 'id':
+                continue
+            # bool is a subclass of int
+            if not isinstance(value, kind) or \
+                    (kind is int and isinstance(value, bool)):
+                self.reject(line, "Invalid field: " + field + ".")
+                return None
+            row[column] = value
+        return row
+
+    def insert(self):
+        counts = {}
+        for kind in KINDS:
+            table = TABLES[kind][0]
+            rows = getattr(self, 'check_' + kind)(self.records[kind])
+            insert_rows(self.connection, table, rows)
+            counts[kind] = len(rows)
+            if rows and kind in versions.TABLES:
+                names = [kind]
+                if kind in versions.ROWS:
+                    key, = table.primary_key.columns
+                    names.extend(versions.row(kind, row[key.name])
+                                 for row in rows if key.name in row)
+                versions.bump(self.connection, names, self.in_chunk)
+            elif rows and kind == 'share':
+                versions.bump(self.connection, versions.shared(
+                    row['recording_url'] for row in rows), self.in_chunk)
+        # Followers of the change feed refetch the lists rather than get
+        # an event per imported row
+        if any(counts.values()):
+            changes.record(self.connection, changes.RESET, {})
+        return counts
+
+    def existing(self, column, values):
+        """The subset of `values` found in `column`"""
+        found = set()
+        for chunk in listing.chunked(list(set(values)), self.in_chunk):
+            found.update(value for value, in self.connection.execute(
+                select([column]).where(column.in_(chunk))))
+        return found
+
+    def check_viewer(self, records):
+        table = models.Viewer.__table__
+        emails = self.existing(table.c.email,
+                               [row['email'] for _, row in records])
+        ids = self.existing(table.c.id,
+                            [row['id'] for _, row in records if 'id' in row])
+        rows = []
+        for line, row in records:
+            if not models.EMAIL_REGEX.match(row['email']):
+                self.reject(line, "Invalid email.")
+            elif row['email'] in emails:
+                self.reject(line, "Email already in use.")
+            elif row.get('id') in ids:
+                self.reject(line, "Viewer id already exists.")
+            else:
+                emails.add(row['email'])
+                if 'id' in row:
+                    ids.add(row['id'])
+                rows.append(row)
+        return rows
+
+    def check_meeting(self, records):
+        hosts = self.existing(models.Viewer.__table__.c.email,
+                              [row['host_email'] for _, row in records])
+        ids = self.existing(models.Meeting.__table__.c.id,
+                            [row['id'] for _, row in records if 'id' in row])
+        rows = []
+        for line, row in records:
+            if row['host_email'] not in hosts:
+                self.reject(line, "Invalid host email.")
+            elif row.get('id') in ids:
+                self.reject(line, "Meeting id already exists.")
+            else:
+                if 'id' in row:
+                    ids.add(row['id'])
+                if not passwords.is_hashed(row['password']):
+                    row['password'] = self.hash_password(row['password'])
+                rows.append(row)
+        return rows
+
+    def check_recording(self, records):
+        urls = self.existing(models.Recording.__table__.c.url,
+                             [row['url'] for _, row in records])
+        meetings = self.existing(models.Meeting.__table__.c.id,
+                                 [row['meeting_id'] for _, row in records])
+        rows = []
+        for line, row in records:
+            if row['url'] in urls:
+                self.reject(line, "URL already exists.")
+            elif row['meeting_id'] not in meetings:
+                self.reject(line, "Invalid meeting id.")
+            else:
+                urls.add(row['url'])
+                rows.append(row)
+        return rows
+
+    def check_share(self, records):
+        emails = self.existing(models.Viewer.__table__.c.email,
+                               [row['viewer_email'] for _, row in records])
+        private = {}
+        recordings = models.Recording.__table__.c
+        urls = list({row['recording_url'] for _, row in records})
+        for chunk in listing.chunked(urls, self.in_chunk):
+            private.update(tuple(row) for row in self.connection.execute(
+                select([recordings.url, recordings.is_private]).where(
+                    recordings.url.in_(chunk))))
+        shared = set()
+        shares = models.viewers.c
+        for url_chunk in listing.chunked(list(private), self.in_chunk):
+            for email_chunk in listing.chunked(list(emails), self.in_chunk):
+                shared.update(tuple(share) for share in
+                              self.connection.execute(select(
+                                  [shares.recording_url,
+                                   shares.viewer_email]).where(
+                                  shares.recording_url.in_(url_chunk) &
+                                  shares.viewer_email.in_(email_chunk))))
+        rows = []
+        for line, row in records:
+            url, email = row['recording_url'], row['viewer_email']
+            if email not in emails:
+                self.reject(line, "The Email " + email +
+                            " does not belong to a valid viewer.")
+            elif url not in private:
+                self.reject(line, "The URL " + url +
+                            " does not belong to a valid Recording.")
+            elif (url, email) in shared:
+                self.reject(line, "Cannot share meeting:" + url +
+                            " with the viewer " + email + " twice.")
+            elif private[url]:
+                self.reject(line, "Cannot add viewers to a private "
+                            "Recording.")
+            else:
+                shared.add((url, email))
+                rows.append(row)
+        return rows
+
+
+def insert_rows(connection, table, rows):
+    """executemany `rows`, grouped by the columns they set"""
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    for group in groups.values():
+        connection.execute(table.insert(), group)
@@ -0,0 +1,191 @@
+import json
+import os
+import tempfile
+import unittest
+from app import create_app
+from extensions import db, shards
+import changes
+import models
+import passwords
+import versions
+
+
+class TransferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = self.create_app('source.db')
+        self.dump = self.path('dump.ndjson')
+
+    def tearDown(self):
+        for app in (self.app, getattr(self, 'target', None)):
+            if app is not None:
+                with app.app_context():
+                    db.get_engine().dispose()
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def create_app(self, name, shard_count=0):
+        app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.path(name),
+            'PASSWORD_HASH_ITERATIONS': 1000,
+            'RECORDING_PURGE_WORKER': False,
+            'STORAGE_BACKEND': 'sharded' if shard_count else 'sqlalchemy',
+            'SHARD_DATABASE_URIS': [
+                'sqlite:///' + self.path('%s.shard%d' % (name, index))
+                for index in range(shard_count)],
+        })
+        with app.app_context():
+            db.create_all()
+            shards.create_all()
+        return app
+
+    def invoke(self, app, *args):
+        result = app.test_cli_runner(mix_stderr=False).invoke(args=args)
+        self.assertEqual(0, result.exit_code, result.output)
+        return result
+
+    def write_dump(self, records):
+        with open(self.dump, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    def test_export_import_round_trip(self):
+        """Ensure an export imported in an empty database exports the
+        same"""
+        client = self.app.test_client()
+        client.post('/viewer/create', json={'email': 'host@email.com'})
+        client.post('/viewer/create', json={'email': 'viewer@email.com'})
+        client.post('/meeting/create', json={'host_email': 'host@email.com',
+                                             'password': 'pass'})
+        client.post('/recording/create', json={'url': 'https://a/',
+                                               'is_private': False,
+                                               'meeting_id': 1})
+        client.post('/recording/share', json={'url': 'https://a/',
+                                              'email': 'viewer@email.com'})
+        result = self.invoke(self.app, 'export', '-o', self.dump,
+                             '--chunk', '1')
+        self.assertIn("2 viewers, 1 meetings, 1 recordings, 1 shares",
+                      result.stderr)
+
+        self.target = self.create_app('target.db')
+        result = self.invoke(self.target, 'import', self.dump)
+        self.assertIn("2 viewers, 1 meetings, 1 recordings, 1 shares",
+                      result.stdout)
+        with self.target.app_context():
+            self.assertIsNotNone(versions.get(db.session, 'meeting:1'))
+            self.assertEqual(['reset'], [event for _, event, _ in
+                                         changes.after(db.session, 0, 10)])
+        copy = self.path('copy.ndjson')
+        self.invoke(self.target, 'export', '-o', copy)
+        with open(self.dump) as original, open(copy) as imported:
+            self.assertEqual(original.read(), imported.read())
+
+    def test_export_skips_deleted_recordings(self):
+        """Ensure deleted recordings are not exported with the shares
+        still waiting for the purge"""
+        client = self.app.test_client()
+        client.post('/viewer/create', json={'email': 'host@email.com'})
+        client.post('/meeting/create', json={'host_email': 'host@email.com',
+                                             'password': 'pass'})
+        for url in ('https://a/', 'https://b/'):
+            client.post('/recording/create', json={'url': url,
+                                                   'is_private': False,
+                                                   'meeting_id': 1})
+            client.post('/recording/share', json={'url': url,
+                                                  'email': 'host@email.com'})
+        client.delete('/recording/delete', json={'url': 'https://a/'})
+        result = self.invoke(self.app, 'export', '-o', self.dump)
+        self.assertIn("1 viewers, 1 meetings, 1 recordings, 1 shares",
+                      result.stderr)
+        with open(self.dump) as f:
+            self.assertNotIn('https://a/', f.read())
+
+    def test_export_reads_the_shards(self):
+        """Ensure the recordings and shares of the shards are exported, and
+        imports with shards are refused"""
+        sharded = self.create_app('sharded.db', shard_count=2)
+        client = sharded.test_client()
+        client.post('/viewer/create', json={'email': 'host@email.com'})
+        for _ in range(2):
+            client.post('/meeting/create', json={
+                'host_email': 'host@email.com', 'password': 'pass'})
+        for meeting_id, url in ((1, 'https://a/'), (2, 'https://b/')):
+            client.post('/recording/create', json={'url': url,
+                                                   'is_private': False,
+                                                   'meeting_id': meeting_id})
+            client.post('/recording/share', json={'url': url,
+                                                  'email': 'host@email.com'})
+        result = self.invoke(sharded, 'export', '-o', self.dump)
+        self.assertIn("1 viewers, 2 meetings, 2 recordings, 2 shares",
+                      result.stderr)
+
+        result = sharded.test_cli_runner(mix_stderr=False).invoke(
+            args=['import', self.dump])
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("Cannot import with SHARD_DATABASE_URIS",
+                      result.stderr)
+
+    def test_import_applies_endpoint_rules(self):
+        """Ensure invalid records are reported and skipped"""
+        self.write_dump([
+            {'type': 'viewer', 'email': 'host@email.com'},
+            {'type': 'viewer', 'email': 'test@'},
+            {'type': 'viewer', 'email': 'host@email.com'},
+            {'type': 'meeting', 'id': 1, 'host_email': 'host@email.com',
+             'password': 'pass'},
+            {'type': 'meeting', 'host_email': 'nobody@email.com',
+             'password': 'pass'},
+            {'type': 'recording', 'url': 'https://a/', 'is_private': True,
+             'meeting_id': 1},
+            {'type': 'recording', 'url': 'https://a/', 'is_private': False,
+             'meeting_id': 1},
+            {'type': 'recording', 'url': 'https://b/', 'is_private': False,
+             'meeting_id': 100},
+            {'type': 'recording', 'url': 'https://c/', 'is_private': 'no',
+             'meeting_id': 1},
+            {'type': 'share', 'url': 'https://a/',
+             'email': 'host@email.com'},
+            {'type': 'unknown'},
+        ])
+        result = self.invoke(self.app, 'import', self.dump)
+        self.assertEqual(sorted([
+            "line 2: Invalid email.",
+            "line 3: Email already in use.",
+            "line 5: Invalid host email.",
+            "line 7: URL already exists.",
+            "line 8: Invalid meeting id.",
+            "line 9: Invalid field: is_private.",
+            "line 10: Cannot add viewers to a private Recording.",
+            "line 11: Invalid record type.",
+        ]), sorted(result.stderr.splitlines()))
+        with self.app.app_context():
+            self.assertEqual(1, models.Viewer.query.count())
+            self.assertEqual(1, models.Meeting.query.count())
+            self.assertTrue(passwords.is_hashed(
+                models.Meeting.query.get(1).password))
+            self.assertEqual(['https://a/'], [
+                recording.url for recording in models.Recording.query])
+
+    def test_import_resumes_from_checkpoint(self):
+        """Ensure committed chunks are recorded and skipped on resume"""
+        self.write_dump([{'type': 'viewer', 'email': 'viewer%d@email.com' % i}
+                         for i in range(5)])
+        checkpoint = self.path('checkpoint')
+        with open(checkpoint, 'w') as f:
+            f.write('3\n')
+        result = self.invoke(self.app, 'import', self.dump, '--chunk', '1',
+                             '--checkpoint', checkpoint)
+        self.assertIn("Imported 2 viewers", result.stdout)
+        with open(checkpoint) as f:
+            self.assertEqual('5', f.read().strip())
+        with self.app.app_context():
+            self.assertEqual(['viewer3@email.com', 'viewer4@email.com'], [
+                viewer.email for viewer in models.Viewer.query])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""
+Version counters of tables and rows, for conditional GETs.
+
+Counters live in the database and are bumped in the transaction of the
+write, so every worker process sees the same versions and a rolled back
+write does not bump anything.
+"""
+from itertools import chain
+from sqlalchemy import bindparam, inspect, select
+import datetime
+import hashlib
+import listing
+import models
+
+# Tables whose lists are versioned, and those whose rows are as well
+TABLES = ('meeting', 'recording', 'viewer')
+ROWS = ('meeting', 'recording')
+
+
+def row(table, key):
+    return '%s:%s' % (table, key)
+
+
+def changed(session):
+    """Names of the versions the pending changes of `session` bump"""
+    names = set()
+    for instance in chain(session.new, session.dirty, session.deleted):
+        table = getattr(instance, '__tablename__', None)
+        if table not in TABLES or (
+                instance in session.dirty and not session.is_modified(
+                    instance, include_collections=False)):
+            continue
+        names.add(table)
+        if table in ROWS:
+            key, = inspect(instance).mapper.primary_key_from_instance(
+                instance)
+            names.add(row(table, key))
+    return names
+
+
+def shared(urls):
+    """Names to bump when sharing the recordings `urls`. Shares are not
+    part of the representation of a recording, but the access decisions
+    cached against its version (see cache.py) depend on them."""
+    return {row('recording', url) for url in urls}
+
+
+def bump(connection, names, in_chunk=500):
+    """Increment the versions `names`, creating the missing ones"""
+    if not names:
+        return
+    table = models.versions
+    now = datetime.datetime.utcnow()
+    existing = set()
+    for chunk in listing.chunked(sorted(set(names)), in_chunk):
+        existing.update(name for name, in connection.execute(
+            select([table.c.name]).where(table.c.name.in_(chunk))))
+    if existing:
+        connection.execute(table.update().where(
+            table.c.name == bindparam('key')).values(
+            version=table.c.version + 1, modified=now),
+            [{'key': name} for name in existing])
+    missing = set(names) - existing
+    if missing:
+        connection.execute(table.insert(), [
+            {'name': name, 'version': 1, 'modified': now}
+            for name in sorted(missing)])
+
+
+def get(session, name):
+    """(version, modified) of `name`, or None if it was never bumped"""
+    table = models.versions
+    return session.execute(select([table.c.version, table.c.modified])
+                           .where(table.c.name == name)).first()
+
+
+def get_many(session, names, in_chunk=500):
+    """{name: (version, modified)} of the `names` that were ever bumped"""
+    table = models.versions
+    found = {}
+    for chunk in listing.chunked(sorted(set(names)), in_chunk):
+        found.update((name, (version, modified))
+                     for name, version, modified in session.execute(
+            select([table.c.name, table.c.version, table.c.modified])
+            .where(table.c.name.in_(chunk))))
+    return found
+
+
+def etag(version, modified, variant=b''):
+    """Strong ETag of a version, `variant` telling apart the
+    representations of one resource (e.g. its query string).
+
+    The time of the change is part of it, so a recreated database does not
+    reuse the ETags of the old one.
+    """
+    return '%d.%s.%s' % (version, modified.strftime('%Y%m%d%H%M%S%f'),
+                         hashlib.sha1(variant).hexdigest()[:12])
@@ -0,0 +1,10 @@
+"""
+WSGI entry point, e.g. `gunicorn --chdir app -c app/gunicorn.conf.py wsgi:app`
+"""
+from app import create_app
+from extensions import viewer_filter
+
+app = create_app()
+# Build the viewer prefilter once, before gunicorn forks the workers
+with app.app_context():
+    viewer_filter.warm()
@@ -0,0 +1,131 @@
+"""
+Latency of access checks while full-table lists flood the server.
+
+    python benchmarks/admission.py --dumpers 8 --checkers 4 --duration 20
+
+Seeds a dataset, then starts one gunicorn worker with --threads threads:
+without admission control, with the full lists limited to one request at a
+time each, and with a process-wide limit serving access checks first on top
+of that. --dumpers clients keep fetching /recording/get and /viewer/get
+whole while --checkers clients run access checks. Reports the access check
+latencies and the lists served and shed.
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+import dataset
+import harness
+from app import create_app
+from extensions import db
+
+LISTS = ('/recording/get', '/viewer/get')
+
+
+def seed(uri, args):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        with db.engine.begin() as conn:
+            dataset.seed(conn, args.viewers, args.meetings, args.recordings,
+                         args.shares, 1000)
+        db.get_engine().dispose()
+
+
+def dumper(port, index, deadline, results):
+    client = harness.Client(port)
+    served = shed = 0
+    for i in range(index, 1 << 62):
+        if time.time() >= deadline:
+            break
+        status = client.request('GET', LISTS[i % len(LISTS)])
+        if status == 200:
+            served += 1
+        else:
+            shed += 1
+            # What a client honouring Retry-After would do, shortened
+            time.sleep(0.1)
+    client.close()
+    results.append((served, shed))
+
+
+def checker(port, index, args, deadline, latencies, failures):
+    client = harness.Client(port)
+    rng = random.Random(index)
+    while time.time() < deadline:
+        k = rng.randint(0, args.shares - 1)
+        recording, viewer = dataset.share(k, args.recordings, args.viewers)
+        began = time.perf_counter()
+        status = client.request('GET', '/recording/has-access', {
+            'email': dataset.email(viewer), 'url': dataset.url(recording),
+            'password': dataset.PASSWORD})
+        if status == 200:
+            latencies.append(time.perf_counter() - began)
+        else:
+            failures.append(status)
+    client.close()
+
+
+def run(directory, uri, name, settings, args):
+    path = os.path.join(directory, name + '.py')
+    harness.write_settings(path, dict(settings, RECORDING_PURGE_WORKER=False))
+    env = {'MEETINGS_SETTINGS': path, 'MEETINGS_THREADS': str(args.threads)}
+    with harness.Server(uri, env=env) as server:
+        deadline = time.time() + args.duration
+        latencies, failures, dumps = [], [], []
+        threads = [threading.Thread(target=dumper, args=(
+            server.port, i, deadline, dumps)) for i in range(args.dumpers)]
+        threads.extend(threading.Thread(target=checker, args=(
+            server.port, i, args, deadline, latencies, failures))
+            for i in range(args.checkers))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    summary = harness.summarize(latencies, len(failures), args.duration)
+    served = sum(count for count, _ in dumps)
+    shed = sum(count for _, count in dumps)
+    print("%-10s %9.1f %8.1f %8.1f %8.1f %11.1f %10d" % (
+        name, summary['throughput'], summary['p50_ms'], summary['p95_ms'],
+        summary['p99_ms'], served / float(args.duration), shed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--viewers', type=int, default=10000)
+    parser.add_argument('--meetings', type=int, default=5000)
+    parser.add_argument('--recordings', type=int, default=20000)
+    parser.add_argument('--shares', type=int, default=50000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--dumpers', type=int, default=8)
+    parser.add_argument('--checkers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        uri = 'sqlite:///' + os.path.join(directory, 'admission.db')
+        seed(uri, args)
+        print("%-10s %9s %8s %8s %8s %11s %10s" % (
+            'admission', 'checks/s', 'p50 ms', 'p95 ms', 'p99 ms',
+            'lists/s', 'lists shed'))
+        run(directory, uri, 'off', {}, args)
+        run(directory, uri, 'on', {
+            'ADMISSION_ENABLED': True,
+            'ADMISSION_LIMITS': {'api.get_recordings': (1, 1),
+                                 'api.get_viewers': (1, 1)},
+        }, args)
+        run(directory, uri, 'priority', {
+            'ADMISSION_ENABLED': True,
+            'ADMISSION_LIMITS': {'api.get_recordings': (1, 1),
+                                 'api.get_viewers': (1, 1)},
+            'ADMISSION_MAX_CONCURRENCY': 4,
+            'ADMISSION_MAX_QUEUE': 8,
+        }, args)
+
+
+if __name__ == '__main__':
+    main()
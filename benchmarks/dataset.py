@@ -0,0 +1,81 @@
+"""
+Synthetic datasets for the benchmarks
+"""
+import os
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, 'app')
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+import models  # noqa: E402
+import passwords  # noqa: E402
+
+PASSWORD = 'pass'
+# Rows per executemany, keeps memory flat when seeding millions of rows
+CHUNK = 10000
+
+
+def email(i):
+    return "viewer%d@email.com" % i
+
+
+def url(i):
+    return "https://s3.amazonaws.com/meetings/recording%d/" % i
+
+
+def host(meeting_id, viewers):
+    return email((meeting_id * 7919) % viewers + 1)
+
+
+def meeting_of(recording, meetings):
+    return (recording * 104729) % meetings + 1
+
+
+def is_private(recording):
+    return recording % 10 == 0
+
+
+def share(k, recordings, viewers):
+    """Return the k-th (recording, viewer) share, all pairs being distinct
+    as long as k < public recordings * viewers"""
+    public = recordings - recordings // 10
+    index = k % public
+    recording = index + index // 9 + 1
+    viewer = (k // public + recording) % viewers + 1
+    return recording, viewer
+
+
+def _insert(conn, table, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK:
+            conn.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        conn.execute(table.insert(), chunk)
+
+
+def seed(conn, viewers, meetings, recordings, shares,
+         iterations=passwords.DEFAULT_ITERATIONS):
+    """Insert the dataset through `conn`, which should be in a transaction.
+
+    Every meeting is hosted by a viewer, every tenth recording is private
+    and shares only go to public recordings. Meetings share one hash of
+    PASSWORD, hashing each would take longer than the rest of the seed.
+    """
+    _insert(conn, models.Viewer.__table__, (
+        {'id': i, 'email': email(i)} for i in range(1, viewers + 1)))
+    stored = passwords.hash_password(PASSWORD, iterations)
+    _insert(conn, models.Meeting.__table__, (
+        {'id': i, 'host_email': host(i, viewers), 'password': stored}
+        for i in range(1, meetings + 1)))
+    _insert(conn, models.Recording.__table__, (
+        {'url': url(i), 'is_private': is_private(i),
+         'meeting_id': meeting_of(i, meetings)}
+        for i in range(1, recordings + 1)))
+    _insert(conn, models.viewers, (
+        {'recording_url': url(r), 'viewer_email': email(v)}
+        for r, v in (share(k, recordings, viewers) for k in range(shares))))
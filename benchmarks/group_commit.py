@@ -0,0 +1,107 @@
+"""
+Write throughput with and without group commit, for several windows.
+
+    python benchmarks/group_commit.py --windows 0.001 0.005 --duration 5
+
+Starts one gunicorn worker with --threads per run and drives it with
+concurrent keep-alive clients creating viewers. The first run commits in
+every request, the next ones enable GROUP_COMMIT_ENABLED with each window.
+"""
+import argparse
+import http.client
+import itertools
+import os
+import tempfile
+import threading
+import time
+
+import harness
+from app import create_app
+from extensions import db
+
+
+def metric(port, name):
+    """Value of an unlabelled sample on /metrics"""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', '/metrics')
+    body = conn.getresponse().read().decode('utf-8')
+    conn.close()
+    for line in body.splitlines():
+        if line.startswith(name + ' '):
+            return float(line.split()[1])
+    return 0.0
+
+
+def client(port, run, index, deadline, counts, failures):
+    client = harness.Client(port)
+    done = errors = 0
+    for i in itertools.count():
+        if time.time() >= deadline:
+            break
+        email = "run%d-client%d-%d@email.com" % (run, index, i)
+        if client.request('POST', '/viewer/create',
+                          {'email': email}) == 200:
+            done += 1
+        else:
+            errors += 1
+    client.close()
+    counts[index] = done
+    failures[index] = errors
+
+
+def run(uri, directory, index, window, args):
+    settings = {'SQLITE_PRAGMAS': {'synchronous': args.synchronous}}
+    if window is not None:
+        settings.update(GROUP_COMMIT_ENABLED=True,
+                        GROUP_COMMIT_WINDOW=window,
+                        GROUP_COMMIT_MAX_BATCH=args.max_batch)
+    path = os.path.join(directory, 'settings%d.py' % index)
+    harness.write_settings(path, settings)
+    env = {'MEETINGS_SETTINGS': path,
+           'MEETINGS_THREADS': str(args.threads)}
+    with harness.Server(uri, workers=1, env=env) as server:
+        counts = [0] * args.concurrency
+        errors = [0] * args.concurrency
+        deadline = time.time() + args.duration
+        threads = [threading.Thread(target=client, args=(
+            server.port, index, i, deadline, counts, errors))
+            for i in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        batches = metric(server.port, 'meetings_group_commit_batches_total')
+        units = metric(server.port, 'meetings_group_commit_units_total')
+        return (sum(counts) / float(args.duration), sum(errors),
+                units / batches if batches else 1.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--windows', type=float, nargs='+',
+                        default=[0, 0.001, 0.002, 0.005, 0.01])
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--synchronous', default='FULL',
+                        help="synchronous pragma of every connection")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        uri = 'sqlite:///' + os.path.join(directory, 'bench.db')
+        app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+        with app.app_context():
+            db.create_all()
+            db.get_engine().dispose()
+        print("window_ms  writes/s  writes/commit  errors")
+        for index, window in enumerate([None] + args.windows):
+            throughput, errors, per_commit = run(uri, directory, index,
+                                                 window, args)
+            print("%9s  %8.1f  %13.1f  %6d" % (
+                'off' if window is None else '%g' % (window * 1000),
+                throughput, per_commit, errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Running the API under a real WSGI server and timing requests against it
+"""
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from dataset import APP_DIR
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(latencies, errors, elapsed):
+    """Throughput and latency percentiles (in ms) of a run"""
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def write_settings(path, settings):
+    """Write a MEETINGS_SETTINGS file"""
+    with open(path, 'w') as f:
+        for name, value in sorted(settings.items()):
+            f.write('%s = %r\n' % (name, value))
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Server(object):
+    """gunicorn serving wsgi:app on a free local port"""
+
+    def __init__(self, uri, workers=1, profile='production', env=None):
+        self.port = free_port()
+        self.env = dict(os.environ, MEETINGS_DATABASE_URI=uri,
+                        MEETINGS_SQLITE_PROFILE=profile,
+                        MEETINGS_BIND='127.0.0.1:%d' % self.port,
+                        MEETINGS_WORKERS=str(workers))
+        self.env.update(env or {})
+        self.process = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(
+            [os.path.join(os.path.dirname(sys.executable), 'gunicorn'),
+             '--chdir', APP_DIR,
+             '-c', os.path.join(APP_DIR, 'gunicorn.conf.py'),
+             '--log-level', 'warning', 'wsgi:app'], env=self.env)
+        deadline = time.time() + 30
+        while time.time() < deadline and self.process.poll() is None:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        self.__exit__()
+        raise RuntimeError("gunicorn did not start")
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.wait()
+
+
+class Client(object):
+    """Keep-alive HTTP client sending JSON bodies like the test client"""
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = http.client.HTTPConnection('127.0.0.1', port)
+
+    def request(self, method, path, body=None):
+        """Send a request and return its status code"""
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError):
+            self.reconnect()
+            raise
+        if response.getheader('Connection') == 'close':
+            self.reconnect()
+        return response.status
+
+    def reconnect(self):
+        self.conn.close()
+        self.conn = http.client.HTTPConnection('127.0.0.1', self.port)
+
+    def close(self):
+        self.conn.close()
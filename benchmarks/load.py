@@ -0,0 +1,321 @@
+"""
+Load test and micro-benchmark of every endpoint.
+
+    python benchmarks/load.py --mode client --viewers 10000 --meetings 10000 \\
+        --recordings 100000 --shares 1000000 --output before.json
+    python benchmarks/load.py --mode server --concurrency 16 \\
+        --baseline before.json
+
+Seeds a synthetic dataset, then runs each endpoint scenario in turn, either
+in-process through the Flask test client (`client`) or against gunicorn
+with concurrent keep-alive clients (`server`), and reports throughput and
+p50/p95/p99 latency per endpoint. `--output` writes the results as JSON and
+`--baseline` compares against such a file from another version.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+import dataset
+import harness
+from app import create_app
+from extensions import db
+from sqlalchemy import create_engine
+
+BATCH = 25
+
+
+class Scenario(object):
+    """One endpoint, with a function building (path, body) for a request"""
+
+    def __init__(self, name, method, build, writes=False, full_list=False):
+        self.name = name
+        self.method = method
+        self.build = build
+        self.writes = writes
+        self.full_list = full_list
+
+
+def scenarios(args, tag):
+    viewers, meetings, recordings = args.viewers, args.meetings, \
+        args.recordings
+    counter = iter(range(1, 1 << 62))
+    lock = threading.Lock()
+    # Seeded recordings are deleted at most once, in random order
+    doomed = list(range(1, recordings + 1))
+    random.Random(1).shuffle(doomed)
+
+    def unique():
+        with lock:
+            return next(counter)
+
+    def any_email(rng):
+        return dataset.email(rng.randint(1, viewers))
+
+    def any_url(rng):
+        return dataset.url(rng.randint(1, recordings))
+
+    def access_check(rng):
+        recording = rng.randint(1, recordings)
+        if dataset.is_private(recording):
+            email = dataset.host(dataset.meeting_of(recording, meetings),
+                                 viewers)
+        else:
+            email = dataset.email(dataset.share(
+                rng.randint(0, args.shares - 1), recordings, viewers)[1]) \
+                if args.shares else any_email(rng)
+        return {'email': email, 'url': dataset.url(recording),
+                'password': dataset.PASSWORD}
+
+    def delete(rng):
+        with lock:
+            recording = doomed.pop() if doomed else 0
+        return '/recording/delete', {'url': dataset.url(recording)}
+
+    return [
+        Scenario('POST /viewer/create', 'POST', lambda rng: (
+            '/viewer/create',
+            {'email': 'bench-%s-%d@email.com' % (tag, unique())}),
+            writes=True),
+        Scenario('GET /viewer/get', 'GET', lambda rng: (
+            '/viewer/get', None), full_list=True),
+        Scenario('GET /viewer/get?limit=100', 'GET', lambda rng: (
+            '/viewer/get?limit=100&after=%d' % rng.randint(0, viewers),
+            None)),
+        Scenario('GET /viewer/recordings?limit=100', 'GET', lambda rng: (
+            '/viewer/recordings?limit=100&email=' + any_email(rng), None)),
+        Scenario('POST /meeting/create', 'POST', lambda rng: (
+            '/meeting/create',
+            {'host_email': any_email(rng), 'password': dataset.PASSWORD}),
+            writes=True),
+        Scenario('GET /meeting/get', 'GET', lambda rng: (
+            '/meeting/get', None), full_list=True),
+        Scenario('GET /meeting/get?limit=100', 'GET', lambda rng: (
+            '/meeting/get?limit=100&after=%d' % rng.randint(0, meetings),
+            None)),
+        Scenario('GET /meeting/get/<id>', 'GET', lambda rng: (
+            '/meeting/get/%d' % rng.randint(1, meetings), None)),
+        Scenario('POST /recording/create', 'POST', lambda rng: (
+            '/recording/create',
+            {'url': 'https://bench/%s/%d' % (tag, unique()),
+             'is_private': False,
+             'meeting_id': rng.randint(1, meetings)}), writes=True),
+        Scenario('POST /recording/share', 'POST', lambda rng: (
+            '/recording/share',
+            {'url': any_url(rng), 'email': any_email(rng)}), writes=True),
+        Scenario('POST /recording/share/bulk', 'POST', lambda rng: (
+            '/recording/share/bulk',
+            {'url': any_url(rng),
+             'emails': [any_email(rng) for _ in range(BATCH)]}),
+            writes=True),
+        Scenario('GET /recording/has-access', 'GET', lambda rng: (
+            '/recording/has-access', access_check(rng))),
+        Scenario('POST /recording/has-access/batch', 'POST', lambda rng: (
+            '/recording/has-access/batch',
+            {'checks': [access_check(rng) for _ in range(BATCH)]})),
+        Scenario('GET /recording/get', 'GET', lambda rng: (
+            '/recording/get', None), full_list=True),
+        Scenario('GET /recording/get?limit=100', 'GET', lambda rng: (
+            '/recording/get?limit=100&after=' + any_url(rng), None)),
+        Scenario('GET /recording/get/<url>', 'GET', lambda rng: (
+            '/recording/get/' + any_url(rng), None)),
+        Scenario('GET /stats', 'GET', lambda rng: ('/stats', None)),
+        Scenario('GET /stats/meeting/<id>', 'GET', lambda rng: (
+            '/stats/meeting/%d' % rng.randint(1, meetings), None)),
+        Scenario('GET /stats/recording/<url>', 'GET', lambda rng: (
+            '/stats/recording/' + any_url(rng), None)),
+        Scenario('GET /stats/viewer/<email>', 'GET', lambda rng: (
+            '/stats/viewer/' + any_email(rng), None)),
+        # Opens the feed from now on and returns after one poll
+        Scenario('GET /changes?timeout=0', 'GET', lambda rng: (
+            '/changes?timeout=0', None)),
+        # After the reads of seeded recordings, as it removes some
+        Scenario('DELETE /recording/delete', 'DELETE', delete,
+                 writes=True),
+        # After the deletes, so some of the urls are purging or purged
+        Scenario('GET /recording/delete/status/<url>', 'GET', lambda rng: (
+            '/recording/delete/status/' + any_url(rng), None)),
+    ]
+
+
+class TestClient(object):
+    """Same interface as harness.Client, in-process"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, json=body)
+        # Streamed bodies are only produced when read
+        response.get_data()
+        response.close()
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+def run_scenario(scenario, make_client, args):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + args.duration
+
+    def worker(index):
+        rng = random.Random(index)
+        client = make_client()
+        mine = []
+        failed = 0
+        try:
+            done = 0
+            while time.time() < deadline and (
+                    not args.requests or done < args.requests):
+                method, (path, body) = scenario.method, scenario.build(rng)
+                start = time.perf_counter()
+                try:
+                    status = client.request(method, path, body)
+                except Exception:
+                    status = 599
+                mine.append(time.perf_counter() - start)
+                if status >= 500:
+                    failed += 1
+                done += 1
+        finally:
+            client.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    start = time.time()
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return harness.summarize(latencies, errors[0], time.time() - start)
+
+
+def seed(uri, args):
+    engine = create_engine(uri)
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+    with app.app_context():
+        db.create_all()
+    with engine.begin() as conn:
+        dataset.seed(conn, args.viewers, args.meetings, args.recordings,
+                     args.shares)
+    engine.dispose()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=dataset.APP_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    print("%-34s %9s %8s %9s %9s %9s %7s" % (
+        "endpoint", "req/s", "requests", "p50 ms", "p95 ms", "p99 ms",
+        "errors"))
+    for name, result in results.items():
+        line = "%-34s %9.1f %8d %9.2f %9.2f %9.2f %7d" % (
+            name, result['throughput'], result['requests'],
+            result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['errors'])
+        before = (baseline or {}).get(name)
+        if before and before['p50_ms']:
+            line += "  p50 %+.0f%%, req/s %+.0f%%" % (
+                (result['p50_ms'] / before['p50_ms'] - 1) * 100,
+                (result['throughput'] / (before['throughput'] or 1) - 1)
+                * 100)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--mode', choices=('client', 'server'),
+                        default='client')
+    parser.add_argument('--viewers', type=int, default=10000)
+    parser.add_argument('--meetings', type=int, default=10000)
+    parser.add_argument('--recordings', type=int, default=100000)
+    parser.add_argument('--shares', type=int, default=1000000)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="gunicorn workers in server mode")
+    parser.add_argument('--duration', type=float, default=5,
+                        help="seconds per endpoint")
+    parser.add_argument('--requests', type=int, default=0,
+                        help="stop each client after this many requests")
+    parser.add_argument('--only', nargs='+', default=[],
+                        help="run the endpoints whose name contains these")
+    parser.add_argument('--full-lists', action='store_true',
+                        help="also dump whole tables through the list "
+                        "endpoints")
+    parser.add_argument('--read-only', action='store_true',
+                        help="skip the endpoints that write")
+    parser.add_argument('--db', help="database file to reuse between runs")
+    parser.add_argument('--output', help="write results as JSON here")
+    parser.add_argument('--baseline', help="JSON results to compare with")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.abspath(args.db or os.path.join(directory,
+                                                       'bench.db'))
+        uri = 'sqlite:///' + path
+        if not os.path.exists(path):
+            started = time.time()
+            seed(uri, args)
+            print("seeded in %.1fs" % (time.time() - started))
+
+        tag = uuid.uuid4().hex[:8]
+        selected = [scenario for scenario in scenarios(args, tag)
+                    if (args.full_lists or not scenario.full_list) and
+                    not (args.read_only and scenario.writes) and
+                    (not args.only or
+                     any(part in scenario.name for part in args.only))]
+
+        results = {}
+        if args.mode == 'client':
+            app = create_app({'SQLALCHEMY_DATABASE_URI': uri,
+                              'SQLITE_PROFILE': 'production'})
+            for scenario in selected:
+                results[scenario.name] = run_scenario(
+                    scenario, lambda: TestClient(app), args)
+        else:
+            with harness.Server(uri, workers=args.workers) as server:
+                for scenario in selected:
+                    results[scenario.name] = run_scenario(
+                        scenario, lambda: harness.Client(server.port), args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'revision': git_revision(),
+                'mode': args.mode,
+                'concurrency': args.concurrency,
+                'workers': args.workers if args.mode == 'server' else None,
+                'dataset': {'viewers': args.viewers,
+                            'meetings': args.meetings,
+                            'recordings': args.recordings,
+                            'shares': args.shares},
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
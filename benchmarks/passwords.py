@@ -0,0 +1,112 @@
+"""
+/recording/has-access latency with hashed meeting passwords.
+
+    python benchmarks/passwords.py --iterations 50000 150000 --budget-ms 20
+
+For each key derivation cost, seeds a dataset and runs the same random
+has-access checks (public recordings, with the right password) in-process,
+first with the credential cache disabled, then enabled and warmed up by one
+pass over the checks. The access decision cache is disabled throughout so
+every check reaches the password. Exits with status 1 if the p95 latency
+with the warm credential cache is over --budget-ms.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import dataset
+import harness
+from app import create_app
+from extensions import credential_cache, db
+
+
+def checks(args):
+    """The same (email, url) pairs for every run"""
+    rng = random.Random(args.seed)
+    pairs = []
+    for _ in range(args.checks):
+        recording, viewer = dataset.share(
+            rng.randint(0, args.shares - 1), args.recordings, args.viewers)
+        pairs.append((dataset.email(viewer), dataset.url(recording)))
+    return pairs
+
+
+def check_all(client, pairs):
+    latencies = []
+    errors = 0
+    start = time.time()
+    for email, url in pairs:
+        began = time.perf_counter()
+        response = client.get('/recording/has-access', json={
+            'email': email, 'url': url, 'password': dataset.PASSWORD})
+        latencies.append(time.perf_counter() - began)
+        if not response.get_json()['message'].startswith('SUCCESS'):
+            errors += 1
+    return harness.summarize(latencies, errors, time.time() - start)
+
+
+def run(uri, cache_size, pairs):
+    """Latencies of the checks, and the hit rate of the credential cache"""
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri,
+                      'ACCESS_CACHE_ENABLED': False,
+                      'CREDENTIAL_CACHE_SIZE': cache_size})
+    credential_cache.clear()
+    client = app.test_client()
+    if cache_size:
+        check_all(client, pairs)
+    before = credential_cache.stats()
+    result = check_all(client, pairs)
+    after = credential_cache.stats()
+    hits = after['hits'] - before['hits']
+    result['hit_rate'] = hits / float(
+        hits + after['misses'] - before['misses'])
+    with app.app_context():
+        db.get_engine().dispose()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--iterations', type=int, nargs='+',
+                        default=[150000])
+    parser.add_argument('--viewers', type=int, default=1000)
+    parser.add_argument('--meetings', type=int, default=200)
+    parser.add_argument('--recordings', type=int, default=2000)
+    parser.add_argument('--shares', type=int, default=10000)
+    parser.add_argument('--checks', type=int, default=2000)
+    parser.add_argument('--cache-size', type=int, default=1024)
+    parser.add_argument('--budget-ms', type=float, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    pairs = checks(args)
+    over_budget = False
+    print("iterations  cache  hit_rate  p50_ms  p95_ms  p99_ms  failed")
+    for iterations in args.iterations:
+        with tempfile.TemporaryDirectory() as directory:
+            uri = 'sqlite:///' + os.path.join(directory, 'bench.db')
+            app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+            with app.app_context():
+                db.create_all()
+                with db.engine.begin() as conn:
+                    dataset.seed(conn, args.viewers, args.meetings,
+                                 args.recordings, args.shares, iterations)
+                db.get_engine().dispose()
+            for cache_size in (0, args.cache_size):
+                result = run(uri, cache_size, pairs)
+                print("%10d  %5s  %8.2f  %6.2f  %6.2f  %6.2f  %6d" % (
+                    iterations, 'on' if cache_size else 'off',
+                    result['hit_rate'], result['p50_ms'], result['p95_ms'],
+                    result['p99_ms'], result['errors']))
+                if cache_size and result['p95_ms'] > args.budget_ms:
+                    over_budget = True
+    if over_budget:
+        print("p95 over the %g ms budget" % args.budget_ms)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
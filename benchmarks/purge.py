@@ -0,0 +1,111 @@
+"""
+Writer stalls while a widely shared recording is deleted.
+
+    python benchmarks/purge.py --shares 200000 --batches 200000 500
+
+Seeds one public recording shared with --shares viewers, starts one
+gunicorn worker with several threads and keeps creating viewers from one
+client while the recording is deleted. For each RECORDING_PURGE_BATCH,
+reports the latency of the DELETE request, the time until the status
+endpoint says "purged" and the latencies of the concurrent writes. A batch
+of all the shares purges in one transaction, like deleting them in the
+request used to.
+"""
+import argparse
+import http.client
+import json
+import os
+import tempfile
+import threading
+import time
+
+import dataset
+import harness
+from app import create_app
+from extensions import db
+
+URL = dataset.url(1)
+
+
+def seed(uri, shares):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        with db.engine.begin() as conn:
+            dataset.seed(conn, shares, 1, 1, 0, 1000)
+            dataset._insert(conn, dataset.models.viewers, (
+                {'recording_url': URL, 'viewer_email': dataset.email(i)}
+                for i in range(1, shares + 1)))
+        db.get_engine().dispose()
+
+
+def status(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', '/recording/delete/status/' + URL)
+    body = json.loads(conn.getresponse().read().decode('utf-8'))
+    conn.close()
+    return body['status']
+
+
+def writer(port, stop, latencies):
+    client = harness.Client(port)
+    i = 0
+    while not stop.is_set():
+        i += 1
+        began = time.perf_counter()
+        client.request('POST', '/viewer/create',
+                       {'email': "writer%d@email.com" % i})
+        latencies.append(time.perf_counter() - began)
+    client.close()
+
+
+def run(uri, directory, batch, args):
+    seed(uri, args.shares)
+    path = os.path.join(directory, 'settings%d.py' % batch)
+    harness.write_settings(path, {'RECORDING_PURGE_BATCH': batch})
+    env = {'MEETINGS_SETTINGS': path, 'MEETINGS_THREADS': '4'}
+    with harness.Server(uri, workers=1, env=env) as server:
+        stop = threading.Event()
+        latencies = []
+        thread = threading.Thread(target=writer,
+                                  args=(server.port, stop, latencies))
+        thread.start()
+        time.sleep(0.5)
+        client = harness.Client(server.port)
+        began = time.perf_counter()
+        client.request('DELETE', '/recording/delete', {'url': URL})
+        deleted = time.perf_counter() - began
+        client.close()
+        while status(server.port) != 'purged':
+            time.sleep(0.01)
+        purged = time.perf_counter() - began
+        time.sleep(0.5)
+        stop.set()
+        thread.join()
+    result = harness.summarize(latencies, 0, 1)
+    result.update(delete_ms=deleted * 1000, purge_s=purged,
+                  max_ms=max(latencies) * 1000)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shares', type=int, default=200000)
+    parser.add_argument('--batches', type=int, nargs='+',
+                        default=[200000, 500])
+    args = parser.parse_args()
+
+    print("batch  delete_ms  purge_s  write_p50_ms  write_p99_ms  "
+          "write_max_ms")
+    with tempfile.TemporaryDirectory() as directory:
+        uri = 'sqlite:///' + os.path.join(directory, 'bench.db')
+        for batch in args.batches:
+            result = run(uri, directory, batch, args)
+            print("%5d  %9.2f  %7.2f  %12.2f  %12.2f  %12.2f" % (
+                batch, result['delete_ms'], result['purge_s'],
+                result['p50_ms'], result['p99_ms'], result['max_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Query plans and timings of the hot lookups before and after `upgrade-db`.
+
+    python benchmarks/query_plans.py --meetings 10000 --shares 200000
+
+Builds a database with the tables as they were before the secondary
+indexes existed, seeds it with synthetic rows, then runs the migration
+and shows how the plan and latency of each lookup change.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from dataset import email, seed
+from extensions import db
+from sqlalchemy import create_engine
+import migrations
+
+QUERIES = [
+    ("recordings for a meeting",
+     "SELECT url FROM recording WHERE meeting_id = ?",
+     lambda args: random.randint(1, args.meetings)),
+    ("meetings hosted by X",
+     "SELECT id FROM meeting WHERE host_email = ?",
+     lambda args: email(random.randint(1, args.viewers))),
+    ("recordings shared with X",
+     "SELECT recording_url FROM viewers WHERE viewer_email = ?",
+     lambda args: email(random.randint(1, args.viewers))),
+]
+
+
+def create_old_schema(engine):
+    """Create the tables without the secondary indexes"""
+    db.metadata.create_all(engine)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(bind=engine)
+
+
+def measure(engine, args):
+    results = []
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        for name, sql, param in QUERIES:
+            plan = [row[-1] for row in cursor.execute(
+                "EXPLAIN QUERY PLAN " + sql, (param(args),))]
+            timings = []
+            for _ in range(args.runs):
+                value = param(args)
+                start = time.perf_counter()
+                cursor.execute(sql, (value,)).fetchall()
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            results.append((name, plan, timings[len(timings) // 2]))
+    finally:
+        conn.close()
+    return results
+
+
+def report(title, results):
+    print(title)
+    for name, plan, median in results:
+        print("  %-26s %9.3f ms  %s" % (
+            name, median * 1000, "; ".join(plan)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--viewers', type=int, default=20000)
+    parser.add_argument('--meetings', type=int, default=10000)
+    parser.add_argument('--recordings', type=int, default=50000)
+    parser.add_argument('--shares', type=int, default=200000)
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+    random.seed(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(
+            'sqlite:///' + os.path.join(directory, 'bench.db'))
+        create_old_schema(engine)
+        with engine.begin() as conn:
+            seed(conn, args.viewers, args.meetings, args.recordings,
+                 args.shares)
+
+        report("Before upgrade-db", measure(engine, args))
+        for change in migrations.upgrade(engine, db.metadata):
+            print("  " + change)
+        report("After upgrade-db", measure(engine, args))
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Write throughput of recording creates and shares against the shard count.
+
+    python benchmarks/shards.py --shards 0 2 4 --workers 4 --duration 10
+
+Seeds viewers and meetings in the main database, then starts gunicorn with
+--workers processes for each shard count (0 keeps the recordings in the main
+database) and drives it with concurrent keep-alive clients, each creating a
+recording in its own meeting and sharing it, in turn.
+"""
+import argparse
+import itertools
+import os
+import tempfile
+import threading
+import time
+
+import dataset
+import harness
+from app import create_app
+from extensions import db, shards
+
+
+def seed(uri, shard_uris, meetings):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri,
+                      'SHARD_DATABASE_URIS': shard_uris})
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        shards.create_all()
+        with db.engine.begin() as conn:
+            dataset.seed(conn, 1, meetings, 0, 0, 1000)
+        # Meetings in turn over the shards, like the API places new ones
+        if shard_uris:
+            meeting = dataset.models.Meeting.__table__
+            db.session.execute(meeting.update().values(
+                shard=meeting.c.id % len(shard_uris)))
+            db.session.commit()
+        db.get_engine().dispose()
+        for index in range(shards.count):
+            shards.engine(index).dispose()
+
+
+def client(port, run, index, meetings, deadline, counts, failures):
+    client = harness.Client(port)
+    done = errors = 0
+    meeting_id = 1 + index % meetings
+    for i in itertools.count():
+        if time.time() >= deadline:
+            break
+        url = "https://rec/run%d/client%d/%d" % (run, index, i)
+        for method, path, body in (
+                ('POST', '/recording/create',
+                 {'url': url, 'is_private': False,
+                  'meeting_id': meeting_id}),
+                ('POST', '/recording/share',
+                 {'url': url, 'email': dataset.email(1)})):
+            if client.request(method, path, body) == 200:
+                done += 1
+            else:
+                errors += 1
+    client.close()
+    counts[index] = done
+    failures[index] = errors
+
+
+def run(directory, run_index, shard_count, args):
+    uri = 'sqlite:///' + os.path.join(directory, 'main%d.db' % run_index)
+    shard_uris = ['sqlite:///' + os.path.join(
+        directory, 'run%d-shard%d.db' % (run_index, index))
+        for index in range(shard_count)]
+    seed(uri, shard_uris, args.concurrency)
+    settings = {'SQLITE_PRAGMAS': {'synchronous': args.synchronous},
+                'RECORDING_PURGE_WORKER': False}
+    if shard_count:
+        settings.update(STORAGE_BACKEND='sharded',
+                        SHARD_DATABASE_URIS=shard_uris)
+    path = os.path.join(directory, 'settings%d.py' % run_index)
+    harness.write_settings(path, settings)
+    env = {'MEETINGS_SETTINGS': path,
+           'MEETINGS_THREADS': str(args.threads)}
+    with harness.Server(uri, workers=args.workers, profile=args.profile,
+                        env=env) as server:
+        counts = [0] * args.concurrency
+        errors = [0] * args.concurrency
+        deadline = time.time() + args.duration
+        threads = [threading.Thread(target=client, args=(
+            server.port, run_index, i, args.concurrency, deadline, counts,
+            errors)) for i in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return sum(counts) / float(args.duration), sum(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shards', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--profile', default='production',
+                        help="SQLite profile of the main database and shards")
+    parser.add_argument('--synchronous', default='FULL',
+                        help="synchronous pragma of every connection")
+    args = parser.parse_args()
+
+    print("shards  writes/s  errors")
+    with tempfile.TemporaryDirectory() as directory:
+        for index, shard_count in enumerate(args.shards):
+            throughput, errors = run(directory, index, shard_count, args)
+            print("%6d  %8.1f  %6d" % (shard_count, throughput, errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Throughput of the API under gunicorn with 1 vs N worker processes.
+
+    python benchmarks/workers.py --workers 1 4 --duration 10
+
+Seeds one database, then for each worker count starts gunicorn on it with
+the production SQLite profile and drives it with concurrent keep-alive
+clients issuing a mix of reads and access checks.
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+import dataset
+import harness
+from app import create_app
+from extensions import db
+
+
+def seed(uri, args):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+    with app.app_context():
+        db.create_all()
+        with db.engine.begin() as conn:
+            dataset.seed(conn, args.viewers, args.meetings, args.recordings,
+                         args.recordings * 5)
+        db.get_engine().dispose()
+
+
+def requests(args, rng):
+    """Yield (method, path, body) of the request mix"""
+    while True:
+        choice = rng.random()
+        if choice < 0.5:
+            body = {'email': dataset.email(rng.randint(1, args.viewers)),
+                    'url': dataset.url(rng.randint(1, args.recordings)),
+                    'password': dataset.PASSWORD}
+            yield 'GET', '/recording/has-access', body
+        elif choice < 0.7:
+            yield 'GET', '/meeting/get/%d' % rng.randint(
+                1, args.meetings), None
+        elif choice < 0.9:
+            yield 'GET', '/recording/get/' + dataset.url(
+                rng.randint(1, args.recordings)), None
+        else:
+            yield 'GET', '/viewer/get?limit=50&after=%d' % rng.randint(
+                0, args.viewers), None
+
+
+def client(port, args, seed, deadline, counts, index):
+    client = harness.Client(port)
+    done = 0
+    for method, path, body in requests(args, random.Random(seed)):
+        if time.time() >= deadline:
+            break
+        client.request(method, path, body)
+        done += 1
+    client.close()
+    counts[index] = done
+
+
+def run(uri, workers, args):
+    with harness.Server(uri, workers=workers) as server:
+        counts = [0] * args.concurrency
+        deadline = time.time() + args.duration
+        threads = [threading.Thread(target=client, args=(
+            server.port, args, i, deadline, counts, i))
+            for i in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(counts) / float(args.duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--viewers', type=int, default=10000)
+    parser.add_argument('--meetings', type=int, default=2000)
+    parser.add_argument('--recordings', type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        uri = 'sqlite:///' + os.path.join(directory, 'bench.db')
+        seed(uri, args)
+        print("workers  requests/s")
+        for workers in args.workers:
+            print("%7d  %10.1f" % (workers, run(uri, workers, args)))
+
+
+if __name__ == '__main__':
+    main()